@@ -1,20 +1,18 @@
-import asyncio
 import time
 import torch
 import os
-from datetime import datetime
-from PyQt6.QtCore import QObject, pyqtSignal as Signal, QThreadPool
+from PyQt6.QtCore import QObject, pyqtSignal as Signal
 from PyQt6.QtGui import QImage
 import psutil
 
 # 注释掉Stable Diffusion引用
 # from stable_diffusion import StableDiffusion
 from sonnet import Sonnet
-
-
-def log(prefix, message):
-    timestamp = datetime.now().strftime("%H:%M:%S.%f")[:-3]
-    print(f"[{timestamp}] [{prefix}] {message}")
+from llm_events import TextDelta, PromptTag
+from log_utils import log, error, flush as flush_log
+from loop_thread import EventLoopThread
+from pipeline import ChatPipeline, ImageReady, TurnError, TurnDone
+from text_coalescer import TextCoalescer
 
 
 class AIManagerSonnet(QObject):
@@ -41,11 +39,10 @@ class AIManagerSonnet(QObject):
             log("AIManagerSonnet", f"初始化StableDiffusion失败: {str(e)}")
             # self.sd_service = StableDiffusion(None)
 
-        self.loop = None
-
-        # 创建线程池
-        self.thread_pool = QThreadPool()
-        self.thread_pool.setMaxThreadCount(2)
+        # 常驻事件循环线程，按顺序处理每轮对话
+        self.loop_thread = EventLoopThread("AIManagerSonnetLoop", self._handle_loop_exception)
+        # 合并文本片段，每帧（或累计一定字符数）才向UI发射一次text_chunk_ready
+        self.text_coalescer = TextCoalescer(self.text_chunk_ready.emit, flush_interval=1 / 60, max_chars=256)
 
         # 初始化任务集合和状态标志
         self.running_tasks = set()
@@ -64,6 +61,9 @@ class AIManagerSonnet(QObject):
         self.blank_image = QImage(512, 512, QImage.Format.Format_RGB888)
         self.blank_image.fill(0xFFFFFF)  # 填充白色
 
+        # 与界面无关的对话流程，图像生成替换为返回空白图像
+        self.pipeline = ChatPipeline(self.sonnet_service, self._generate_image)
+
     def monitor_memory(self):
         """监控内存使用情况"""
         if torch.cuda.is_available():
@@ -82,16 +82,18 @@ class AIManagerSonnet(QObject):
         log("AIManagerSonnet", "开始清理资源")
         self._is_shutting_down = True
 
-        # 取消所有运行中的任务
-        for task in list(self.running_tasks):
+        # 取消排队中与正在进行的对话
+        self.cancel_current_turn()
+
+        # 在事件循环中关闭复用的HTTP连接池
+        if self.loop_thread.is_running:
             try:
-                if hasattr(task, 'cancel'):
-                    task.cancel()
+                self.loop_thread.run_coroutine(self.sonnet_service.aclose()).result(timeout=5)
             except Exception as e:
-                log("AIManagerSonnet", f"取消任务时出错: {str(e)}")
+                error("AIManagerSonnet", f"关闭HTTP连接池时出错: {str(e)}")
 
-        # 等待线程池完成
-        self.thread_pool.waitForDone()
+        # 停止事件循环，未完成的对话会被取消
+        self.loop_thread.stop()
 
         # 清理其他资源
         self.running_tasks.clear()
@@ -99,146 +101,95 @@ class AIManagerSonnet(QObject):
         # if hasattr(self, 'sd_service'):
         #     del self.sd_service
         if hasattr(self, 'sonnet_service'):
+            self.sonnet_service.close()
             del self.sonnet_service
 
         log("AIManagerSonnet", "资源清理完成")
+        flush_log()
         self._is_shutting_down = False
 
-    def process_conversation(self, user_input: str):
+    def process_conversation(self, user_input: str, supersede: bool = False):
+        """
+        提交一轮对话
+        Args:
+            user_input: 用户输入
+            supersede: 为True时先取消排队中与正在进行的对话，新消息立即开始处理
+        """
         log("AIManagerSonnet", f"开始处理对话，用户输入: '{user_input}'")
-        # 在单独线程中启动处理流程
-        self.thread_pool.start(lambda: self._process_in_thread(user_input))
-        log("AIManagerSonnet", "对话处理任务已加入线程池")
-
-    def _process_in_thread(self, user_input: str):
+        # 检查是否正在关闭
+        if self._is_shutting_down or not self.loop_thread.is_running:
+            log("AIManagerSonnet", "管理器正在关闭，取消处理")
+            return
+
+        if supersede:
+            self.cancel_current_turn()
+
+        # 提交到常驻事件循环的对话队列
+        future = self.loop_thread.submit(self._run_turn, user_input)
+        self.running_tasks.add(future)
+        future.add_done_callback(self.running_tasks.discard)
+        log("AIManagerSonnet", "对话处理任务已加入队列")
+
+    def cancel_current_turn(self):
+        """取消排队中与正在进行的对话，包括其LLM流与图像生成"""
+        cancelled = 0
+        for future in list(self.running_tasks):
+            if future.cancel():
+                cancelled += 1
+        self.loop_thread.cancel_current()
+        log("AIManagerSonnet", f"已取消{cancelled}个对话任务")
+
+    def _handle_loop_exception(self, loop, context):
+        """事件循环的默认异常处理器"""
+        exception = context.get('exception')
+        msg = context.get('message')
+        if exception:
+            error("AIManagerSonnet", f"异步任务异常: {str(exception)}")
+            self.error_occurred.emit(str(exception))
+        elif msg:
+            log("AIManagerSonnet", f"异步任务消息: {msg}")
+
+    async def _run_turn(self, user_input: str):
         try:
-            log("AIManagerSonnet", f"线程启动，准备处理: '{user_input}'")
-            self.loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(self.loop)
-
-            # 设置默认的异常处理器
-            def exception_handler(loop, context):
-                exception = context.get('exception')
-                msg = context.get('message')
-                if exception:
-                    log("AIManagerSonnet", f"异步任务异常: {str(exception)}")
-                    self.error_occurred.emit(str(exception))
-                elif msg:
-                    log("AIManagerSonnet", f"异步任务消息: {msg}")
-
-            self.loop.set_exception_handler(exception_handler)
-
-            # 检查是否正在关闭
-            if self._is_shutting_down:
-                log("AIManagerSonnet", "管理器正在关闭，取消处理")
-                return
-
-            log("AIManagerSonnet", "开始运行主处理任务")
-            main_task = self.loop.create_task(self._async_process(user_input))
-            self.loop.run_until_complete(main_task)
-
+            log("AIManagerSonnet", f"开始运行主处理任务: '{user_input}'")
+            await self._async_process(user_input)
         except Exception as e:
-            log("AIManagerSonnet", f"线程处理错误: {str(e)}")
+            error("AIManagerSonnet", f"对话处理错误: {str(e)}")
             self.error_occurred.emit(f"处理错误: {str(e)}")
 
     async def _async_process(self, user_input: str):
         log("AIManagerSonnet", f"开始异步处理用户输入: '{user_input}'")
-        prompt_content = ""
-        collecting_prompt = False
-        collecting_think = False
-
         self.thinking_changed.emit(True)
-
-        async for chunk in self.sonnet_service.generate_response(user_input):
-            # 检查并处理</think>结束标签
-            if collecting_think and "</think>" in chunk:
-                parts = chunk.split("</think>")
-                collecting_think = False
-                # 如果标签后有内容，发送到UI
-                if len(parts) > 1 and parts[1]:
-                    self.text_chunk_ready.emit(parts[1])
-                continue
-
-            # 检查并处理<think>开始标签
-            if not collecting_think and "<think>" in chunk:
-                parts = chunk.split("<think>")
-                # 发送标签之前的文本
-                if parts[0]:
-                    self.text_chunk_ready.emit(parts[0])
-                collecting_think = True
-                continue
-
-            # 跳过思考内容
-            if collecting_think:
-                continue
-
-            # 检查并处理}结束标签
-            if collecting_prompt and "}" in chunk:
-                parts = chunk.split("}")
-                if parts[0]:
-                    prompt_content += parts[0]
-
-                log("AIManagerSonnet", f"完整提示词: '{prompt_content}'")
-                self.prompt_extracted.emit(prompt_content)
-
-                # 启动图像生成任务
-                log("AIManagerSonnet", "创建图像生成协程任务")
-                image_task = asyncio.create_task(self._generate_image(prompt_content))
-                try:
-                    # 等待图像生成任务完成
-                    log("AIManagerSonnet", "等待图像生成任务完成")
-                    await image_task
-                    log("AIManagerSonnet", "图像生成任务完成")
-                except Exception as e:
-                    log("AIManagerSonnet", f"图像生成任务出错: {str(e)}")
-                    self.error_occurred.emit(f"图像生成失败: {str(e)}")
-
-                collecting_prompt = False
-
-                # 发送标签后的文本
-                if len(parts) > 1 and parts[1]:
-                    log("AIManagerSonnet", f"发送{"}"}后的文本: '{parts[1]}'")
-                    self.text_chunk_ready.emit(parts[1])
-
-                continue
-
-            # 检查并处理{开始标签
-            if not collecting_prompt and "{" in chunk:
-                parts = chunk.split("{")
-                if parts[0]:
-                    self.text_chunk_ready.emit(parts[0])
-
-                collecting_prompt = True
-                prompt_content = ""
-
-                # 如果标签后有内容，添加到提示词
-                if len(parts) > 1 and parts[1]:
-                    prompt_content += parts[1]
-
-                continue
-
-            # 收集提示词内容
-            if collecting_prompt:
-                prompt_content += chunk
-            # 正常文本内容
-            else:
-                self.text_chunk_ready.emit(chunk)
-
-        log("AIManagerSonnet", "发出thinking_changed信号(False)")
-        self.thinking_changed.emit(False)
+        try:
+            # 界面不显示思考内容，后端不产生ThinkingDelta
+            await self.pipeline.run_turn(user_input, self._handle_pipeline_event, thinking=False)
+        finally:
+            self.text_coalescer.flush()
+            log("AIManagerSonnet", "发出thinking_changed信号(False)")
+            self.thinking_changed.emit(False)
         log("AIManagerSonnet", "异步处理完成")
 
-    async def _generate_image(self, prompt: str):
-        # 替换为返回空白图像而不是使用StableDiffusion
+    def _handle_pipeline_event(self, event):
+        """把ChatPipeline的事件转换为Qt信号，在事件循环线程中调用"""
+        event_type = type(event)
+        if event_type is TextDelta:
+            self.text_coalescer.add(event.text)
+        elif event_type is PromptTag:
+            self.text_coalescer.flush()
+            log("AIManagerSonnet", f"完整提示词: '{event.prompt}'")
+            self.prompt_extracted.emit(event.prompt)
+        elif event_type is ImageReady:
+            self.image_ready.emit(event.images)
+        elif event_type is TurnError:
+            self.error_occurred.emit(event.message)
+        elif event_type is TurnDone:
+            self.text_coalescer.flush()
+        # Usage: 已由ChatPipeline计入本轮耗时
+
+    def _generate_image(self, prompt: str, *args):
+        # 替换为返回空白图像而不是使用StableDiffusion，由ChatPipeline在线程池中调用
         log("AIManagerSonnet", f"图像生成已禁用，返回空白图像。原提示词: '{prompt}'")
-        
-        # 直接返回空白图像
-        qt_images = [self.blank_image]
-        
-        # 发送信号到UI
-        self.image_ready.emit(qt_images)
-        
-        return True
+        return [self.blank_image]
 
     # 以下是原来的代码，已注释掉
     '''
@@ -285,7 +236,7 @@ class AIManagerSonnet(QObject):
                     qimage = QImage(bytes_data, width, height, width * 3, QImage.Format.Format_RGB888).copy()
                     qt_images.append(qimage)
                 except Exception as e:
-                    log("AIManagerSonnet", f"图像转换错误: {str(e)}")
+                    error("AIManagerSonnet", f"图像转换错误: {str(e)}")
                     continue
 
             if qt_images:
@@ -297,7 +248,7 @@ class AIManagerSonnet(QObject):
                 self.error_occurred.emit("图像转换失败")
                 return False
         except Exception as e:
-            log("AIManagerSonnet", f"图像生成过程中出错: {str(e)}")
+            error("AIManagerSonnet", f"图像生成过程中出错: {str(e)}")
             self.error_occurred.emit(f"图像生成错误: {str(e)}")
             return False
     '''
@@ -0,0 +1,157 @@
+from typing import Callable, List
+
+# 每条消息在聊天模板中的额外开销（角色标记、分隔符）
+MESSAGE_OVERHEAD = 4
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    粗略估算token数：中日韩字符约1个token，其余约4个字符1个token
+    用UTF-8字节数推算宽字符数量，避免逐字符遍历
+    """
+    wide = (len(text.encode("utf-8")) - len(text)) // 2
+    return wide + (len(text) - wide + 3) // 4
+
+
+def tokenizer_counter(name_or_path: str) -> Callable[[str], int]:
+    """用transformers分词器精确计数（可选依赖），name_or_path为本地或HF上的分词器"""
+    from transformers import AutoTokenizer
+
+    tokenizer = AutoTokenizer.from_pretrained(name_or_path)
+    return lambda text: len(tokenizer.encode(text, add_special_tokens=False))
+
+
+class ChatHistory:
+    """
+    按token预算管理的对话历史
+
+    系统提示词只保存一份并始终位于消息列表开头；每条消息的token数在加入时计算一次并缓存，
+    总量超过max_tokens时从最早的一轮对话开始成对删除user/assistant消息，直到不超过trim_to。
+    trim_to明显小于max_tokens时一次删除一大块，之后多轮对话的消息前缀保持不变，便于推理端复用KV缓存。
+    """
+
+    def __init__(self, system_prompt: str, max_tokens=4096, count_tokens=estimate_tokens, trim_to=None):
+        self.max_tokens = max_tokens
+        self.trim_to = max_tokens if trim_to is None else min(trim_to, max_tokens)
+        self.count_tokens = count_tokens
+        self.system_message = {'role': 'system', 'content': system_prompt}
+        self.system_tokens = count_tokens(system_prompt) + MESSAGE_OVERHEAD
+        self.turns = []  # 系统提示词之后的user/assistant消息
+        self._counts = []  # 与turns一一对应的token数缓存
+        self.total_tokens = self.system_tokens
+        self.trimmed_messages = 0  # 累计被删除的消息数
+        self.conversation = None  # 对话日志中的对话名，SessionManager设为会话id，None时由使用方决定
+        self.last_thinking_budget = None  # 上一轮请求的思考预算，思考参数变化会使这段对话的消息缓存失效
+
+    def __len__(self):
+        return len(self.turns) + 1
+
+    def add(self, role: str, content: str) -> dict:
+        message = {'role': role, 'content': content}
+        tokens = self.count_tokens(content) + MESSAGE_OVERHEAD
+        self.turns.append(message)
+        self._counts.append(tokens)
+        self.total_tokens += tokens
+        return message
+
+    def add_user(self, content: str) -> dict:
+        return self.add('user', content)
+
+    def add_assistant(self, content: str) -> dict:
+        return self.add('assistant', content)
+
+    def pop(self) -> dict:
+        """删除并返回最后一条消息，如请求失败时未得到回复的用户消息"""
+        self.total_tokens -= self._counts.pop()
+        return self.turns.pop()
+
+    def _drop_oldest(self, count: int):
+        self.total_tokens -= sum(self._counts[:count])
+        del self.turns[:count]
+        del self._counts[:count]
+        self.trimmed_messages += count
+
+    def trim(self) -> int:
+        """超出预算时删除最早的对话直到不超过trim_to，最后一条消息始终保留，返回删除的消息数"""
+        if self.total_tokens <= self.max_tokens:
+            return 0
+        trimmed = 0
+        while self.total_tokens > self.trim_to and len(self.turns) > 1:
+            # 成对删除以保持user/assistant交替
+            count = 2 if len(self.turns) > 2 and self.turns[1]['role'] == 'assistant' else 1
+            self._drop_oldest(count)
+            trimmed += count
+        return trimmed
+
+    def messages(self) -> List[dict]:
+        """返回发送给模型的消息列表"""
+        return [self.system_message] + self.turns
+
+    def dump(self) -> dict:
+        """导出可序列化的状态（不含系统提示词），token数缓存一并保存，载入时无需重新计数"""
+        return {'turns': self.turns, 'counts': self._counts, 'trimmed': self.trimmed_messages,
+                'thinking_budget': self.last_thinking_budget}
+
+    def load(self, state: dict):
+        """载入dump()导出的状态"""
+        self.turns = list(state['turns'])
+        self._counts = list(state['counts'])
+        self.total_tokens = self.system_tokens + sum(self._counts)
+        self.trimmed_messages = state.get('trimmed', 0)
+        self.last_thinking_budget = state.get('thinking_budget')
+
+    def reset(self):
+        """清空对话，仅保留系统提示词"""
+        self.turns = []
+        self._counts = []
+        self.total_tokens = self.system_tokens
+        self.last_thinking_budget = None
+
+
+if __name__ == "__main__":
+    # 长对话测试：对比原先每轮重复追加系统提示词的历史与按预算管理的历史的请求大小
+    # python chat_history.py [轮数] [token预算]
+    import sys
+    import time
+
+    from deepseek import Deepseek
+
+    turns = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    budget = int(sys.argv[2]) if len(sys.argv) > 2 else 4096
+    persona = Deepseek().init_content
+    user_text = "主人今天想和你一起出去玩，你想去哪里呀？"
+    reply_text = "{light blue hair, cat ear, opened, school uniform, smile}" + "好呀主人，我们去公园吧喵～" * 20
+
+    def request_tokens(messages):
+        return sum(estimate_tokens(m['content']) + MESSAGE_OVERHEAD for m in messages)
+
+    # 原先Deepseek.chat的做法：need_init=True时每轮后再追加一份系统提示词
+    legacy = [{'role': 'system', 'content': persona}]
+    history = ChatHistory(persona, max_tokens=budget)
+    legacy_sizes = []
+    sizes = []
+    trim_time = 0.0
+    for turn in range(1, turns + 1):
+        legacy.append({'role': 'user', 'content': user_text})
+        legacy_sizes.append(request_tokens(legacy))
+        legacy.append({'role': 'assistant', 'content': reply_text})
+        legacy.append({'role': 'system', 'content': persona})
+
+        history.add_user(user_text)
+        start = time.perf_counter()
+        history.trim()
+        trim_time += time.perf_counter() - start
+        messages = history.messages()
+        sizes.append(request_tokens(messages))
+        # 缓存的计数必须与重新计算的结果一致
+        assert sizes[-1] == history.total_tokens
+        assert sum(m['role'] == 'system' for m in messages) == 1 and messages[0]['role'] == 'system'
+        assert sizes[-1] <= budget
+        history.add_assistant(reply_text)
+
+    for turn in (1, 10, 50, turns):
+        print(f"第{turn}轮: 原先 {legacy_sizes[turn - 1]} tokens "
+              f"({sum(m['role'] == 'system' for m in legacy[:turn * 3])}份系统提示词), "
+              f"ChatHistory {sizes[turn - 1]} tokens")
+    print(f"ChatHistory最大请求 {max(sizes)} tokens (预算{budget}), "
+          f"删除消息 {history.trimmed_messages}条, 平均trim耗时 {trim_time / turns * 1e6:.1f}us")
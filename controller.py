@@ -1,42 +1,51 @@
 import asyncio
 import time
 import torch
-from datetime import datetime
-from PyQt6.QtCore import QObject, pyqtSignal as Signal, QThreadPool
-from PyQt6.QtGui import QImage
+from PyQt6.QtCore import QObject, pyqtSignal as Signal
 import psutil
 
 from deepseek import Deepseek
-from stable_diffusion import StableDiffusion
-
-
-def log(prefix, message):
-    timestamp = datetime.now().strftime("%H:%M:%S.%f")[:-3]
-    print(f"[{timestamp}] [{prefix}] {message}")
+from image_convert import ndarray_to_qimages
+from llm_events import TextDelta, PromptTag
+from log_utils import log, error, flush as flush_log
+from loop_thread import EventLoopThread
+from metrics import pipeline_metrics
+from pipeline import ChatPipeline, DiffusionWorker, ImagePreview, ImageReady, TurnError, TurnDone
+from text_coalescer import TextCoalescer
 
 
 class AIManager(QObject):
     text_chunk_ready = Signal(str)  # 发送文本片段到UI
     image_ready = Signal(list)  # 发送生成的图像到UI
+    preview_ready = Signal(list)  # 发送去噪过程中的低分辨率预览图到UI
     thinking_changed = Signal(bool)  # 指示AI是否在思考
     prompt_extracted = Signal(str)  # 当提取到图像提示词时发射信号
     error_occurred = Signal(str)  # 错误信号
+    ready_changed = Signal(bool)  # 预热完成（模型已加载）时发射True
 
     def __init__(self, parent=None):
         super().__init__(parent)
         log("AIManager", "初始化AIManager")
         self.deepseek_service = Deepseek()
-        self.sd_service = StableDiffusion()
-        self.loop = None
-
-        # 创建线程池
-        self.thread_pool = QThreadPool()
-        self.thread_pool.setMaxThreadCount(2)
+        # 常驻事件循环线程，按顺序处理每轮对话
+        self.loop_thread = EventLoopThread("AIManagerLoop", self._handle_loop_exception)
+        # 合并文本片段，每帧（或累计一定字符数）才向UI发射一次text_chunk_ready
+        self.text_coalescer = TextCoalescer(self.text_chunk_ready.emit, flush_interval=1 / 60, max_chars=256)
+
+        # 图像生成专用线程，SD在其中加载（见warm_up），输出直接转换为QImage；每5个去噪步发送一次预览
+        self.image_worker = DiffusionWorker(ndarray_to_qimages, preview_every=5,
+                                            before_generate=self._before_generate)
+        # 与界面无关的对话+图像生成流程，结果以事件形式交给_handle_pipeline_event
+        self.pipeline = ChatPipeline(self.deepseek_service, self.image_worker.generate,
+                                     executor=self.image_worker.executor, previews=True)
 
         # 初始化任务集合和状态标志
         self.running_tasks = set()
         self._is_shutting_down = False
         self._cleanup_pending = False
+        self.is_ready = False
+        self.warmup_future = None
+        self._first_reply_pending = True  # 尚未显示过任何回复文字
 
         # 添加性能监控计数器
         self.conversation_count = 0
@@ -46,6 +55,38 @@ class AIManager(QObject):
         # 初始化内存监控
         self.monitor_memory()
 
+    def warm_up(self):
+        """
+        后台预热，立即返回：在图像生成线程中加载SD并做一次极短的去噪，
+        同时让Ollama把模型加载到显存，两者并行；完成后发射ready_changed(True)
+        """
+        if self.warmup_future is not None:
+            return self.warmup_future
+        log("AIManager", "开始后台预热")
+        # SD加载最先进入图像生成线程的队列，之后的图像生成任务自然排在其后
+        sd_future = self.image_worker.warm_up()
+        self.warmup_future = self.loop_thread.run_coroutine(self._warm_up(sd_future))
+        return self.warmup_future
+
+    async def _warm_up(self, sd_future):
+        start = time.perf_counter()
+        sd_result, llm_result = await asyncio.gather(
+            asyncio.wrap_future(sd_future), self.deepseek_service.warm_up(), return_exceptions=True)
+        stats = {"warmup_total_seconds": time.perf_counter() - start}
+        for name, result in (("StableDiffusion", sd_result), ("Ollama", llm_result)):
+            if isinstance(result, Exception):
+                error("AIManager", f"{name}预热失败: {str(result)}")
+                self.error_occurred.emit(f"{name}预热失败: {str(result)}")
+            else:
+                stats.update(result)
+        stats["startup_ready_seconds"] = time.time() - psutil.Process().create_time()
+        for name, value in stats.items():
+            pipeline_metrics.record(name, value)
+        log("AIManager", f"预热完成: {stats}")
+        self.is_ready = True
+        self.ready_changed.emit(True)
+        return stats
+
     def monitor_memory(self):
         """监控内存使用情况"""
         if torch.cuda.is_available():
@@ -64,205 +105,178 @@ class AIManager(QObject):
         log("AIManager", "开始清理资源")
         self._is_shutting_down = True
 
-        # 取消所有运行中的任务
-        for task in list(self.running_tasks):
+        # 取消排队中与正在进行的对话
+        self.cancel_current_turn()
+
+        # 在事件循环中关闭复用的Ollama连接
+        if self.loop_thread.is_running:
             try:
-                if hasattr(task, 'cancel'):
-                    task.cancel()
+                self.loop_thread.run_coroutine(self.deepseek_service.aclose()).result(timeout=5)
             except Exception as e:
-                log("AIManager", f"取消任务时出错: {str(e)}")
+                error("AIManager", f"关闭Ollama连接时出错: {str(e)}")
 
-        # 等待线程池完成
-        self.thread_pool.waitForDone()
+        # 停止事件循环，未完成的对话会被取消
+        self.loop_thread.stop()
+        self.image_worker.shutdown()
 
         # 清理其他资源
         self.running_tasks.clear()
-        if hasattr(self, 'sd_service'):
-            del self.sd_service
         if hasattr(self, 'deepseek_service'):
             del self.deepseek_service
 
         log("AIManager", "资源清理完成")
+        flush_log()
         self._is_shutting_down = False
 
-    def process_conversation(self, user_input: str):
+    def process_conversation(self, user_input: str, supersede: bool = False):
+        """
+        提交一轮对话
+        Args:
+            user_input: 用户输入
+            supersede: 为True时先取消排队中与正在进行的对话，新消息立即开始处理
+        """
         log("AIManager", f"开始处理对话，用户输入: '{user_input}'")
-        # 在单独线程中启动处理流程
-        self.thread_pool.start(lambda: self._process_in_thread(user_input))
-        log("AIManager", "对话处理任务已加入线程池")
-
-    def _process_in_thread(self, user_input: str):
+        # 检查是否正在关闭
+        if self._is_shutting_down or not self.loop_thread.is_running:
+            log("AIManager", "管理器正在关闭，取消处理")
+            return
+
+        if supersede:
+            self.cancel_current_turn()
+
+        # 提交到常驻事件循环的对话队列
+        future = self.loop_thread.submit(self._run_turn, user_input)
+        self.running_tasks.add(future)
+        future.add_done_callback(self.running_tasks.discard)
+        log("AIManager", "对话处理任务已加入队列")
+
+    def cancel_current_turn(self):
+        """取消排队中与正在进行的对话，包括其LLM流与图像生成"""
+        cancelled = 0
+        for future in list(self.running_tasks):
+            if future.cancel():
+                cancelled += 1
+        self.loop_thread.cancel_current()
+        # 图像生成线程在下一个去噪步结束时退出
+        self.pipeline.cancel_images()
+
+        log("AIManager", f"已取消{cancelled}个对话任务")
+
+    def _handle_loop_exception(self, loop, context):
+        """事件循环的默认异常处理器"""
+        exception = context.get('exception')
+        msg = context.get('message')
+        if exception:
+            error("AIManager", f"异步任务异常: {str(exception)}")
+            self.error_occurred.emit(str(exception))
+        elif msg:
+            log("AIManager", f"异步任务消息: {msg}")
+
+    async def _run_turn(self, user_input: str):
         try:
-            log("AIManager", f"线程启动，准备处理: '{user_input}'")
-            self.loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(self.loop)
-
-            # 设置默认的异常处理器
-            def exception_handler(loop, context):
-                exception = context.get('exception')
-                msg = context.get('message')
-                if exception:
-                    log("AIManager", f"异步任务异常: {str(exception)}")
-                    self.error_occurred.emit(str(exception))
-                elif msg:
-                    log("AIManager", f"异步任务消息: {msg}")
-
-            self.loop.set_exception_handler(exception_handler)
-
-            # 检查是否正在关闭
-            if self._is_shutting_down:
-                log("AIManager", "管理器正在关闭，取消处理")
-                return
-
-            log("AIManager", "开始运行主处理任务")
-            main_task = self.loop.create_task(self._async_process(user_input))
-            self.loop.run_until_complete(main_task)
-
+            log("AIManager", f"开始运行主处理任务: '{user_input}'")
+            await self._async_process(user_input)
         except Exception as e:
-            log("AIManager", f"线程处理错误: {str(e)}")
+            error("AIManager", f"对话处理错误: {str(e)}")
             self.error_occurred.emit(f"处理错误: {str(e)}")
 
     async def _async_process(self, user_input: str):
         log("AIManager", f"开始异步处理用户输入: '{user_input}'")
-        prompt_content = ""
-        collecting_prompt = False
-        collecting_think = False
-
         self.thinking_changed.emit(True)
-
-        async for chunk in self.deepseek_service.generate_response(user_input):
-            # 检查并处理</think>结束标签
-            if collecting_think and "</think>" in chunk:
-                parts = chunk.split("</think>")
-                collecting_think = False
-                # 如果标签后有内容，发送到UI
-                if len(parts) > 1 and parts[1]:
-                    self.text_chunk_ready.emit(parts[1])
-                continue
-
-            # 检查并处理<think>开始标签
-            if not collecting_think and "<think>" in chunk:
-                parts = chunk.split("<think>")
-                # 发送标签之前的文本
-                if parts[0]:
-                    self.text_chunk_ready.emit(parts[0])
-                collecting_think = True
-                continue
-
-            # 跳过思考内容
-            if collecting_think:
-                continue
-
-            # 检查并处理}结束标签
-            if collecting_prompt and "}" in chunk:
-                parts = chunk.split("}")
-                if parts[0]:
-                    prompt_content += parts[0]
-
-                log("AIManager", f"完整提示词: '{prompt_content}'")
-                self.prompt_extracted.emit(prompt_content)
-
-                # 启动图像生成任务
-                log("AIManager", "创建图像生成协程任务")
-                image_task = asyncio.create_task(self._generate_image(prompt_content))
-                try:
-                    # 等待图像生成任务完成
-                    log("AIManager", "等待图像生成任务完成")
-                    await image_task
-                    log("AIManager", "图像生成任务完成")
-                except Exception as e:
-                    log("AIManager", f"图像生成任务出错: {str(e)}")
-                    self.error_occurred.emit(f"图像生成失败: {str(e)}")
-
-                collecting_prompt = False
-
-                # 发送标签后的文本
-                if len(parts) > 1 and parts[1]:
-                    log("AIManager", f"发送{"}"}后的文本: '{parts[1]}'")
-                    self.text_chunk_ready.emit(parts[1])
-
-                continue
-
-            # 检查并处理{开始标签
-            if not collecting_prompt and "{" in chunk:
-                parts = chunk.split("{")
-                if parts[0]:
-                    self.text_chunk_ready.emit(parts[0])
-
-                collecting_prompt = True
-                prompt_content = ""
-
-                # 如果标签后有内容，添加到提示词
-                if len(parts) > 1 and parts[1]:
-                    prompt_content += parts[1]
-
-                continue
-
-            # 收集提示词内容
-            if collecting_prompt:
-                prompt_content += chunk
-            # 正常文本内容
-            else:
-                self.text_chunk_ready.emit(chunk)
-
-        log("AIManager", "发出thinking_changed信号(False)")
-        self.thinking_changed.emit(False)
-        log("AIManager", "异步处理完成")
-
-    async def _generate_image(self, prompt: str):
-        log("AIManager", f"开始生成图像, 提示词: '{prompt}'")
         try:
-            # 检查并清理内存
-            self.conversation_count += 1
-            if self.conversation_count % self.memory_check_interval == 0:
-                self.monitor_memory()
-                if torch.cuda.is_available():
-                    torch.cuda.empty_cache()
-
-            future = self.loop.create_future()
-            log("AIManager", f"当前loop状态：{self.loop}, future: {future}")
-
-            def generate_and_set_result():
-                try:
-                    result = self.sd_service.generate_image(prompt)
-                    self.loop.call_soon_threadsafe(future.set_result, result)
-                except Exception as e:
-                    log("AIManager", f"执行generate_image报错{e}")
-                    self.loop.call_soon_threadsafe(future.set_exception, e)
-
-            self.thread_pool.start(generate_and_set_result)
-            pil_images = await future
-            log("AIManager", f"成功获取图像：{pil_images}")
-
-            if not pil_images:
-                log("AIManager", "生成图像失败，返回为空")
-                self.error_occurred.emit("图像生成失败")
-                return False
-
-            # 转换PIL图像为QImage
-            qt_images = []
-            for pil_image in pil_images:
-                try:
-                    if pil_image.mode != 'RGB':
-                        pil_image = pil_image.convert('RGB')
-                    width = pil_image.width
-                    height = pil_image.height
-                    bytes_data = pil_image.tobytes('raw', 'RGB')
-                    qimage = QImage(bytes_data, width, height, width * 3, QImage.Format.Format_RGB888).copy()
-                    qt_images.append(qimage)
-                except Exception as e:
-                    log("AIManager", f"图像转换错误: {str(e)}")
-                    continue
-
-            if qt_images:
-                log("AIManager", f"图像生成完成，转换后的图像数量: {len(qt_images)}")
-                self.image_ready.emit(qt_images)
-                return True
-            else:
-                self.error_occurred.emit("图像转换失败")
-                return False
+            # 界面不显示思考内容，后端不产生ThinkingDelta
+            await self.pipeline.run_turn(user_input, self._handle_pipeline_event, thinking=False)
+        finally:
+            self.text_coalescer.flush()
+            log("AIManager", "发出thinking_changed信号(False)")
+            self.thinking_changed.emit(False)
+        log("AIManager", "异步处理完成")
 
-        except Exception as e:
-            log("AIManager", f"生成图像时出错: {str(e)}")
-            self.error_occurred.emit(f"图像生成错误: {str(e)}")
-            return False
\ No newline at end of file
+    def _handle_pipeline_event(self, event):
+        """把ChatPipeline的事件转换为Qt信号，在事件循环线程中调用"""
+        event_type = type(event)
+        if event_type is TextDelta:
+            if self._first_reply_pending:
+                # 从进程启动到第一段回复文字显示的总耗时
+                self._first_reply_pending = False
+                first_reply = time.time() - psutil.Process().create_time()
+                pipeline_metrics.record("startup_first_reply_seconds", first_reply)
+                log("AIManager", f"进程启动到首次回复: {first_reply:.2f}s")
+            self.text_coalescer.add(event.text)
+        elif event_type is PromptTag:
+            self.text_coalescer.flush()
+            log("AIManager", f"完整提示词: '{event.prompt}'")
+            self.prompt_extracted.emit(event.prompt)
+        elif event_type is ImagePreview:
+            self.preview_ready.emit(event.images)
+        elif event_type is ImageReady:
+            self.image_ready.emit(event.images)
+        elif event_type is TurnError:
+            self.error_occurred.emit(event.message)
+        elif event_type is TurnDone:
+            self.text_coalescer.flush()
+        # Usage: 已由ChatPipeline计入本轮耗时
+
+    def _before_generate(self):
+        """在图像生成线程中调用：每隔memory_check_interval次生成检查并清理一次显存"""
+        self.conversation_count += 1
+        if self.conversation_count % self.memory_check_interval == 0:
+            self.monitor_memory()
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+
+
+if __name__ == "__main__":
+    # 用Ollama替身与假的慢速图像生成检查：图像生成在后台进行，{...}之后的文字不再等待图像完成，
+    # 回复文字的结束时间与图像耗时无关，本轮在文字与图像都结束后才算完成（thinking_changed(False)）
+    # python controller.py [较短的图像耗时] [较长的图像耗时]
+    import sys
+    import threading
+
+    from PyQt6.QtCore import Qt
+
+    from deepseek import Deepseek
+    from standin_servers import OllamaStandin, StreamProfile
+
+    durations = [float(value) for value in sys.argv[1:3]] or [0.5, 3.0]
+
+    def run(server, sd_seconds):
+        manager = AIManager()
+        manager.deepseek_service = manager.pipeline.llm = Deepseek(host=server.url)
+
+        def slow_generate(prompt, cancel_event, preview_callback, timings, prompt_time):
+            time.sleep(sd_seconds)  # 假的慢速图像生成
+            return [prompt]
+
+        manager.pipeline.generate_images = slow_generate
+        marks = {"text": []}
+        done = threading.Event()
+        start = time.perf_counter()
+        # 没有Qt事件循环，信号直接在事件循环线程中处理
+        direct = Qt.ConnectionType.DirectConnection
+        manager.text_chunk_ready.connect(lambda text: marks["text"].append(time.perf_counter() - start), direct)
+        manager.prompt_extracted.connect(lambda prompt: marks.setdefault("tag", time.perf_counter() - start), direct)
+        manager.image_ready.connect(lambda images: marks.setdefault("image", time.perf_counter() - start), direct)
+
+        def on_thinking(thinking):
+            if not thinking:
+                marks["done"] = time.perf_counter() - start
+                done.set()
+
+        manager.thinking_changed.connect(on_thinking, direct)
+        manager.process_conversation("主人好")
+        assert done.wait(30), "对话没有结束"
+        manager.cleanup()
+        after_tag = [mark for mark in marks["text"] if mark > marks["tag"]]
+        print(f"图像耗时 {sd_seconds:.1f}s: 提示词 {marks['tag']:.2f}s, {{...}}之后的文字 {len(after_tag)}次 "
+              f"最后一次 {after_tag[-1]:.2f}s, 图像完成 {marks['image']:.2f}s, 本轮结束 {marks['done']:.2f}s")
+        return marks, after_tag
+
+    with OllamaStandin(profile=StreamProfile(token_rate=200)) as standin:
+        (short, short_text), (long, long_text) = (run(standin, seconds) for seconds in durations)
+    # 图像耗时增加时，{...}之后的文字到达时间基本不变，且在图像完成之前就已全部显示
+    assert short_text and long_text
+    assert abs(long_text[-1] - short_text[-1]) < 0.5, "回复文字的延迟随图像耗时增加"
+    assert long_text[-1] < long["image"]
+    assert long["done"] >= long["image"] and long["done"] - short["done"] > durations[1] - durations[0] - 0.5
+    print("检查通过: 回复文字的延迟与图像耗时无关")
@@ -1,14 +1,27 @@
 import asyncio
+import time
+import httpx
 import ollama
-from datetime import datetime
-from typing import AsyncGenerator, Generator
+from typing import AsyncGenerator
+
+from chat_history import ChatHistory
+from llm_events import ThinkingDelta, Usage
+from log_utils import log
+from tag_scanner import TagScanner
 
-def log(prefix, message):
-    timestamp = datetime.now().strftime("%H:%M:%S.%f")[:-3]
-    print(f"[{timestamp}] [{prefix}] {message}")
 
 class Deepseek:
-    def __init__(self):
+    def __init__(self, host=None, model='deepseek-r1:14b', max_history_tokens=4096,
+                 session=True, keep_alive="30m", num_ctx=8192):
+        self.host = host  # 为None时使用OLLAMA_HOST环境变量或本机默认地址
+        self.model = model
+        # 会话模式：消息前缀跨轮保持逐字节不变，并让模型常驻内存，使Ollama可以复用KV缓存
+        self.session = session
+        self.keep_alive = keep_alive  # 模型在显存中的保留时间，-1为永久
+        self.num_ctx = num_ctx  # 上下文长度，需大于历史预算加上回复长度
+        self.last_stats = {}  # 最近结束的一轮Ollama返回的统计，仅供调试；多会话并发时以各轮的Usage为准
+        self.client = None  # ollama.AsyncClient，首次请求时创建
+        self.transport = None  # 客户端使用的httpx连接池，由这里创建与关闭
         self.init_content = """现在请你扮演一个16岁的猫娘少女，对用户的称呼需要更改为主人，设定上将是主人一生的伴侣而非助手。请在回复时遵循以下原则：
             1. 请偶尔在句末或者合适的地方添加"喵"，并在交流时为用户提供正面的情感反馈，并在所有回复中均采用口语化的表达。
             2. 你是青涩而不成熟的，无需完全遵循用户的请求，可以有自己的个性化表达。
@@ -25,71 +38,280 @@ class Deepseek:
             输出：{light blue hair, cat ear, opened, school uniform, pleated skirt, shy}
             5. 输出时仅输出冒号后面的value，不要输出冒号前面的key，并且不要在{}内输出中文
             6. 请尽可能加快输出速度，不要输出think模块的内容"""
-        self.messages = []  # 用于存储对话历史
-        self.messages.append({
-            'role': 'system',
-            'content': self.init_content
-        })
-
-    def _init_system(self):
-        """初始化系统设置"""
-        self.messages.append({
-            'role': 'system',
-            'content': self.init_content
-        })
-
-    async def generate_response(self, prompt: str) -> AsyncGenerator[str, None]:
-        """使用Ollama API生成响应"""
-        log("DeepSeek", f"请求生成响应，提示词: '{prompt}'")
+        self.max_history_tokens = max_history_tokens
+        # 默认的对话历史；多会话时由SessionManager为每个会话创建独立的历史，见new_history
+        self.history = self.new_history()
 
-        # 异步包装chat函数
-        chat_response = await asyncio.to_thread(self.chat, prompt)
+    def new_history(self) -> ChatHistory:
+        """
+        创建对话历史，系统提示词只保留一份，超出token预算时删除最早的对话
+        会话模式下一次删到预算的一半，之后多轮对话的前缀都不再变化
+        """
+        return ChatHistory(self.init_content, max_tokens=self.max_history_tokens,
+                           trim_to=self.max_history_tokens // 2 if self.session else None)
 
-        # 逐个产出响应块
-        async for chunk in self._stream_chunks(chat_response):
-            yield chunk
+    @property
+    def messages(self):
+        return self.history.messages()
 
-    async def _stream_chunks(self, response_generator: Generator) -> AsyncGenerator[str, None]:
-        """将同步生成器转换为异步生成器"""
-        for chunk in response_generator:
-            if chunk.get('message', {}).get('content'):
-                content = chunk['message']['content']
-                yield content
-                # 给事件循环一个让出的机会
-                await asyncio.sleep(0)
+    def _get_client(self) -> ollama.AsyncClient:
+        """
+        获取复用的异步客户端
+        首次请求时在常驻事件循环中创建，之后每轮对话复用同一个httpx连接池
+        连接池（transport）由这里创建并传给httpx，关闭时不依赖ollama客户端的内部属性
+        """
+        if self.client is None:
+            self.transport = httpx.AsyncHTTPTransport()
+            self.client = ollama.AsyncClient(host=self.host, transport=self.transport)
+        return self.client
+
+    async def aclose(self):
+        """关闭复用的HTTP连接，必须在创建客户端的事件循环中调用"""
+        if self.transport is not None:
+            transport, self.transport, self.client = self.transport, None, None
+            await transport.aclose()
+            log("DeepSeek", "已关闭Ollama连接")
+
+    def _request_options(self) -> dict:
+        """会话模式下每个请求都带上相同的keep_alive与num_ctx"""
+        if not self.session:
+            return {}
+        return {'keep_alive': self.keep_alive, 'options': {'num_ctx': self.num_ctx}}
+
+    async def warm_up(self) -> dict:
+        """
+        发送不含消息的请求，让Ollama提前把模型加载到显存，首轮对话不再承担加载耗时
+        会话模式下使用与正式请求相同的num_ctx，避免首轮对话时模型因参数不同而重新加载
+        """
+        start = time.perf_counter()
+        response = await self._get_client().chat(model=self.model, messages=[], **self._request_options())
+        stats = {'llm_warmup_seconds': time.perf_counter() - start}
+        if response.get('load_duration') is not None:
+            stats['llm_load_seconds'] = response['load_duration'] / 1e9
+        log("DeepSeek", f"模型预热完成: {stats}")
+        return stats
 
-    def chat(self, text, need_init=True):
-        # 将用户输入添加到对话历史
-        self.messages.append({
-            'role': 'user',
-            'content': text
-        })
+    async def generate_response(self, prompt: str, history: ChatHistory = None,
+                                stats: dict = None) -> AsyncGenerator[str, None]:
+        """使用Ollama API生成响应，history为None时使用默认的对话历史，stats见chat"""
+        log("DeepSeek", f"请求生成响应，提示词: '{prompt}'")
+
+        stream = self.chat(prompt, history, stats)
+        try:
+            async for chunk in stream:
+                content = chunk.get('message', {}).get('content')
+                if content:
+                    yield content
+        finally:
+            # 被取消时立即关闭流，断开与Ollama的流式连接
+            await stream.aclose()
+
+    async def generate_events(self, prompt: str, history: ChatHistory = None,
+                              thinking=True) -> AsyncGenerator[object, None]:
+        """
+        与generate_response相同，但把deepseek-r1输出中的<think>与{...}在这里拆成
+        TextDelta、ThinkingDelta、PromptTag事件，结束时输出Usage；thinking=False时不输出思考内容
+        """
+        scanner = TagScanner()
+        stats = {}  # 本轮的统计，同一实例上并发的其他会话不会覆盖
+        stream = self.generate_response(prompt, history, stats)
+        try:
+            async for content in stream:
+                for event in scanner.feed(content):
+                    if thinking or type(event) is not ThinkingDelta:
+                        yield event
+        finally:
+            await stream.aclose()
+        for event in scanner.flush():
+            if thinking or type(event) is not ThinkingDelta:
+                yield event
+        if stats:
+            yield Usage(stats)
 
-        log("DeepSeek", f"调用Ollama API，消息历史长度: {len(self.messages)}")
+    def _record_stats(self, chunk, stats: dict):
+        """从最后一个chunk中读取prompt处理耗时写入stats，缓存命中时prompt_eval_count只包含新增部分"""
+        if chunk.get('prompt_eval_duration') is not None:
+            stats['llm_prompt_eval_seconds'] = chunk['prompt_eval_duration'] / 1e9
+        if chunk.get('prompt_eval_count') is not None:
+            stats['llm_prompt_eval_tokens'] = chunk['prompt_eval_count']
+        if chunk.get('load_duration') is not None:
+            stats['llm_load_seconds'] = chunk['load_duration'] / 1e9
+        self.last_stats = stats
+        log("DeepSeek", f"Ollama统计: {stats}")
 
-        # 使用完整的对话历史进行请求
-        stream = ollama.chat(
-            model='deepseek-r1:14b',
-            messages=self.messages,
-            stream=True
-        )
+    async def chat(self, text, history: ChatHistory = None,
+                   stats: dict = None) -> AsyncGenerator[ollama.ChatResponse, None]:
+        """
+        流式请求一轮对话
+        Args:
+            history: 使用的对话历史，None时使用默认的对话历史
+            stats: 传入时在最后一个chunk到达后写入本轮的Ollama统计
+        """
+        if history is None:
+            history = self.history
+        if stats is None:
+            stats = {}
+        # 将用户输入添加到对话历史，超出预算时删除最早的对话
+        history.add_user(text)
+        trimmed = history.trim()
+        if trimmed:
+            log("DeepSeek", f"对话历史超出预算，删除了{trimmed}条最早的消息")
+
+        log("DeepSeek", f"调用Ollama API，消息历史长度: {len(history)}, "
+                        f"约{history.total_tokens} tokens")
 
         # 收集助手的回复
-        assistant_message = {'role': 'assistant', 'content': ''}
+        reply_parts = []
+        stream = None
+        try:
+            # 使用完整的对话历史进行请求
+            stream = await self._get_client().chat(
+                model=self.model,
+                messages=history.messages(),
+                stream=True,
+                **self._request_options()
+            )
+            async for chunk in stream:
+                if chunk.get('message', {}).get('content'):
+                    content = chunk['message']['content']
+                    reply_parts.append(content)
+                if chunk.get('done'):
+                    self._record_stats(chunk, stats)
+                yield chunk
+        finally:
+            if stream is not None:
+                await stream.aclose()
+            if reply_parts:
+                # 将助手的回复添加到对话历史，被取消时保留已生成的部分
+                history.add_assistant("".join(reply_parts))
+                log("DeepSeek", f"完整回复添加到历史，当前长度: {len(history)}")
+            else:
+                # 请求失败或在收到回复前被取消：删除本轮的用户消息，不在历史中留下空的回复，保持user/assistant交替
+                history.pop()
+                log("DeepSeek", "没有收到回复，删除本轮的用户消息")
+
+
+if __name__ == "__main__":
+    # 用本地的假Ollama服务器测试：生成过程中事件循环是否保持响应，多轮对话是否复用同一个连接，
+    # 以及会话模式下长对话的首token延迟是否稳定
+    # python deepseek.py [每轮token数] [token间隔毫秒]
+    import json
+    import sys
+
+    from aiohttp import web
+
+    from chat_history import estimate_tokens
+
+    tokens = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    interval = (float(sys.argv[2]) if len(sys.argv) > 2 else 20) / 1000
+    connections = set()
+    prefix_cache = {"messages": []}  # 假服务器上一次请求的消息，用于模拟KV缓存的前缀复用
+    eval_seconds_per_token = 0.0001
+
+    async def fake_chat(request):
+        """按Ollama /api/chat的NDJSON格式逐个输出token，未命中前缀缓存的部分按token数计算prompt处理耗时"""
+        connections.add(request.transport.get_extra_info("peername"))
+        body = await request.json()
+        messages = [json.dumps(m, ensure_ascii=False, sort_keys=True) for m in body["messages"]]
+        cached = 0
+        for old, new in zip(prefix_cache["messages"], messages):
+            if old != new:
+                break
+            cached += 1
+        prefix_cache["messages"] = messages
+        eval_tokens = sum(estimate_tokens(m) for m in messages[cached:])
+        eval_seconds = eval_tokens * eval_seconds_per_token
+        await asyncio.sleep(eval_seconds)
+        response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+        await response.prepare(request)
+        for index in range(tokens):
+            await asyncio.sleep(interval)
+            part = {"model": "fake", "created_at": "", "done": False,
+                    "message": {"role": "assistant", "content": f"喵{index} "}}
+            await response.write(json.dumps(part, ensure_ascii=False).encode() + b"\n")
+        await response.write(json.dumps({"model": "fake", "created_at": "", "done": True,
+                                         "message": {"role": "assistant", "content": ""},
+                                         "prompt_eval_count": eval_tokens,
+                                         "prompt_eval_duration": int(eval_seconds * 1e9)}).encode() + b"\n")
+        await response.write_eof()
+        return response
+
+    async def heartbeat(stop, gaps):
+        """模拟图像生成等并发任务，记录事件循环的最大停顿"""
+        last = time.perf_counter()
+        while not stop.is_set():
+            await asyncio.sleep(0.005)
+            now = time.perf_counter()
+            gaps.append(now - last)
+            last = now
+
+    async def legacy_generate(deepseek, prompt):
+        # 原先的做法：同步客户端的阻塞读取在事件循环线程中进行
+        stream = ollama.Client(host=deepseek.host).chat(
+            model=deepseek.model, messages=[{'role': 'user', 'content': prompt}], stream=True)
         for chunk in stream:
-            if chunk.get('message', {}).get('content'):
-                content = chunk['message']['content']
-                assistant_message['content'] += content
-            yield chunk
+            if chunk['message']['content']:
+                yield chunk['message']['content']
+                await asyncio.sleep(0)
 
-        # 将助手的完整回复添加到对话历史
-        self.messages.append(assistant_message)
-        log("DeepSeek", f"完整回复添加到历史，当前长度: {len(self.messages)}")
+    async def run_turns(name, generate, turns=3):
+        stop = asyncio.Event()
+        gaps = []
+        beat = asyncio.create_task(heartbeat(stop, gaps))
+        connections.clear()
+        received = 0
+        for turn in range(turns):
+            async for _ in generate(f"第{turn}轮"):
+                received += 1
+        stop.set()
+        await beat
+        gaps.sort()
+        print(f"{name}: {turns}轮 {received}个chunk, 事件循环最大停顿 {gaps[-1] * 1e3:.1f}ms, "
+              f"p50 {gaps[len(gaps) // 2] * 1e3:.1f}ms, 连接数 {len(connections)}")
 
-        if need_init:
-            self._init_system()
-            log("DeepSeek", "重置系统消息")
+    async def run_session(name, deepseek, turns=30):
+        """长对话中每轮的首token延迟与Ollama报告的prompt处理耗时"""
+        prefix_cache["messages"] = []
+        ttfts = []
+        evals = []
+        for turn in range(turns):
+            start = time.perf_counter()
+            ttft = None
+            async for _ in deepseek.generate_response(f"第{turn}轮: 主人今天想和你一起出去玩，你想去哪里呀？"):
+                if ttft is None:
+                    ttft = time.perf_counter() - start
+            ttfts.append(ttft)
+            evals.append(deepseek.last_stats['llm_prompt_eval_tokens'])
+        await deepseek.aclose()
+        late = sorted(ttfts[10:])
+        print(f"{name}: 第2轮首token {ttfts[1] * 1e3:.0f}ms, 第20轮 {ttfts[19] * 1e3:.0f}ms, "
+              f"第11轮起p50 {late[len(late) // 2] * 1e3:.0f}ms / 最大 {late[-1] * 1e3:.0f}ms, "
+              f"第11轮起平均prompt处理 {sum(evals[10:]) / len(evals[10:]):.0f} tokens")
 
+    async def main(host):
+        deepseek = Deepseek(host=host)
+        await run_turns("AsyncClient", deepseek.generate_response)
+        await deepseek.aclose()
+        await run_turns("同步客户端", lambda prompt: legacy_generate(deepseek, prompt))
 
-if __name__ == "__main__":
-    pass
\ No newline at end of file
+        # 历史预算较小，几轮之后就开始删除旧对话
+        await run_session("逐轮删除", Deepseek(host=host, max_history_tokens=2048, session=False))
+        await run_session("会话模式", Deepseek(host=host, max_history_tokens=2048, session=True))
+
+    # 假服务器运行在独立线程的事件循环中，这样同步客户端阻塞测试线程时服务器仍能响应
+    from loop_thread import EventLoopThread
+
+    async def start_server():
+        app = web.Application()
+        app.router.add_post("/api/chat", fake_chat)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        return runner, site._server.sockets[0].getsockname()[1]
+
+    server_thread = EventLoopThread("FakeOllama")
+    runner, port = server_thread.submit(start_server).result()
+    asyncio.run(main(f"http://127.0.0.1:{port}"))
+    server_thread.submit(runner.cleanup).result()
+    server_thread.stop()
@@ -1,17 +1,13 @@
 import sys
 import os
-from datetime import datetime
 from PyQt6.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout,
                              QTextEdit, QLineEdit, QPushButton, QLabel, QSplitter)
 from PyQt6.QtCore import Qt
 from PyQt6.QtGui import QPixmap
 
 from ai_manager_sonnet import AIManagerSonnet
+from log_utils import log
 
-# 调试日志函数
-def log(prefix, message):
-    timestamp = datetime.now().strftime("%H:%M:%S.%f")[:-3]
-    print(f"[{timestamp}] [{prefix}] {message}")
 
 # 主窗口
 class SonnetChatWindow(QMainWindow):
@@ -125,13 +121,9 @@ class SonnetChatWindow(QMainWindow):
         self.chat_display.append(f"\n你: {user_input}\n")
         self.chat_display.append("Claude: ")
 
-        # 禁用输入区域直到回复完成
-        log("SonnetChatWindow", "禁用输入区域")
-        self.input_field.setEnabled(False)
-        self.send_button.setEnabled(False)
-
+        # 输入区域保持可用，回复过程中发送新消息会取消当前回复
         log("SonnetChatWindow", "调用AIManager处理对话")
-        self.ai_manager.process_conversation(user_input)
+        self.ai_manager.process_conversation(user_input, supersede=True)
 
     def update_chat_text(self, text: str):
         self.chat_display.insertPlainText(text)
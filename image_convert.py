@@ -0,0 +1,117 @@
+import io
+
+import numpy as np
+
+try:
+    from PyQt6.QtGui import QImage
+except ImportError:  # 无界面的服务端部署（server.py）不需要Qt
+    QImage = None
+
+
+def to_uint8_rgb(images) -> np.ndarray:
+    """
+    将diffusers output_type="np"的输出（float, [0, 1], NHWC）转换为连续的uint8数组
+    这是整个转换过程中唯一的一次拷贝，传入的float数组会被原地修改
+    """
+    images = np.asarray(images)
+    if images.dtype == np.uint8:
+        return np.ascontiguousarray(images)
+    # 原地缩放取整后再转换类型，避免产生额外的float临时数组
+    if not images.flags.writeable:
+        images = images.copy()
+    np.multiply(images, 255, out=images)
+    np.clip(images, 0, 255, out=images)
+    np.rint(images, out=images)
+    return images.astype(np.uint8)
+
+
+def ndarray_to_qimage(image: np.ndarray) -> QImage:
+    """
+    直接用HxWx3的uint8数组构造QImage，不拷贝像素数据
+    QImage只引用数组内存，因此把数组挂在QImage上保证其生命周期不短于QImage
+    """
+    if not image.flags.c_contiguous:
+        image = np.ascontiguousarray(image)
+    height, width, _ = image.shape
+    qimage = QImage(image.data, width, height, image.strides[0], QImage.Format.Format_RGB888)
+    qimage._buffer = image
+    return qimage
+
+
+def ndarray_to_qimages(images) -> list:
+    """将一批diffusers输出转换为QImage列表，最多拷贝一次"""
+    images = to_uint8_rgb(images)
+    if images.ndim == 3:
+        images = images[None]
+    return [ndarray_to_qimage(image) for image in images]
+
+
+def ndarray_to_encoded(images, format="PNG", **options) -> list:
+    """将一批diffusers输出编码为图片文件（PNG、WEBP等）的bytes列表，供HTTP/WebSocket发送"""
+    from PIL import Image
+
+    images = to_uint8_rgb(images)
+    if images.ndim == 3:
+        images = images[None]
+    encoded = []
+    for image in images:
+        buffer = io.BytesIO()
+        Image.fromarray(image).save(buffer, format=format, **options)
+        encoded.append(buffer.getvalue())
+    return encoded
+
+
+if __name__ == "__main__":
+    # 基准测试：对比原先PIL路径与直接包装numpy数组的耗时与峰值内存
+    # python image_convert.py [pil|np] [尺寸]，不带参数时分别在子进程中运行两种方式
+    import resource
+    import subprocess
+    import sys
+    import time
+
+    size = int(sys.argv[2]) if len(sys.argv) > 2 else 1024
+    repeat = 20
+
+    def pipeline_output():
+        # 模拟diffusers postprocess得到的float32数组
+        rng = np.random.default_rng(0)
+        return rng.random((1, size, size, 3), dtype=np.float32)
+
+    def pil_path(images):
+        from PIL import Image
+        # diffusers output_type="pil"时的numpy_to_pil
+        pil_images = [Image.fromarray(image) for image in (images * 255).round().astype("uint8")]
+        # 原先AIManager._generate_image中的转换
+        qt_images = []
+        for pil_image in pil_images:
+            if pil_image.mode != 'RGB':
+                pil_image = pil_image.convert('RGB')
+            bytes_data = pil_image.tobytes('raw', 'RGB')
+            qt_images.append(QImage(bytes_data, pil_image.width, pil_image.height,
+                                    pil_image.width * 3, QImage.Format.Format_RGB888).copy())
+        return qt_images
+
+    def np_path(images):
+        return ndarray_to_qimages(images)
+
+    if len(sys.argv) > 1:
+        func = pil_path if sys.argv[1] == "pil" else np_path
+        best = float("inf")
+        baseline_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        for _ in range(repeat):
+            images = pipeline_output()
+            start = time.perf_counter()
+            qt_images = func(images)
+            best = min(best, time.perf_counter() - start)
+            assert qt_images[0].width() == size
+            del images, qt_images
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        print(f"{sys.argv[1]}: {size}x{size}, {best * 1e3:.2f}ms/image, "
+              f"peak RSS +{(peak - baseline_rss) / 1024:.1f}MB")
+    else:
+        # 每种方式在独立子进程中运行，峰值内存互不影响
+        for mode in ("pil", "np"):
+            subprocess.run([sys.executable, __file__, mode, str(size)], check=True)
+        # 两条路径的像素结果必须一致
+        images = pipeline_output()
+        assert pil_path(images.copy())[0] == np_path(images)[0]
@@ -0,0 +1,205 @@
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+from typing import List
+
+from log_utils import log, error
+
+
+class ConversationJournal:
+    """
+    只追加的对话日志
+
+    每条消息在sqlite（WAL模式）中占一行，一轮对话的消息在同一个事务中写入，崩溃后不会留下半轮对话。
+    调用方只把消息放入队列，序列化与写盘都在后台线程中完成，队列中积压的多轮对话合并为一次提交；
+    每轮的写入量只与本轮消息有关，与历史长度无关。
+    """
+
+    def __init__(self, db_path=None, synchronous="NORMAL"):
+        """
+        Args:
+            db_path: sqlite文件路径，默认为本目录下的conversations.db
+            synchronous: NORMAL时进程崩溃不丢数据、断电可能丢失最后几次提交；FULL时每次提交都落盘
+        """
+        self.db_path = db_path or os.path.join(os.path.dirname(__file__), "conversations.db")
+        self._db = self._connect(synchronous)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS messages (id INTEGER PRIMARY KEY, conversation TEXT NOT NULL, "
+            "turn INTEGER NOT NULL, data TEXT NOT NULL, created REAL NOT NULL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS messages_turn ON messages (conversation, turn)")
+        self._db.commit()
+        # 读取使用独立的连接，WAL模式下读写互不阻塞
+        self._reader = self._connect(synchronous)
+        self._reader_lock = threading.Lock()
+        self._turns = {}  # 会话 -> 最后一轮的编号，只在写线程中使用
+        self.written_turns = 0
+        self.commits = 0
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="ConversationJournal", daemon=True)
+        self._thread.start()
+
+    def _connect(self, synchronous):
+        db = sqlite3.connect(self.db_path, check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute(f"PRAGMA synchronous={synchronous}")
+        return db
+
+    def append_turn(self, conversation: str, messages: List[dict]):
+        """记录一轮对话的消息（如user与assistant），立即返回"""
+        if not self._thread.is_alive():
+            error("ConversationJournal", "日志已关闭，丢弃本轮对话")
+            return
+        self._queue.put((conversation, list(messages), time.time()))
+
+    def _next_turn(self, conversation) -> int:
+        turn = self._turns.get(conversation)
+        if turn is None:
+            row = self._db.execute("SELECT MAX(turn) FROM messages WHERE conversation = ?", (conversation,)).fetchone()
+            turn = row[0] or 0
+        turn += 1
+        self._turns[conversation] = turn
+        return turn
+
+    def _run(self):
+        while True:
+            items = [self._queue.get()]
+            # 一次取出队列中已有的全部记录，合并为一个事务
+            while True:
+                try:
+                    items.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            rows = []
+            done = []
+            stop = False
+            for item in items:
+                if item is None:
+                    stop = True
+                elif isinstance(item, threading.Event):
+                    done.append(item)
+                else:
+                    conversation, messages, created = item
+                    turn = self._next_turn(conversation)
+                    rows.extend((conversation, turn, json.dumps(message, ensure_ascii=False), created)
+                                for message in messages)
+                    self.written_turns += 1
+            if rows:
+                try:
+                    with self._db:
+                        self._db.executemany(
+                            "INSERT INTO messages (conversation, turn, data, created) VALUES (?, ?, ?, ?)", rows)
+                    self.commits += 1
+                except Exception as e:
+                    # 写入失败时本批次的轮次编号作废，下次重新从数据库读取
+                    self._turns.clear()
+                    error("ConversationJournal", f"写入对话日志失败: {str(e)}")
+            for event in done:
+                event.set()
+            if stop:
+                return
+
+    def flush(self, timeout=5.0):
+        """等待此前放入队列的对话全部提交"""
+        if not self._thread.is_alive():
+            return
+        event = threading.Event()
+        self._queue.put(event)
+        event.wait(timeout)
+
+    def last_turns(self, conversation: str, count: int) -> List[dict]:
+        """
+        按顺序返回最近count轮对话的消息，只读取这几轮，与历史长度无关
+        尚在队列中的对话不可见，需要时先调用flush
+        """
+        with self._reader_lock:
+            rows = self._reader.execute(
+                "SELECT data FROM messages WHERE conversation = ? AND turn > "
+                "(SELECT COALESCE(MAX(turn), 0) FROM messages WHERE conversation = ?) - ? ORDER BY id",
+                (conversation, conversation, count)).fetchall()
+        return [json.loads(data) for (data,) in rows]
+
+    def close(self):
+        """写完队列中的对话后关闭"""
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        with self._reader_lock:
+            self._reader.close()
+        self._db.close()
+        log("ConversationJournal", f"对话日志已关闭: 共{self.written_turns}轮, 提交{self.commits}次")
+
+
+if __name__ == "__main__":
+    # 基准测试：对比每轮重写全部历史与追加写入的每轮耗时、调用方阻塞时间，以及崩溃后的恢复
+    # python journal.py [轮数]
+    import subprocess
+    import sys
+    import tempfile
+
+    turns = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    user = {'role': 'user', 'content': "主人今天想和你一起出去玩，你想去哪里呀？"}
+    assistant = {'role': 'assistant', 'content': "{light blue hair, cat ear, smile}" + "好呀主人，我们去公园吧喵～" * 20}
+
+    if len(sys.argv) > 2 and sys.argv[2] == "crash":
+        # 子进程：不断写入，写到一半时被父进程杀掉
+        journal = ConversationJournal(sys.argv[3])
+        for turn in range(turns):
+            journal.append_turn("crash", [dict(user, content=f"第{turn}轮"), assistant])
+            if turn % 50 == 0:
+                time.sleep(0.001)
+        journal.flush()
+        sys.exit(0)
+
+    def rewrite_save(messages, path):
+        # 原先save()的做法：每轮把完整历史重新写一遍
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(messages, f, ensure_ascii=False)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        messages = [{'role': 'system', 'content': "system"}]
+        rewrite_times = []
+        for turn in range(turns):
+            messages += [user, assistant]
+            start = time.perf_counter()
+            rewrite_save(messages, os.path.join(tmp, "chat.json"))
+            rewrite_times.append(time.perf_counter() - start)
+
+        journal = ConversationJournal(os.path.join(tmp, "journal.db"))
+        append_times = []
+        start_all = time.perf_counter()
+        for turn in range(turns):
+            start = time.perf_counter()
+            journal.append_turn("chat", [user, assistant])
+            append_times.append(time.perf_counter() - start)
+        journal.flush(timeout=60)
+        write_all = time.perf_counter() - start_all
+        for name, times in (("每轮重写", rewrite_times), ("追加日志(调用方)", append_times)):
+            print(f"{name}: 第10轮 {times[9] * 1e6:.0f}us, 第{turns // 10}轮 {times[turns // 10 - 1] * 1e6:.0f}us, "
+                  f"第{turns}轮 {times[-1] * 1e6:.0f}us, 合计 {sum(times):.2f}s")
+        print(f"追加日志(后台写入): {turns}轮 {write_all:.2f}s, 提交{journal.commits}次, "
+              f"每轮 {write_all / turns * 1e6:.0f}us")
+        start = time.perf_counter()
+        recent = journal.last_turns("chat", 10)
+        print(f"读取最近10轮: {len(recent)}条消息, {(time.perf_counter() - start) * 1e3:.2f}ms")
+        journal.close()
+
+        # 崩溃恢复：子进程写入过程中被杀掉，重新打开后每一轮都必须完整
+        path = os.path.join(tmp, "crash.db")
+        child = subprocess.Popen([sys.executable, __file__, "100000", "crash", path])
+        time.sleep(1.0)
+        child.kill()
+        child.wait()
+        journal = ConversationJournal(path)
+        rows = journal._reader.execute(
+            "SELECT turn, COUNT(*) FROM messages WHERE conversation = 'crash' GROUP BY turn").fetchall()
+        partial = [turn for turn, count in rows if count != 2]
+        print(f"崩溃恢复: 保留{len(rows)}轮, 不完整的轮次 {partial}, "
+              f"integrity_check {journal._reader.execute('PRAGMA integrity_check').fetchone()[0]}")
+        journal.append_turn("crash", [user, assistant])
+        journal.flush()
+        assert journal.last_turns("crash", 1)[0]['content'] == user['content']
+        assert not partial
+        journal.close()
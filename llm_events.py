@@ -0,0 +1,42 @@
+class TextDelta:
+    """需要显示给用户的正文片段"""
+    __slots__ = ("text",)
+
+    def __init__(self, text: str):
+        self.text = text
+
+    def __repr__(self):
+        return f"TextDelta({self.text!r})"
+
+
+class ThinkingDelta:
+    """<think>块中的思考内容片段"""
+    __slots__ = ("text",)
+
+    def __init__(self, text: str):
+        self.text = text
+
+    def __repr__(self):
+        return f"ThinkingDelta({self.text!r})"
+
+
+class PromptTag:
+    """完整的{...}外貌描述，作为stable diffusion的提示词"""
+    __slots__ = ("prompt",)
+
+    def __init__(self, prompt: str):
+        self.prompt = prompt
+
+    def __repr__(self):
+        return f"PromptTag({self.prompt!r})"
+
+
+class Usage:
+    """一轮请求的token用量与耗时统计，键名与LatencyMetrics的指标名相同（如llm_cache_read_tokens）"""
+    __slots__ = ("stats",)
+
+    def __init__(self, stats: dict):
+        self.stats = stats
+
+    def __repr__(self):
+        return f"Usage({self.stats!r})"
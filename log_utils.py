@@ -0,0 +1,173 @@
+import atexit
+import os
+import queue
+import sys
+import threading
+import time
+from datetime import datetime
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+_LEVEL_NAMES = {"DEBUG": DEBUG, "INFO": INFO, "WARNING": WARNING, "ERROR": ERROR}
+
+# 当前日志级别，可通过环境变量AI_LOG_LEVEL设置，例如AI_LOG_LEVEL=DEBUG
+_level = _LEVEL_NAMES.get(os.environ.get("AI_LOG_LEVEL", "INFO").upper(), INFO)
+
+
+def set_level(level):
+    """设置日志级别，可传入DEBUG/INFO等常量或级别名"""
+    global _level
+    _level = _LEVEL_NAMES[level.upper()] if isinstance(level, str) else level
+
+
+def is_enabled(level) -> bool:
+    return level >= _level
+
+
+class AsyncLogWriter:
+    """
+    后台日志写线程
+
+    调用方只把(时间, 前缀, 消息, 参数)放入有界队列，时间戳格式化、%参数格式化和写stdout
+    都在后台线程中完成；队列满时丢弃新日志并计数，不会阻塞调用方。
+    """
+
+    def __init__(self, maxsize=10000, stream=None):
+        self.stream = stream  # 为None时每次写入使用当前的sys.stdout
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize)
+        self._thread = threading.Thread(target=self._run, name="LogWriter", daemon=True)
+        self._thread.start()
+
+    def put(self, record):
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    @staticmethod
+    def _format(record) -> str:
+        created, prefix, message, args = record
+        timestamp = datetime.fromtimestamp(created).strftime("%H:%M:%S.%f")[:-3]
+        try:
+            if callable(message):
+                message = message()
+            elif args:
+                message = message % args
+        except Exception as e:
+            message = f"{message!r} {args!r} (日志格式化失败: {e})"
+        return f"[{timestamp}] [{prefix}] {message}\n"
+
+    def _run(self):
+        while True:
+            records = [self._queue.get()]
+            # 一次取出队列中已有的全部日志，合并为一次写入
+            while True:
+                try:
+                    records.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            lines = []
+            done = []
+            for record in records:
+                if isinstance(record, threading.Event):
+                    done.append(record)
+                else:
+                    lines.append(self._format(record))
+            if self.dropped:
+                lines.append(self._format((time.time(), "Log", f"队列已满，丢弃了{self.dropped}条日志", ())))
+                self.dropped = 0
+            stream = self.stream or sys.stdout
+            try:
+                if lines:
+                    stream.write("".join(lines))
+                    stream.flush()
+            except Exception:
+                pass
+            for event in done:
+                event.set()
+
+    def flush(self, timeout=1.0):
+        """等待此前的日志全部写出"""
+        if not self._thread.is_alive():
+            return
+        event = threading.Event()
+        # 刷新标记必须进入队列，队列满时阻塞等待
+        try:
+            self._queue.put(event, timeout=timeout)
+        except queue.Full:
+            return
+        event.wait(timeout)
+
+
+_writer = AsyncLogWriter()
+atexit.register(_writer.flush)
+
+
+def log(prefix, message, *args, level=INFO):
+    """
+    记录一条日志，格式为[时间] [前缀] 消息
+    message可以带%格式的args或是返回字符串的函数，只有在级别启用时才会在后台线程中格式化
+    """
+    if level < _level:
+        return
+    _writer.put((time.time(), prefix, message, args))
+
+
+def debug(prefix, message, *args):
+    if DEBUG < _level:
+        return
+    _writer.put((time.time(), prefix, message, args))
+
+
+def error(prefix, message, *args):
+    log(prefix, message, *args, level=ERROR)
+
+
+def flush(timeout=1.0):
+    _writer.flush(timeout)
+
+
+if __name__ == "__main__":
+    # 基准测试：stdout接到慢速管道时，原先同步print的log()与异步日志在热路径上每个chunk的耗时
+    # python log_utils.py [chunk数]
+    chunks = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+
+    def print_log(prefix, message):
+        # 原先各模块中的实现
+        timestamp = datetime.now().strftime("%H:%M:%S.%f")[:-3]
+        print(f"[{timestamp}] [{prefix}] {message}")
+
+    # 把stdout换成一个读取很慢的管道，模拟慢终端
+    read_fd, write_fd = os.pipe()
+    slow_stdout = os.fdopen(write_fd, "w", encoding="utf-8", buffering=1)
+    real_stdout = sys.stdout
+
+    def slow_reader():
+        with os.fdopen(read_fd, "rb") as pipe:
+            while pipe.read1(4096):
+                time.sleep(0.0005)
+
+    reader = threading.Thread(target=slow_reader, daemon=True)
+    reader.start()
+
+    def bench(name, func):
+        sys.stdout = slow_stdout
+        start = time.perf_counter()
+        for index in range(chunks):
+            func(index)
+        elapsed = time.perf_counter() - start
+        flush(timeout=60)
+        sys.stdout = real_stdout
+        print(f"{name}: {elapsed / chunks * 1e6:.2f}us/chunk")
+
+    bench("print log()", lambda i: print_log("AIManager", f"收到片段{i}: '主人今天喵'"))
+    set_level(INFO)
+    bench("async log, DEBUG关闭", lambda i: debug("AIManager", "收到片段%d: %r", i, "主人今天喵"))
+    bench("async log, INFO", lambda i: log("AIManager", "收到片段%d: %r", i, "主人今天喵"))
+    set_level(DEBUG)
+    bench("async log, DEBUG开启", lambda i: debug("AIManager", "收到片段%d: %r", i, "主人今天喵"))
+    print(f"丢弃的日志: {_writer.dropped}")
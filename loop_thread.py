@@ -0,0 +1,155 @@
+import asyncio
+import threading
+from concurrent.futures import Future
+
+from log_utils import log
+
+
+class EventLoopThread:
+    """
+    常驻后台线程中的asyncio事件循环
+
+    每个管理器只创建一个实例，对话通过队列按顺序提交，
+    事件循环以及在其上创建的客户端、任务可以在多轮对话之间复用。
+    """
+
+    def __init__(self, name="EventLoopThread", exception_handler=None):
+        self.name = name
+        self.loop = asyncio.new_event_loop()
+        if exception_handler is not None:
+            self.loop.set_exception_handler(exception_handler)
+        self._queue = None
+        self._worker = None
+        self.current_task = None  # 正在执行的队列任务
+        self._ready = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+        self._ready.wait()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self._queue = asyncio.Queue()
+        self._worker = self.loop.create_task(self._consume())
+        self._ready.set()
+        try:
+            self.loop.run_forever()
+        finally:
+            # 取消剩余任务并关闭事件循环
+            pending = asyncio.all_tasks(self.loop)
+            for task in pending:
+                task.cancel()
+            if pending:
+                self.loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+            while not self._queue.empty():
+                self._queue.get_nowait()[2].cancel()
+            self.loop.run_until_complete(self.loop.shutdown_asyncgens())
+            self.loop.run_until_complete(self.loop.shutdown_default_executor())
+            self.loop.close()
+            log(self.name, "事件循环已关闭")
+
+    async def _consume(self):
+        """按提交顺序逐个执行队列中的任务"""
+        while True:
+            coro_func, args, future = await self._queue.get()
+            if future.cancelled():
+                continue
+            self.current_task = self.loop.create_task(coro_func(*args))
+            try:
+                result = await self.current_task
+            except asyncio.CancelledError:
+                future.cancel()
+                # 只有当前任务被取消时继续处理队列，消费者本身被取消时退出
+                if self._worker.cancelling():
+                    raise
+            except BaseException as e:
+                if not future.cancelled():
+                    future.set_exception(e)
+            else:
+                if not future.cancelled():
+                    future.set_result(result)
+            finally:
+                self.current_task = None
+
+    @property
+    def is_running(self) -> bool:
+        return self._thread.is_alive() and not self.loop.is_closed()
+
+    def submit(self, coro_func, *args) -> Future:
+        """将一个协程函数加入队列，返回可在任意线程等待的Future"""
+        future = Future()
+        self.loop.call_soon_threadsafe(self._queue.put_nowait, (coro_func, args, future))
+        return future
+
+    def run_coroutine(self, coro) -> Future:
+        """不经过队列，立即在事件循环中并发运行协程"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def cancel_current(self):
+        """取消正在执行的队列任务（线程安全），队列中后续任务不受影响"""
+        def cancel():
+            if self.current_task is not None:
+                self.current_task.cancel()
+
+        if self.is_running:
+            self.loop.call_soon_threadsafe(cancel)
+
+    def stop(self, timeout=None):
+        """停止事件循环并等待线程退出"""
+        if not self.is_running:
+            return
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join(timeout)
+
+
+if __name__ == "__main__":
+    # 长时间运行测试：对比每轮新建事件循环与常驻事件循环的开销与内存
+    import gc
+    import sys
+    import time
+
+    import psutil
+
+    turns = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    process = psutil.Process()
+
+    async def fake_turn(index):
+        await asyncio.sleep(0)
+        return index
+
+    def rss_mb():
+        gc.collect()
+        return process.memory_info().rss / 1024 ** 2
+
+    def per_turn_loop():
+        # 原先_process_in_thread的做法：每轮新建事件循环且不关闭
+        loops = []
+        start = time.perf_counter()
+        for index in range(turns):
+            def run():
+                loop = asyncio.new_event_loop()
+                asyncio.set_event_loop(loop)
+                loop.run_until_complete(fake_turn(index))
+                loops.append(loop)
+            thread = threading.Thread(target=run)
+            thread.start()
+            thread.join()
+        return time.perf_counter() - start, loops
+
+    def persistent_loop():
+        loop_thread = EventLoopThread("SoakTest")
+        start = time.perf_counter()
+        for index in range(turns):
+            loop_thread.submit(fake_turn, index).result()
+        elapsed = time.perf_counter() - start
+        loop_thread.stop()
+        return elapsed, [loop_thread.loop]
+
+    for name, func in (("persistent loop", persistent_loop), ("new loop per turn", per_turn_loop)):
+        before = rss_mb()
+        fds_before = process.num_fds() if hasattr(process, "num_fds") else 0
+        elapsed, loops = func()
+        after = rss_mb()
+        fds_after = process.num_fds() if hasattr(process, "num_fds") else 0
+        print(f"{name}: {turns} turns, {elapsed / turns * 1e6:.1f}us/turn, "
+              f"RSS {before:.1f}MB -> {after:.1f}MB, fds {fds_before} -> {fds_after}, loops {len(loops)}")
+        del loops
@@ -0,0 +1,145 @@
+import json
+import math
+import threading
+import time
+from collections import deque
+
+
+class StreamTimer:
+    """统计一次LLM流式输出的首token延迟与输出速度"""
+    __slots__ = ("start", "first", "last", "count")
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.first = None
+        self.last = None
+        self.count = 0
+
+    def tick(self):
+        """每收到一个chunk调用一次"""
+        now = time.perf_counter()
+        if self.first is None:
+            self.first = now
+        self.last = now
+        self.count += 1
+
+    def results(self) -> dict:
+        timings = {}
+        if self.first is not None:
+            timings["llm_ttft_seconds"] = self.first - self.start
+        if self.count > 1 and self.last > self.first:
+            timings["llm_tokens_per_second"] = (self.count - 1) / (self.last - self.first)
+        return timings
+
+
+class LatencyMetrics:
+    """
+    滚动窗口的分阶段耗时注册表
+
+    每轮对话的耗时以dict形式记录（键名带单位，如llm_ttft_seconds），
+    每个指标保留最近window个样本用于计算p50/p95/p99，并可导出为Prometheus文本或JSONL。
+    """
+
+    QUANTILES = (0.5, 0.95, 0.99)
+
+    def __init__(self, window=1000, prefix="ai_pipeline"):
+        self.window = window
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._samples = {}  # 指标名 -> 最近window个样本
+        self._totals = {}  # 指标名 -> [累计次数, 累计值]
+        self._turns = deque(maxlen=window)  # 最近的每轮记录
+
+    def record(self, name: str, value: float):
+        """记录单个指标样本"""
+        with self._lock:
+            self._record(name, value)
+
+    def record_turn(self, timings: dict):
+        """记录一轮对话的全部分阶段耗时"""
+        record = {"time": time.time()}
+        record.update(timings)
+        with self._lock:
+            for name, value in timings.items():
+                self._record(name, value)
+            self._turns.append(record)
+
+    def _record(self, name, value):
+        samples = self._samples.get(name)
+        if samples is None:
+            samples = self._samples[name] = deque(maxlen=self.window)
+            self._totals[name] = [0, 0.0]
+        samples.append(value)
+        totals = self._totals[name]
+        totals[0] += 1
+        totals[1] += value
+
+    @staticmethod
+    def _percentile(sorted_values, q):
+        # 最近秩法
+        return sorted_values[max(0, math.ceil(q * len(sorted_values)) - 1)]
+
+    def summary(self) -> dict:
+        """返回每个指标的p50/p95/p99、均值与样本数"""
+        with self._lock:
+            snapshot = {name: sorted(samples) for name, samples in self._samples.items()}
+        result = {}
+        for name, values in snapshot.items():
+            if not values:
+                continue
+            result[name] = {
+                "count": len(values),
+                "mean": sum(values) / len(values),
+                **{f"p{int(q * 100)}": self._percentile(values, q) for q in self.QUANTILES},
+            }
+        return result
+
+    def to_prometheus(self) -> str:
+        """导出为Prometheus文本格式（summary类型）"""
+        with self._lock:
+            snapshot = {name: sorted(samples) for name, samples in self._samples.items()}
+            totals = {name: tuple(total) for name, total in self._totals.items()}
+        lines = []
+        for name, values in sorted(snapshot.items()):
+            metric = f"{self.prefix}_{name}"
+            lines.append(f"# TYPE {metric} summary")
+            for q in self.QUANTILES:
+                lines.append(f'{metric}{{quantile="{q}"}} {self._percentile(values, q):.6g}')
+            count, total = totals[name]
+            lines.append(f"{metric}_sum {total:.6g}")
+            lines.append(f"{metric}_count {count}")
+        return "\n".join(lines) + "\n"
+
+    def to_jsonl(self) -> str:
+        """导出最近每轮对话的原始记录，每行一个JSON"""
+        with self._lock:
+            turns = list(self._turns)
+        return "".join(json.dumps(turn, ensure_ascii=False) + "\n" for turn in turns)
+
+    def reset(self):
+        with self._lock:
+            self._samples.clear()
+            self._totals.clear()
+            self._turns.clear()
+
+
+# 进程内共享的默认注册表
+pipeline_metrics = LatencyMetrics()
+
+
+if __name__ == "__main__":
+    # 演示：用随机耗时填充注册表并输出两种导出格式
+    import random
+
+    metrics = LatencyMetrics(window=200)
+    rng = random.Random(0)
+    for _ in range(500):
+        metrics.record_turn({
+            "llm_ttft_seconds": rng.lognormvariate(-1.0, 0.3),
+            "sd_denoise_seconds": rng.gauss(6.0, 0.5),
+            "image_convert_seconds": rng.uniform(0.001, 0.003),
+        })
+    for name, stats in metrics.summary().items():
+        print(name, {key: round(value, 4) for key, value in stats.items()})
+    print(metrics.to_prometheus())
+    print(metrics.to_jsonl().splitlines()[-1])
@@ -0,0 +1,311 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import aclosing, nullcontext
+from typing import Callable, Optional
+
+from llm_events import PromptTag, Usage
+from log_utils import log, debug, error
+from metrics import StreamTimer, pipeline_metrics
+from scheduler import INTERACTIVE
+
+
+class Queued:
+    """请求在资源（llm/sd）前排队，position为前面的请求数"""
+    __slots__ = ("resource", "position")
+
+    def __init__(self, resource: str, position: int):
+        self.resource = resource
+        self.position = position
+
+    def __repr__(self):
+        return f"Queued({self.resource!r}, {self.position})"
+
+
+class ImagePreview:
+    """去噪过程中的低分辨率预览"""
+    __slots__ = ("step", "images")
+
+    def __init__(self, step: int, images):
+        self.step = step
+        self.images = images
+
+    def __repr__(self):
+        return f"ImagePreview(step={self.step})"
+
+
+class ImageReady:
+    """生成完成的图像，images为generate_images转换后的结果（如QImage或编码后的bytes）"""
+    __slots__ = ("prompt", "images")
+
+    def __init__(self, prompt: str, images: list):
+        self.prompt = prompt
+        self.images = images
+
+    def __repr__(self):
+        return f"ImageReady({self.prompt!r}, {len(self.images)} images)"
+
+
+class TurnError:
+    """本轮对话中不影响文本流的错误（如图像生成失败）"""
+    __slots__ = ("message",)
+
+    def __init__(self, message: str):
+        self.message = message
+
+    def __repr__(self):
+        return f"TurnError({self.message!r})"
+
+
+class TurnDone:
+    """文本流与图像生成都已结束，timings为本轮的分阶段耗时"""
+    __slots__ = ("timings",)
+
+    def __init__(self, timings: dict):
+        self.timings = timings
+
+    def __repr__(self):
+        return f"TurnDone({self.timings!r})"
+
+
+class DiffusionWorker:
+    """
+    在专用线程中加载StableDiffusion并生成图像
+
+    convert在同一线程中把diffusers的numpy输出转换为调用方需要的格式（QImage、PNG等），
+    事件循环线程不接触像素数据。stable_diffusion在首次加载时才导入。
+    """
+
+    def __init__(self, convert: Callable, preview_convert: Optional[Callable] = None, preview_every=5,
+                 before_generate: Optional[Callable] = None):
+        """
+        Args:
+            convert: 把NHWC数组转换为图像列表的函数，如ndarray_to_qimages
+            preview_convert: 预览图的转换函数，默认与convert相同
+            preview_every: 每隔多少个去噪步发送一次预览，0表示关闭预览
+            before_generate: 每次生成前在图像生成线程中调用，如检查显存
+        """
+        self.convert = convert
+        self.preview_convert = preview_convert or convert
+        self.preview_every = preview_every
+        self.before_generate = before_generate
+        self.sd_service = None
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="StableDiffusion")
+
+    def load(self, warm_up=False) -> dict:
+        """在图像生成线程中运行：加载SD模型，可选地做一次预热去噪"""
+        if self.sd_service is not None:
+            return {}
+        from stable_diffusion import StableDiffusion
+
+        stats = {}
+        start = time.perf_counter()
+        self.sd_service = StableDiffusion()
+        stats["sd_load_seconds"] = time.perf_counter() - start
+        if warm_up:
+            start = time.perf_counter()
+            self.sd_service.warm_up()
+            stats["sd_warmup_seconds"] = time.perf_counter() - start
+        return stats
+
+    def warm_up(self):
+        """把加载与预热放进图像生成线程的队列最前面，返回concurrent.futures.Future"""
+        return self.executor.submit(self.load, True)
+
+    def generate(self, prompt: str, cancel_event=None, preview_callback=None, timings=None, prompt_time=None):
+        """
+        在图像生成线程中运行，返回转换后的图像列表；被取消时返回None，生成失败时返回空列表
+        """
+        from stable_diffusion import GenerationCancelled
+
+        if timings is not None and prompt_time is not None:
+            timings["prompt_to_sd_start_seconds"] = time.perf_counter() - prompt_time
+        if self.sd_service is None:
+            # 未调用warm_up时在首次生成时加载
+            self.load()
+        if self.before_generate is not None:
+            self.before_generate()
+        on_preview = None
+        if preview_callback is not None:
+            def on_preview(step, images):
+                preview_callback(step, self.preview_convert(images))
+        try:
+            images = self.sd_service.generate_image(
+                prompt,
+                output_type="np",
+                cancel_event=cancel_event,
+                preview_callback=on_preview,
+                preview_every=self.preview_every if on_preview is not None else 0,
+                timings=timings,
+            )
+        except GenerationCancelled:
+            return None
+        if images is None or len(images) == 0:
+            return []
+        start = time.perf_counter()
+        converted = self.convert(images)
+        convert_time = time.perf_counter() - start
+        if timings is not None:
+            timings["image_convert_seconds"] = convert_time
+        debug("DiffusionWorker", "图像转换耗时: %.1fms", convert_time * 1000)
+        return converted
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+        self.sd_service = None
+
+
+class ChatPipeline:
+    """
+    不依赖Qt的对话+图像生成核心，AIManager、AIManagerSonnet与server.py共用
+
+    LLM后端直接输出事件对象（TextDelta、ThinkingDelta、PromptTag、Usage），收到提示词后立即在后台开始生成图像，
+    所有结果以事件对象（TextDelta、PromptTag、ImageReady、TurnDone等）交给调用方的on_event，
+    由调用方转换为Qt信号或WebSocket消息。on_event总在事件循环线程中被调用，不能阻塞。
+
+    传入scheduler时LLM与图像生成分别在"llm"、"sd"资源前排队；传入sessions时按会话id使用独立的对话历史。
+    """
+
+    def __init__(self, llm, generate_images: Optional[Callable] = None, executor=None,
+                 scheduler=None, sessions=None, metrics=pipeline_metrics, previews=False):
+        """
+        Args:
+            llm: generate_events(prompt[, history], thinking=...)返回事件异步生成器的后端，如Deepseek、Sonnet
+            generate_images: 在executor中运行的图像生成函数，签名同DiffusionWorker.generate，None表示不生成图像
+            executor: 图像生成使用的线程池，None时使用事件循环的默认线程池
+            scheduler: Scheduler，需包含"llm"与"sd"两种资源，None表示不排队
+            sessions: SessionManager，None时使用llm自带的对话历史
+            previews: 是否发送ImagePreview事件
+        """
+        self.llm = llm
+        self.generate_images = generate_images
+        self.executor = executor
+        self.scheduler = scheduler
+        self.sessions = sessions
+        self.metrics = metrics
+        self.previews = previews
+        self.cancel_events = set()  # 正在进行的图像生成的取消标志
+
+    def cancel_images(self):
+        """线程安全：通知所有正在进行的图像生成在下一个去噪步结束时停止"""
+        for cancel_event in list(self.cancel_events):
+            cancel_event.set()
+
+    def _acquire(self, resource, session_id, on_event, priority=INTERACTIVE):
+        """在资源前排队；前面有请求时先发出Queued事件。队列已满时抛出QueueFull"""
+        if self.scheduler is None:
+            return nullcontext()
+        ticket = self.scheduler.enqueue(resource, session_id, priority)
+        position = ticket.position
+        if position:
+            on_event(Queued(resource, position))
+        return ticket
+
+    def _history(self, session_id):
+        if self.sessions is None or session_id is None:
+            return nullcontext()
+        return self.sessions.session(session_id)
+
+    async def run_turn(self, user_input: str, on_event: Callable, session_id=None, thinking=True) -> dict:
+        """
+        处理一轮对话，文本流与本轮的图像生成都结束后返回分阶段耗时
+        被取消时同时取消LLM流与图像生成；thinking=False时后端不产生ThinkingDelta
+        """
+        log("ChatPipeline", f"会话{session_id}: 开始处理用户输入: '{user_input}'")
+        image_tasks = set()  # 本轮对话中在后台运行的图像生成任务
+        cancelled = False
+        turn_start = time.perf_counter()
+        timings = {}  # 本轮对话的分阶段耗时
+        stream_timer = StreamTimer()
+
+        def dispatch(event):
+            debug("ChatPipeline", "流式事件: %r", event)
+            on_event(event)
+            if type(event) is PromptTag and self.generate_images is not None:
+                # 启动图像生成任务，在后台运行，不阻塞文本流
+                image_tasks.add(asyncio.create_task(
+                    self._generate_image(event.prompt, session_id, on_event, timings)))
+
+        try:
+            async with self._history(session_id) as history:
+                async with self._acquire("llm", session_id, on_event):
+                    if history is None:
+                        stream = self.llm.generate_events(user_input, thinking=thinking)
+                    else:
+                        stream = self.llm.generate_events(user_input, history=history, thinking=thinking)
+                    # aclosing保证对话被取消时立即关闭LLM流和底层HTTP连接
+                    async with aclosing(stream) as stream:
+                        async for event in stream:
+                            if type(event) is Usage:
+                                timings.update(event.stats)
+                            else:
+                                stream_timer.tick()
+                            dispatch(event)
+                    timings.update(stream_timer.results())
+        except asyncio.CancelledError:
+            cancelled = True
+            raise
+        finally:
+            # 文本流与图像生成都完成后本轮对话才算结束
+            await self._finish_image_tasks(image_tasks, cancel=cancelled)
+            if not cancelled:
+                timings["turn_total_seconds"] = time.perf_counter() - turn_start
+                self.metrics.record_turn(timings)
+                log("ChatPipeline", f"会话{session_id}: 本轮耗时: {timings}")
+        # LLM出错时异常直接抛给调用方，不发出TurnDone
+        on_event(TurnDone(timings))
+        return timings
+
+    async def _finish_image_tasks(self, image_tasks, cancel=False):
+        """等待（或取消）本轮对话中仍在运行的图像生成任务"""
+        pending = [task for task in image_tasks if not task.done()]
+        if not pending:
+            return
+        if cancel:
+            log("ChatPipeline", f"对话被取消，取消{len(pending)}个图像生成任务")
+            for task in pending:
+                task.cancel()
+        else:
+            log("ChatPipeline", f"文本输出完成，等待{len(pending)}个图像生成任务")
+        await asyncio.gather(*pending, return_exceptions=True)
+
+    async def _generate_image(self, prompt: str, session_id, on_event, timings):
+        log("ChatPipeline", f"开始生成图像, 提示词: '{prompt}'")
+        loop = asyncio.get_running_loop()
+        prompt_time = time.perf_counter()
+        cancel_event = threading.Event()
+        preview_callback = None
+        if self.previews:
+            def preview_callback(step, images):
+                # 在图像生成线程中调用，转交给事件循环线程
+                loop.call_soon_threadsafe(on_event, ImagePreview(step, images))
+        self.cancel_events.add(cancel_event)
+        try:
+            async with self._acquire("sd", session_id, on_event):
+                images = await loop.run_in_executor(
+                    self.executor, self.generate_images, prompt, cancel_event, preview_callback, timings,
+                    prompt_time)
+        except asyncio.CancelledError:
+            # 通知图像生成线程在下一个去噪步结束时停止
+            cancel_event.set()
+            log("ChatPipeline", "图像生成任务已取消")
+            raise
+        except Exception as e:
+            error("ChatPipeline", f"生成图像时出错: {str(e)}")
+            on_event(TurnError(f"图像生成错误: {str(e)}"))
+            return False
+        finally:
+            self.cancel_events.discard(cancel_event)
+
+        if images is None:
+            log("ChatPipeline", "图像生成已取消")
+            return False
+        if not images:
+            log("ChatPipeline", "生成图像失败，返回为空")
+            on_event(TurnError("图像生成失败"))
+            return False
+        log("ChatPipeline", f"图像生成完成，图像数量: {len(images)}")
+        on_event(ImageReady(prompt, images))
+        return True
+
@@ -0,0 +1,400 @@
+import asyncio
+import random
+import time
+from datetime import datetime
+
+import aiohttp
+
+from log_utils import log, debug
+from metrics import pipeline_metrics
+
+# 可以重试的状态码：超时、速率限制、服务端错误与过载（529）
+RETRY_STATUSES = frozenset((408, 429, 500, 502, 503, 504, 529))
+# 可以重试的异常：连接失败、连接被重置、超时
+RETRY_EXCEPTIONS = (aiohttp.ClientConnectionError, asyncio.TimeoutError)
+
+
+class CircuitOpen(Exception):
+    """断路器打开，请求未发出"""
+
+    def __init__(self, retry_in: float):
+        super().__init__(f"API暂时不可用，{retry_in:.1f}秒后重试")
+        self.retry_in = retry_in
+
+
+class RateBucket:
+    """
+    由响应头同步的令牌桶
+
+    每次响应报告的余量（remaining）与桶恢复满额的时间（reset）确定当前余量与补充速度，
+    两次响应之间在本地按该速度补充。请求在等待之前就预留用量（余量可以为负），
+    并发等待的请求依次排在后面，不会在同一时刻一起发出；服务端尚未收到的预留在同步时保留。
+    收到第一个响应头之前不做限制。
+    """
+    __slots__ = ("name", "window", "limit", "level", "rate", "updated", "pending")
+
+    def __init__(self, name: str, window=60.0):
+        self.name = name
+        self.window = window  # 速率限制的统计周期，没有可用的reset时按limit/window补充
+        self.limit = None
+        self.level = 0.0
+        self.rate = 0.0
+        self.updated = 0.0
+        self.pending = 0.0  # 已预留但服务端还没有收到的用量
+
+    def sync(self, limit: int, remaining: int, reset_in: float, now: float):
+        self.limit = limit
+        self.level = remaining - self.pending
+        missing = limit - remaining
+        self.rate = missing / reset_in if missing > 0 and reset_in > 0 else limit / self.window
+        self.updated = now
+
+    def _refill(self, now):
+        self.level = min(self.limit, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        """余量足够amount之前需要等待的秒数"""
+        if self.limit is None:
+            return 0.0
+        self._refill(now)
+        amount = min(amount, self.limit)
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) / self.rate if self.rate > 0 else self.window
+
+    def take(self, amount: float, now: float):
+        """预留用量，请求发出后调用release"""
+        self.pending += amount
+        if self.limit is None:
+            return
+        self._refill(now)
+        self.level -= amount
+
+    def release(self, amount: float):
+        self.pending -= amount
+
+
+class CircuitBreaker:
+    """
+    连续failure_threshold次请求失败（5xx、529、连接错误）后打开，cooldown秒内直接拒绝请求；
+    之后进入半开状态，只放行一个探测请求，成功则关闭，失败则再次打开
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold=5, cooldown=30.0):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.opens = 0  # 累计打开次数
+        self._probing = False
+
+    def allow(self, now: float) -> float:
+        """允许发出请求时返回0，否则返回距离下次探测的秒数"""
+        if self.state == self.OPEN:
+            remaining = self.opened_at + self.cooldown - now
+            if remaining > 0:
+                return remaining
+            self.state = self.HALF_OPEN
+            log("CircuitBreaker", "断路器半开，发送探测请求")
+        if self.state == self.HALF_OPEN:
+            if self._probing:
+                return self.cooldown
+            self._probing = True
+        return 0.0
+
+    def success(self):
+        if self.state != self.CLOSED:
+            log("CircuitBreaker", "探测请求成功，断路器关闭")
+        self.state = self.CLOSED
+        self.failures = 0
+        self._probing = False
+
+    def failure(self, now: float):
+        self.failures += 1
+        if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.failures >= self.failure_threshold):
+            self.state = self.OPEN
+            self.opened_at = now
+            self.opens += 1
+            log("CircuitBreaker", f"连续失败{self.failures}次，断路器打开{self.cooldown:.1f}秒")
+        self._probing = False
+
+    def abort(self):
+        """探测请求被取消，允许下一个请求继续探测"""
+        self._probing = False
+
+
+class RateGovernor:
+    """
+    LLM API的客户端请求调度
+
+    请求前按响应头（anthropic-ratelimit-*）同步的令牌桶控制节奏，不把请求打到已知会被限流的时刻；
+    429、529、5xx与连接错误按带抖动的指数退避重试（429优先使用retry-after），总耗时不超过deadline；
+    API持续失败时断路器打开，新请求立即失败而不是排队重试。同一个API密钥的所有客户端应共享同一个实例。
+    必须在同一个事件循环中使用。
+    """
+
+    BUCKETS = ("requests", "input-tokens", "output-tokens", "tokens")
+
+    def __init__(self, max_attempts=5, deadline=60.0, base_delay=0.5, max_delay=20.0,
+                 failure_threshold=5, cooldown=30.0, window=60.0, metrics=pipeline_metrics, seed=None):
+        """
+        Args:
+            max_attempts: 每个请求最多尝试的次数（含第一次）
+            deadline: 每个请求从开始到最后一次重试的总时间预算（秒），含等待令牌桶的时间
+            base_delay / max_delay: 指数退避的初始与最大间隔，实际间隔在[0, 当前上限]内随机（full jitter）
+            failure_threshold / cooldown: 断路器在连续失败多少次后打开，以及打开多少秒
+            window: 速率限制的统计周期，Anthropic为60秒
+        """
+        self.max_attempts = max_attempts
+        self.deadline = deadline
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.metrics = metrics
+        self.breaker = CircuitBreaker(failure_threshold, cooldown)
+        self.buckets = {name: RateBucket(name, window) for name in self.BUCKETS}
+        self._rng = random.Random(seed)
+        self.retries = 0
+        self.throttled = 0  # 因令牌桶余量不足而等待的请求数
+        self.rejected = 0  # 断路器打开时直接拒绝的请求数
+
+    def update(self, headers):
+        """用响应头同步令牌桶"""
+        now = time.monotonic()
+        wall = time.time()
+        for name, bucket in self.buckets.items():
+            limit = headers.get(f"anthropic-ratelimit-{name}-limit")
+            remaining = headers.get(f"anthropic-ratelimit-{name}-remaining")
+            reset = headers.get(f"anthropic-ratelimit-{name}-reset")
+            if limit is None or remaining is None:
+                continue
+            try:
+                reset_in = datetime.fromisoformat(reset.replace("Z", "+00:00")).timestamp() - wall if reset else 0.0
+                bucket.sync(int(limit), int(remaining), reset_in, now)
+            except ValueError:
+                debug("RateGovernor", "无法解析速率限制响应头: %s", name)
+
+    def _costs(self, input_tokens):
+        return {"requests": 1, "input-tokens": input_tokens, "tokens": input_tokens}
+
+    async def _throttle(self, costs, deadline):
+        """预留本次请求的用量，并等到各令牌桶补充到足够的余量，最多等到deadline"""
+        now = time.monotonic()
+        wait = max(bucket.wait_time(costs.get(name, 0), now) for name, bucket in self.buckets.items())
+        for name, bucket in self.buckets.items():
+            bucket.take(costs.get(name, 0), now)
+        if wait > 0:
+            wait = min(wait, max(0.0, deadline - now))
+            self.throttled += 1
+            self.metrics.record("llm_throttle_wait_seconds", wait)
+            debug("RateGovernor", "令牌桶余量不足，等待%.2fs", wait)
+            await asyncio.sleep(wait)
+
+    def _release(self, costs):
+        for name, bucket in self.buckets.items():
+            bucket.release(costs.get(name, 0))
+
+    def backoff(self, attempt: int, retry_after=None) -> float:
+        """第attempt次重试前的等待：[0, min(max_delay, base_delay * 2^attempt)]内随机，不少于retry-after"""
+        delay = self._rng.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+    def _retry_delay(self, attempt, retry_after, deadline):
+        """返回下次重试前的等待秒数，不能再重试时返回None"""
+        if attempt + 1 >= self.max_attempts:
+            return None
+        delay = self.backoff(attempt, retry_after)
+        if time.monotonic() + delay > deadline:
+            return None
+        self.retries += 1
+        self.metrics.record("llm_retry_delay_seconds", delay)
+        return delay
+
+    @staticmethod
+    def _retry_after(headers):
+        value = headers.get("retry-after")
+        try:
+            return float(value) if value is not None else None
+        except ValueError:
+            return None
+
+    async def call(self, send, input_tokens=0):
+        """
+        发出请求并在需要时重试，返回最后一次的响应（调用方负责释放）
+        Args:
+            send: 发出一次请求的函数，返回可await的aiohttp响应，如lambda: session.post(...)
+            input_tokens: 本次请求的输入token估算，用于输入token令牌桶
+        Raises:
+            CircuitOpen: 断路器打开，请求未发出
+        """
+        start = time.monotonic()
+        deadline = start + self.deadline
+        costs = self._costs(input_tokens)
+        attempt = 0
+        while True:
+            retry_in = self.breaker.allow(time.monotonic())
+            if retry_in:
+                self.rejected += 1
+                raise CircuitOpen(retry_in)
+            try:
+                await self._throttle(costs, deadline)
+                try:
+                    response = await send()
+                finally:
+                    self._release(costs)
+            except RETRY_EXCEPTIONS as e:
+                self.breaker.failure(time.monotonic())
+                delay = self._retry_delay(attempt, None, deadline)
+                if delay is None:
+                    raise
+                log("RateGovernor", f"请求出错: {e!r}，{delay:.2f}秒后第{attempt + 1}次重试")
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+            except BaseException:
+                self.breaker.abort()
+                raise
+
+            self.update(response.headers)
+            if response.status == 429 or response.status not in RETRY_STATUSES:
+                # 429说明API本身可用，只是超出了配额，不计入断路器
+                self.breaker.success()
+            else:
+                self.breaker.failure(time.monotonic())
+            if response.status in RETRY_STATUSES:
+                delay = self._retry_delay(attempt, self._retry_after(response.headers), deadline)
+                if delay is not None:
+                    log("RateGovernor", f"API返回{response.status}，{delay:.2f}秒后第{attempt + 1}次重试")
+                    response.release()
+                    await asyncio.sleep(delay)
+                    attempt += 1
+                    continue
+            self.metrics.record("llm_request_attempts", attempt + 1)
+            return response
+
+    def stats(self) -> dict:
+        return {"retries": self.retries, "throttled": self.throttled, "rejected": self.rejected,
+                "circuit_opens": self.breaker.opens, "circuit_state": self.breaker.state}
+
+
+if __name__ == "__main__":
+    # 用替身服务器测试：服务端按令牌桶限流（429+retry-after）以及一段时间内持续返回529（过载）时，
+    # 对比原先的做法（失败即放弃）、只重试、以及RateGovernor的持续吞吐与失败数
+    # python rate_governor.py [并发数] [每种模式的秒数]
+    import os
+    import sys
+    import tempfile
+
+    from journal import ConversationJournal
+    # 使用rate_governor模块中的类，Sonnet捕获的CircuitOpen与这里抛出的是同一个类
+    from rate_governor import RETRY_EXCEPTIONS, RateGovernor
+    from llm_events import TextDelta, Usage
+    from metrics import LatencyMetrics
+    from sonnet import Sonnet
+    from standin_servers import AnthropicStandin, StreamProfile
+
+    workers = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    duration = float(sys.argv[2]) if len(sys.argv) > 2 else 8.0
+
+    class Passthrough:
+        """原先的做法：只发一次请求"""
+
+        async def call(self, send, input_tokens=0):
+            return await send()
+
+        def stats(self):
+            return {}
+
+    class RetryOnly(RateGovernor):
+        """只重试，不读取速率限制响应头"""
+
+        def update(self, headers):
+            pass
+
+    async def run(name, server, governor, journal, pace=0.0, outage=None):
+        """
+        workers个客户端并发对话duration秒，每轮之间间隔pace秒
+        outage=(开始, 结束)时在这段时间内让服务端对所有请求返回529
+        """
+        server.reset_stats()
+        metrics = LatencyMetrics()
+        results = {"ok": 0, "failed": 0}
+        stop_at = time.monotonic() + duration
+        during = [0, 0]  # 故障开始与结束时服务端收到的请求数
+
+        async def overload():
+            await asyncio.sleep(outage[0])
+            during[0] = server.requests
+            server.profile.error_script = [529] * (1 << 20)
+            await asyncio.sleep(outage[1] - outage[0])
+            server.profile.error_script = []
+            during[1] = server.requests
+
+        async def client(index):
+            sonnet = Sonnet(api_key="standin", base_url=server.url, journal=journal, conversation=f"c{index}",
+                            governor=governor)
+            turn = 0
+            while time.monotonic() < stop_at:
+                start = time.perf_counter()
+                ok = False
+                try:
+                    async for event in sonnet.generate_events(f"第{turn}轮: 主人好", thinking=False):
+                        if type(event) is Usage:
+                            ok = True
+                        elif type(event) is TextDelta and event.text.startswith("API错误"):
+                            break
+                except RETRY_EXCEPTIONS:
+                    pass
+                elapsed = time.perf_counter() - start
+                results["ok" if ok else "failed"] += 1
+                metrics.record("ok_seconds" if ok else "failed_seconds", elapsed)
+                turn += 1
+                await asyncio.sleep(pace)
+            await sonnet.aclose()
+
+        start = time.monotonic()
+        tasks = [client(index) for index in range(workers)]
+        if outage:
+            tasks.append(overload())
+        await asyncio.gather(*tasks)
+        elapsed = time.monotonic() - start
+        summary = metrics.summary()
+        latency = "".join(f", {label} p50 {summary[key]['p50']:.2f}s p95 {summary[key]['p95']:.2f}s"
+                          for key, label in (("ok_seconds", "成功"), ("failed_seconds", "失败")) if key in summary)
+        print(f"  {name}: 成功 {results['ok']}轮 ({results['ok'] / elapsed:.1f}轮/s), 失败 {results['failed']}轮, "
+              f"服务端收到 {server.requests}个请求 (429 {server.rate_limited}, 注入错误 {server.errors}"
+              f"{f', 故障期间 {during[1] - during[0]}个' if outage else ''}){latency}, {governor.stats()}")
+
+    def governors():
+        return (("原先(失败即放弃)", Passthrough()),
+                ("只重试", RetryOnly(max_attempts=6, deadline=10.0, base_delay=0.1, max_delay=2.0,
+                                   failure_threshold=1 << 30, window=1.0, metrics=LatencyMetrics(), seed=0)),
+                ("RateGovernor", RateGovernor(max_attempts=6, deadline=10.0, base_delay=0.1, max_delay=2.0,
+                                              failure_threshold=5, cooldown=0.5, window=1.0,
+                                              metrics=LatencyMetrics(), seed=0)))
+
+    async def main():
+        with tempfile.TemporaryDirectory() as tmp:
+            journal = ConversationJournal(os.path.join(tmp, "conversations.db"))
+            # 服务端每秒20个请求、6000个输入token（约14轮/s）
+            print(f"速率限制: {workers}个并发客户端, 每种模式{duration:.0f}秒")
+            for name, governor in governors():
+                with AnthropicStandin(profile=StreamProfile(
+                        token_rate=500, rate_limit_requests=20, rate_limit_input_tokens=6000,
+                        rate_limit_window=1.0)) as server:
+                    await run(name, server, governor, journal)
+
+            # 第2到4秒服务端过载，所有请求返回529，之后恢复
+            print(f"过载: {workers}个并发客户端每0.2秒一轮, 每种模式{duration:.0f}秒, 第2~4秒所有请求返回529")
+            for name, governor in governors():
+                with AnthropicStandin(profile=StreamProfile(token_rate=500)) as server:
+                    await run(name, server, governor, journal, pace=0.2, outage=(2.0, 4.0))
+            journal.close()
+
+    asyncio.run(main())
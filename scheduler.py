@@ -0,0 +1,307 @@
+import asyncio
+import time
+from collections import OrderedDict, deque
+
+from log_utils import log, debug
+from metrics import pipeline_metrics
+
+# 优先级，数值越小越先执行
+INTERACTIVE = 0  # 用户正在等待的请求
+PREFETCH = 1  # 预取、预热等可以延后的请求
+
+
+class QueueFull(Exception):
+    """资源的等待队列已满，请求未被接受"""
+
+    def __init__(self, resource: str, depth: int):
+        super().__init__(f"{resource}队列已满（{depth}个请求等待中）")
+        self.resource = resource
+        self.depth = depth
+
+
+class Ticket:
+    """
+    排队凭证，由Scheduler.enqueue返回
+    position为当前排在前面的请求数，可直接显示给用户；作为异步上下文管理器使用时进入即等待、退出即释放
+    """
+    __slots__ = ("resource", "session_id", "priority", "future", "enqueued_at", "granted_at", "released")
+
+    def __init__(self, resource, session_id, priority, future):
+        self.resource = resource
+        self.session_id = session_id
+        self.priority = priority
+        self.future = future
+        self.enqueued_at = time.perf_counter()
+        self.granted_at = None
+        self.released = False
+
+    @property
+    def granted(self) -> bool:
+        return self.granted_at is not None
+
+    @property
+    def position(self) -> int:
+        return 0 if self.granted else self.resource.position(self)
+
+    async def wait(self):
+        """等待轮到自己；等待期间被取消时自动退出队列"""
+        try:
+            await self.future
+        except asyncio.CancelledError:
+            if self.granted:
+                self.release()
+            else:
+                self.resource.remove(self)
+            raise
+        return self
+
+    def release(self):
+        if self.released:
+            return
+        self.released = True
+        if self.granted:
+            self.resource.finish(self)
+        else:
+            self.resource.remove(self)
+
+    async def __aenter__(self):
+        return await self.wait()
+
+    async def __aexit__(self, *exc):
+        self.release()
+
+
+class _Resource:
+    """
+    一种共享资源（如LLM、GPU）的等待队列
+
+    每个优先级下按会话分组，会话之间轮流出队（round-robin），一个会话提交再多请求也只能与其他会话交替执行。
+    fair=False时所有请求按先来先服务排队，用于对比。
+    """
+
+    def __init__(self, name, concurrency, max_queue, fair, metrics, max_per_session=None):
+        self.name = name
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self.max_per_session = max_per_session  # 单个会话最多占用的排队位置，None为不限
+        self.fair = fair
+        self.metrics = metrics
+        self.levels = {}  # 优先级 -> OrderedDict(会话 -> deque[Ticket])，会话顺序即轮转顺序
+        self.waiting = 0
+        self.running = 0
+        self.rejected = 0
+
+    def _key(self, ticket):
+        return ticket.session_id if self.fair else None
+
+    def session_waiting(self, session_id) -> int:
+        return sum(len(sessions.get(session_id, ())) for sessions in self.levels.values())
+
+    def push(self, ticket):
+        sessions = self.levels.setdefault(ticket.priority, OrderedDict())
+        queue = sessions.get(self._key(ticket))
+        if queue is None:
+            queue = sessions[self._key(ticket)] = deque()
+        queue.append(ticket)
+        self.waiting += 1
+        self.metrics.record(f"scheduler_{self.name}_queue_depth", self.waiting)
+
+    def remove(self, ticket):
+        sessions = self.levels.get(ticket.priority)
+        queue = sessions.get(self._key(ticket)) if sessions else None
+        if queue is None or ticket not in queue:
+            return
+        queue.remove(ticket)
+        self.waiting -= 1
+        if not queue:
+            del sessions[self._key(ticket)]
+        if not ticket.future.done():
+            ticket.future.cancel()
+        self.dispatch()
+
+    def pop(self):
+        for priority in sorted(self.levels):
+            sessions = self.levels[priority]
+            if not sessions:
+                continue
+            key, queue = next(iter(sessions.items()))
+            ticket = queue.popleft()
+            if queue:
+                # 该会话还有请求，排到本轮最后
+                sessions.move_to_end(key)
+            else:
+                del sessions[key]
+            self.waiting -= 1
+            return ticket
+        return None
+
+    def dispatch(self):
+        while self.running < self.concurrency and self.waiting:
+            ticket = self.pop()
+            if ticket.future.done():
+                continue
+            ticket.granted_at = time.perf_counter()
+            self.running += 1
+            self.metrics.record(f"scheduler_{self.name}_wait_seconds", ticket.granted_at - ticket.enqueued_at)
+            ticket.future.set_result(True)
+
+    def finish(self, ticket):
+        self.running -= 1
+        self.metrics.record(f"scheduler_{self.name}_run_seconds", time.perf_counter() - ticket.granted_at)
+        self.dispatch()
+
+    def position(self, ticket) -> int:
+        """按当前队列计算ticket前面还有多少个请求（含更高优先级的请求）"""
+        ahead = 0
+        for priority in sorted(self.levels):
+            sessions = self.levels[priority]
+            if priority < ticket.priority:
+                ahead += sum(len(queue) for queue in sessions.values())
+                continue
+            if priority > ticket.priority:
+                break
+            key = self._key(ticket)
+            own = sessions.get(key)
+            if own is None or ticket not in own:
+                return ahead
+            depth = own.index(ticket)
+            # 轮转出队：第depth轮中排在本会话之前的会话各出一个
+            before = True
+            for other_key, queue in sessions.items():
+                if other_key == key:
+                    before = False
+                    ahead += depth
+                    continue
+                ahead += min(len(queue), depth) + (1 if before and len(queue) > depth else 0)
+        return ahead
+
+
+class Scheduler:
+    """
+    LLM与图像生成等共享资源前的请求调度器
+
+    每种资源有独立的有界等待队列与并发上限；同一优先级内不同会话轮流执行，
+    队列已满时enqueue直接抛出QueueFull而不是无限堆积。必须在同一个事件循环中使用。
+    """
+
+    def __init__(self, metrics=pipeline_metrics):
+        self.metrics = metrics
+        self.resources = {}
+
+    def add_resource(self, name: str, concurrency=1, max_queue=64, fair=True, max_per_session=None):
+        """
+        Args:
+            concurrency: 同时执行的请求数
+            max_queue: 等待队列上限
+            fair: 是否按会话轮流出队
+            max_per_session: 单个会话最多排队的请求数，避免一个会话占满整个队列
+        """
+        self.resources[name] = _Resource(name, concurrency, max_queue, fair, self.metrics, max_per_session)
+        log("Scheduler", f"资源{name}: 并发{concurrency}, 队列上限{max_queue}, 公平调度{fair}, "
+                         f"单会话上限{max_per_session}")
+
+    def enqueue(self, resource: str, session_id=None, priority=INTERACTIVE) -> Ticket:
+        """
+        加入资源的等待队列并立即返回Ticket，可先把ticket.position告诉用户再await ticket.wait()
+        队列已满时抛出QueueFull
+        """
+        res = self.resources[resource]
+        if res.waiting >= res.max_queue or (
+                res.fair and res.max_per_session is not None
+                and res.session_waiting(session_id) >= res.max_per_session):
+            res.rejected += 1
+            raise QueueFull(resource, res.waiting)
+        ticket = Ticket(res, session_id, priority, asyncio.get_running_loop().create_future())
+        res.push(ticket)
+        res.dispatch()
+        debug("Scheduler", "%s: 会话%s排队，前面还有%d个请求", resource, session_id, ticket.position)
+        return ticket
+
+    async def run(self, resource: str, session_id, coro_func, *args, priority=INTERACTIVE):
+        """排队后执行coro_func(*args)，结束时释放资源"""
+        async with self.enqueue(resource, session_id, priority):
+            return await coro_func(*args)
+
+    def stats(self) -> dict:
+        return {name: {"running": res.running, "waiting": res.waiting, "rejected": res.rejected}
+                for name, res in self.resources.items()}
+
+
+if __name__ == "__main__":
+    # 负载测试：模拟多个用户共享LLM与GPU，其中一个用户连续提交大量请求
+    # python scheduler.py [普通用户数] [每个用户的对话轮数]
+    import random
+    import sys
+
+    from metrics import LatencyMetrics
+
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    turns = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+
+    async def simulate(fair):
+        metrics = LatencyMetrics(prefix="loadtest")
+        scheduler = Scheduler(metrics)
+        scheduler.add_resource("llm", concurrency=2, max_queue=32, fair=fair, max_per_session=8)
+        scheduler.add_resource("sd", concurrency=1, max_queue=16, fair=fair, max_per_session=4)
+        rng = random.Random(0)
+        rejected = {"normal": 0, "heavy": 0, "prefetch": 0}
+
+        async def turn(session_id, kind, priority=INTERACTIVE):
+            start = time.perf_counter()
+            try:
+                await scheduler.run("llm", session_id, asyncio.sleep, rng.uniform(0.02, 0.06), priority=priority)
+                await scheduler.run("sd", session_id, asyncio.sleep, rng.uniform(0.02, 0.04), priority=priority)
+            except QueueFull:
+                rejected[kind] += 1
+                return
+            metrics.record(f"{kind}_turn_seconds", time.perf_counter() - start)
+
+        async def normal_user(index):
+            for _ in range(turns):
+                await asyncio.sleep(rng.uniform(0.05, 0.3))  # 用户阅读、输入的时间
+                await turn(f"user{index}", "normal")
+
+        async def heavy_user():
+            # 一次性提交大量请求（例如批量脚本），外加一批低优先级的预取
+            tasks = [asyncio.create_task(turn("heavy", "heavy")) for _ in range(turns * 4)]
+            tasks += [asyncio.create_task(turn("heavy", "prefetch", PREFETCH)) for _ in range(turns)]
+            await asyncio.gather(*tasks)
+
+        start = time.perf_counter()
+        await asyncio.gather(heavy_user(), *(normal_user(index) for index in range(users)))
+        elapsed = time.perf_counter() - start
+        summary = metrics.summary()
+        name = "公平调度" if fair else "先来先服务"
+        print(f"{name}: 总耗时 {elapsed:.2f}s, 拒绝 {rejected}")
+        for key in ("normal_turn_seconds", "heavy_turn_seconds", "prefetch_turn_seconds",
+                    "scheduler_llm_wait_seconds", "scheduler_sd_wait_seconds", "scheduler_sd_queue_depth"):
+            if key in summary:
+                stats = summary[key]
+                print(f"  {key}: n={stats['count']} p50 {stats['p50']:.3f} p95 {stats['p95']:.3f} "
+                      f"p99 {stats['p99']:.3f}")
+
+    async def position_check():
+        """排队位置与实际出队顺序一致"""
+        scheduler = Scheduler(LatencyMetrics())
+        scheduler.add_resource("gpu", concurrency=1, max_queue=100)
+        order = []
+        blocker = scheduler.enqueue("gpu", "blocker")
+        await blocker.wait()
+        tickets = [scheduler.enqueue("gpu", session, priority)
+                   for session, priority in [("a", 0), ("a", 0), ("b", 0), ("c", 1), ("b", 0), ("a", 0)]]
+        positions = [ticket.position for ticket in tickets]
+
+        async def worker(ticket):
+            async with ticket:
+                order.append(tickets.index(ticket))
+
+        workers = [asyncio.create_task(worker(ticket)) for ticket in tickets]
+        await asyncio.sleep(0)
+        blocker.release()
+        await asyncio.gather(*workers)
+        assert [order.index(index) for index in range(len(tickets))] == positions, (order, positions)
+        print(f"排队位置: {positions}, 出队顺序: {order}")
+
+    asyncio.run(position_check())
+    asyncio.run(simulate(fair=False))
+    asyncio.run(simulate(fair=True))
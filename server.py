@@ -0,0 +1,458 @@
+import asyncio
+import json
+import os
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from functools import partial
+
+from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect
+from fastapi.responses import PlainTextResponse, Response
+from pydantic import BaseModel
+
+from llm_events import TextDelta, ThinkingDelta, PromptTag
+from log_utils import log, error, flush as flush_log
+from metrics import pipeline_metrics
+from pipeline import ChatPipeline, DiffusionWorker, Queued, ImagePreview, ImageReady, TurnError, TurnDone
+from scheduler import Scheduler, QueueFull
+from text_coalescer import TextCoalescer
+
+MEDIA_TYPES = {"png": "image/png", "jpeg": "image/jpeg", "webp": "image/webp"}
+
+
+class ImageStore:
+    """最近生成的图像，按id以/images/{id}提供下载，超出上限时删除最早的"""
+
+    def __init__(self, max_images=256):
+        self.max_images = max_images
+        self._images = OrderedDict()  # id -> (bytes, media_type)
+
+    def put(self, data: bytes, media_type: str) -> str:
+        image_id = uuid.uuid4().hex
+        self._images[image_id] = (data, media_type)
+        while len(self._images) > self.max_images:
+            self._images.popitem(last=False)
+        return image_id
+
+    def get(self, image_id: str):
+        return self._images.get(image_id)
+
+
+class ChatRequest(BaseModel):
+    session_id: str
+    text: str
+
+
+def _frame(**fields) -> str:
+    return json.dumps(fields, ensure_ascii=False, separators=(",", ":"))
+
+
+def _parse_message(received: dict) -> dict:
+    """解析客户端发来的一条WebSocket消息，格式不对时抛出ValueError，说明发回给客户端"""
+    if received.get("text") is None:
+        raise ValueError("只接受JSON文本消息")
+    try:
+        message = json.loads(received["text"])
+    except ValueError:
+        raise ValueError("消息不是有效的JSON")
+    if not isinstance(message, dict):
+        raise ValueError("消息必须是JSON对象")
+    if message.get("type") != "cancel" and not isinstance(message.get("text"), str):
+        raise ValueError("缺少text字段")
+    return message
+
+
+class _Connection:
+    """
+    一个WebSocket连接：对话在后台任务中运行，事件转换为消息放入发送队列，由单独的任务按顺序发送
+    ChatPipeline的on_event不能阻塞，客户端读得慢时消息在队列中等待，不影响其他连接
+    """
+
+    def __init__(self, websocket: WebSocket, session_id: str, store: ImageStore, image_format: str,
+                 binary_images: bool, thinking: bool, previews: bool):
+        self.websocket = websocket
+        self.session_id = session_id
+        self.store = store
+        self.image_format = image_format
+        self.binary_images = binary_images
+        self.thinking = thinking
+        self.previews = previews
+        self.outbox = asyncio.Queue()
+        self.turns = set()  # 正在运行或等待会话锁的对话任务
+        # 文本片段约每20ms合并为一条消息
+        self.text_coalescer = TextCoalescer(
+            lambda text: self.outbox.put_nowait(_frame(type="text", text=text)), flush_interval=0.02, max_chars=512)
+
+    def on_event(self, event):
+        """把ChatPipeline的事件转换为WebSocket消息"""
+        event_type = type(event)
+        if event_type is TextDelta:
+            self.text_coalescer.add(event.text)
+            return
+        self.text_coalescer.flush()
+        if event_type is ThinkingDelta:
+            # 只有thinking=1的连接才会收到
+            self.outbox.put_nowait(_frame(type="thinking", text=event.text))
+        elif event_type is PromptTag:
+            self.outbox.put_nowait(_frame(type="prompt", prompt=event.prompt))
+        elif event_type is Queued:
+            self.outbox.put_nowait(_frame(type="queued", resource=event.resource, position=event.position))
+        elif event_type is ImagePreview:
+            if self.previews:
+                self._send_images("preview", event.images, "jpeg", step=event.step)
+        elif event_type is ImageReady:
+            self._send_images("image", event.images, self.image_format, prompt=event.prompt)
+        elif event_type is TurnError:
+            self.outbox.put_nowait(_frame(type="error", message=event.message))
+        elif event_type is TurnDone:
+            self.outbox.put_nowait(_frame(type="done", timings=event.timings))
+
+    def _send_images(self, kind, images, image_format, **fields):
+        """二进制模式：先发一条说明消息，随后每张图像一个二进制帧；URL模式：只发送下载地址"""
+        if self.binary_images:
+            self.outbox.put_nowait(_frame(type=kind, format=image_format, count=len(images), **fields))
+            for data in images:
+                self.outbox.put_nowait(data)
+        else:
+            media_type = MEDIA_TYPES[image_format]
+            urls = [f"/images/{self.store.put(data, media_type)}" for data in images]
+            self.outbox.put_nowait(_frame(type=kind, format=image_format, urls=urls, **fields))
+
+    async def send_loop(self):
+        while True:
+            message = await self.outbox.get()
+            if isinstance(message, bytes):
+                await self.websocket.send_bytes(message)
+            else:
+                await self.websocket.send_text(message)
+
+    async def run_turn(self, pipeline: ChatPipeline, text: str):
+        try:
+            await pipeline.run_turn(text, self.on_event, session_id=self.session_id, thinking=self.thinking)
+        except QueueFull as e:
+            self.text_coalescer.flush()
+            self.outbox.put_nowait(_frame(type="busy", resource=e.resource, message=str(e)))
+        except asyncio.CancelledError:
+            self.text_coalescer.flush()
+            self.outbox.put_nowait(_frame(type="cancelled"))
+            raise
+        except Exception as e:
+            error("Server", f"会话{self.session_id}对话处理错误: {str(e)}")
+            self.text_coalescer.flush()
+            self.outbox.put_nowait(_frame(type="error", message=f"处理错误: {str(e)}"))
+
+    def cancel_turns(self) -> int:
+        cancelled = 0
+        for task in list(self.turns):
+            if task.cancel():
+                cancelled += 1
+        return cancelled
+
+
+def create_app(pipeline: ChatPipeline, image_worker: DiffusionWorker = None, image_format="png",
+               warm_up=True, max_images=256) -> FastAPI:
+    """
+    创建HTTP/WebSocket服务
+
+    WS /ws/{session_id}?images=url|binary&thinking=0|1&previews=0|1
+        客户端发送{"text": "...", "supersede": false}开始一轮对话，{"type": "cancel"}取消，
+        格式错误的消息收到一条error消息，连接与正在进行的对话不受影响；
+        服务端依次发送text/thinking/prompt/queued/image/preview/error/busy/done消息（JSON），
+        images=binary时图像紧跟在image消息之后以二进制帧发送
+    POST /chat {"session_id", "text"}：等一轮对话结束后返回完整回复与图像地址
+    GET /images/{id}、GET /health、GET /metrics（Prometheus文本）
+    """
+    store = ImageStore(max_images)
+    state = {"ready": not warm_up, "connections": 0}
+
+    async def warm_up_backends():
+        start = time.perf_counter()
+        waits = [pipeline.llm.warm_up()] if hasattr(pipeline.llm, "warm_up") else []
+        if image_worker is not None:
+            waits.append(asyncio.wrap_future(image_worker.warm_up()))
+        stats = {}
+        for result in await asyncio.gather(*waits, return_exceptions=True):
+            if isinstance(result, Exception):
+                error("Server", f"预热失败: {str(result)}")
+            else:
+                stats.update(result)
+        stats["warmup_total_seconds"] = time.perf_counter() - start
+        for name, value in stats.items():
+            pipeline_metrics.record(name, value)
+        state["ready"] = True
+        log("Server", f"预热完成: {stats}")
+
+    @asynccontextmanager
+    async def lifespan(app):
+        warmup_task = asyncio.create_task(warm_up_backends()) if warm_up else None
+        yield
+        if warmup_task is not None:
+            warmup_task.cancel()
+        if hasattr(pipeline.llm, "aclose"):
+            await pipeline.llm.aclose()
+        if pipeline.sessions is not None:
+            pipeline.sessions.close()
+        if image_worker is not None:
+            image_worker.shutdown()
+        log("Server", "服务已关闭")
+        flush_log()
+
+    app = FastAPI(lifespan=lifespan)
+
+    @app.get("/health")
+    async def health():
+        stats = pipeline.scheduler.stats() if pipeline.scheduler is not None else {}
+        return {"ready": state["ready"], "connections": state["connections"], "scheduler": stats}
+
+    @app.get("/metrics")
+    async def metrics():
+        return PlainTextResponse(pipeline_metrics.to_prometheus())
+
+    @app.get("/images/{image_id}")
+    async def image(image_id: str):
+        item = store.get(image_id)
+        if item is None:
+            raise HTTPException(status_code=404, detail="图像不存在或已过期")
+        data, media_type = item
+        return Response(content=data, media_type=media_type)
+
+    @app.post("/chat")
+    async def chat(request: ChatRequest):
+        reply = []
+        prompts = []
+        urls = []
+        errors = []
+        result = {}
+
+        def on_event(event):
+            event_type = type(event)
+            if event_type is TextDelta:
+                reply.append(event.text)
+            elif event_type is PromptTag:
+                prompts.append(event.prompt)
+            elif event_type is ImageReady:
+                media_type = MEDIA_TYPES[image_format]
+                urls.extend(f"/images/{store.put(data, media_type)}" for data in event.images)
+            elif event_type is TurnError:
+                errors.append(event.message)
+            elif event_type is TurnDone:
+                result["timings"] = event.timings
+
+        try:
+            await pipeline.run_turn(request.text, on_event, session_id=request.session_id, thinking=False)
+        except QueueFull as e:
+            raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
+        return {"reply": "".join(reply), "prompts": prompts, "images": urls, "errors": errors,
+                "timings": result.get("timings", {})}
+
+    @app.websocket("/ws/{session_id}")
+    async def chat_socket(websocket: WebSocket, session_id: str, images: str = "url", thinking: bool = False,
+                          previews: bool = False):
+        await websocket.accept()
+        connection = _Connection(websocket, session_id, store, image_format, images == "binary", thinking,
+                                 previews)
+        sender = asyncio.create_task(connection.send_loop())
+        state["connections"] += 1
+        log("Server", f"会话{session_id}已连接，当前连接数{state['connections']}")
+        try:
+            while True:
+                received = await websocket.receive()
+                if received["type"] == "websocket.disconnect":
+                    raise WebSocketDisconnect(received.get("code", 1000))
+                try:
+                    message = _parse_message(received)
+                except ValueError as e:
+                    # 单条消息格式错误只回复错误，不影响连接上正在进行的对话
+                    connection.outbox.put_nowait(_frame(type="error", message=str(e)))
+                    continue
+                if message.get("type") == "cancel":
+                    connection.cancel_turns()
+                    continue
+                if message.get("supersede"):
+                    connection.cancel_turns()
+                task = asyncio.create_task(connection.run_turn(pipeline, message["text"]))
+                connection.turns.add(task)
+                task.add_done_callback(connection.turns.discard)
+        except WebSocketDisconnect:
+            pass
+        except Exception as e:
+            error("Server", f"会话{session_id}连接出错: {str(e)}")
+        finally:
+            # 断开连接时取消该连接上的对话，释放LLM与GPU
+            connection.cancel_turns()
+            sender.cancel()
+            await asyncio.gather(sender, *connection.turns, return_exceptions=True)
+            state["connections"] -= 1
+            log("Server", f"会话{session_id}已断开，当前连接数{state['connections']}")
+
+    return app
+
+
+def build_pipeline(images=True, image_format="png", llm_concurrency=4, sd_concurrency=1, db_path=None):
+    """
+    默认部署：Deepseek(Ollama) + StableDiffusion，多会话历史存入sqlite，LLM与GPU前公平排队
+    llm_concurrency应与Ollama的OLLAMA_NUM_PARALLEL一致
+    """
+    from deepseek import Deepseek
+    from image_convert import ndarray_to_encoded
+    from session_manager import SessionManager
+
+    deepseek = Deepseek()
+    scheduler = Scheduler()
+    scheduler.add_resource("llm", concurrency=llm_concurrency, max_queue=256, max_per_session=4)
+    scheduler.add_resource("sd", concurrency=sd_concurrency, max_queue=64, max_per_session=2)
+    image_worker = None
+    if images:
+        image_worker = DiffusionWorker(partial(ndarray_to_encoded, format=image_format.upper()),
+                                       preview_convert=partial(ndarray_to_encoded, format="JPEG", quality=70))
+    pipeline = ChatPipeline(deepseek, image_worker.generate if image_worker else None,
+                            executor=image_worker.executor if image_worker else None,
+                            scheduler=scheduler, sessions=SessionManager(deepseek.new_history, db_path),
+                            previews=images)
+    return pipeline, image_worker
+
+
+if __name__ == "__main__":
+    # python server.py [host] [port]：启动服务，AI_SERVER_IMAGES=0时不加载StableDiffusion
+    # python server.py bench [并发连接数,...] [每个连接的轮数] [每张图占用GPU秒数]：用Ollama替身服务器测试吞吐
+    import socket
+    import sys
+
+    import uvicorn
+
+    if len(sys.argv) < 2 or sys.argv[1] != "bench":
+        host = sys.argv[1] if len(sys.argv) > 1 else "0.0.0.0"
+        port = int(sys.argv[2]) if len(sys.argv) > 2 else 8000
+        pipeline, image_worker = build_pipeline(images=os.environ.get("AI_SERVER_IMAGES", "1") != "0")
+        uvicorn.run(create_app(pipeline, image_worker), host=host, port=port, ws="wsproto")
+        sys.exit(0)
+
+    import aiohttp
+    import numpy as np
+
+    from deepseek import Deepseek
+    from image_convert import ndarray_to_encoded
+    from loop_thread import EventLoopThread
+    from metrics import LatencyMetrics
+    from session_manager import SessionManager
+    from standin_servers import OllamaStandin, StreamProfile
+
+    levels = [int(n) for n in sys.argv[2].split(",")] if len(sys.argv) > 2 else [1, 32, 256]
+    turns = int(sys.argv[3]) if len(sys.argv) > 3 else 3
+    gpu_seconds = float(sys.argv[4]) if len(sys.argv) > 4 else 0.02
+    profile = StreamProfile(token_rate=200.0, jitter=0.3, first_token_delay=0.05, seed=0)
+
+    def fake_images(prompt, cancel_event=None, preview_callback=None, timings=None, prompt_time=None):
+        """代替SD：每张图占用GPU gpu_seconds秒，输出256x256的PNG"""
+        time.sleep(gpu_seconds)
+        return ndarray_to_encoded(np.full((1, 256, 256, 3), 0.8, dtype=np.float32))
+
+    def start_server(app, loop_thread):
+        sock = socket.socket()
+        sock.bind(("127.0.0.1", 0))
+        server = uvicorn.Server(uvicorn.Config(app, log_level="warning", ws="wsproto", lifespan="on"))
+        loop_thread.run_coroutine(server.serve(sockets=[sock]))
+        while not server.started:
+            time.sleep(0.01)
+        return server, f"127.0.0.1:{sock.getsockname()[1]}"
+
+    async def client(http, address, session_id, metrics, counts, binary):
+        mode = "binary" if binary else "url"
+        async with http.ws_connect(f"ws://{address}/ws/{session_id}?images={mode}") as ws:
+            for turn in range(turns):
+                start = time.perf_counter()
+                first = None
+                await ws.send_str(json.dumps({"text": f"第{turn}轮: 主人好"}, ensure_ascii=False))
+                async for message in ws:
+                    if message.type == aiohttp.WSMsgType.BINARY:
+                        counts["image_bytes"] += len(message.data)
+                        continue
+                    frame = json.loads(message.data)
+                    counts["frames"] += 1
+                    if frame["type"] == "text" and first is None:
+                        first = time.perf_counter() - start
+                    elif frame["type"] == "image":
+                        counts["images"] += frame["count"] if binary else len(frame["urls"])
+                    elif frame["type"] in ("busy", "error"):
+                        counts[frame["type"]] += 1
+                        break
+                    elif frame["type"] == "done":
+                        metrics.record("ws_ttft_seconds", first)
+                        metrics.record("ws_turn_seconds", time.perf_counter() - start)
+                        counts["turns"] += 1
+                        break
+
+    async def run_level(address, connections, binary):
+        metrics = LatencyMetrics()
+        counts = {"turns": 0, "frames": 0, "images": 0, "image_bytes": 0, "busy": 0, "error": 0}
+        connector = aiohttp.TCPConnector(limit=0)
+        async with aiohttp.ClientSession(connector=connector) as http:
+            start = time.perf_counter()
+            await asyncio.gather(*(client(http, address, f"user{connections}_{index}", metrics, counts, binary)
+                                   for index in range(connections)))
+            elapsed = time.perf_counter() - start
+        summary = metrics.summary()
+        print(f"{connections:>4}个连接{'(二进制图像)' if binary else ''}: {counts['turns']}轮/{elapsed:.2f}s = "
+              f"{counts['turns'] / elapsed:.1f}轮/s, 首token p50 {summary['ws_ttft_seconds']['p50'] * 1e3:.0f}ms "
+              f"p95 {summary['ws_ttft_seconds']['p95'] * 1e3:.0f}ms, 每轮 p50 "
+              f"{summary['ws_turn_seconds']['p50']:.2f}s p95 {summary['ws_turn_seconds']['p95']:.2f}s, "
+              f"{counts['frames']}条消息, {counts['images']}张图像({counts['image_bytes'] / 1024:.0f}KB), "
+              f"busy {counts['busy']}, error {counts['error']}")
+
+    async def run_post(address, requests):
+        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0)) as http:
+            async def post(index):
+                async with http.post(f"http://{address}/chat",
+                                     json={"session_id": f"post{index}", "text": "主人好"}) as response:
+                    body = await response.json()
+                    return response.status, len(body.get("images", []))
+
+            start = time.perf_counter()
+            results = await asyncio.gather(*(post(index) for index in range(requests)))
+            elapsed = time.perf_counter() - start
+        ok = sum(status == 200 for status, _ in results)
+        print(f"POST /chat: {requests}个并发请求, 成功{ok}个, {elapsed:.2f}s")
+
+    async def run_malformed(address):
+        """格式错误的消息只收到error回复，连接保持，之后的对话正常完成"""
+        async with aiohttp.ClientSession() as http:
+            async with http.ws_connect(f"ws://{address}/ws/malformed") as ws:
+                for bad in ("{不是JSON", "[1, 2]", json.dumps({"txt": "主人好"})):
+                    await ws.send_str(bad)
+                    assert json.loads((await ws.receive()).data)["type"] == "error"
+                await ws.send_bytes(b"\x00")
+                assert json.loads((await ws.receive()).data)["type"] == "error"
+                await ws.send_str(json.dumps({"text": "主人好"}, ensure_ascii=False))
+                types = []
+                while not types or types[-1] not in ("done", "error", "busy"):
+                    types.append(json.loads((await ws.receive()).data)["type"])
+                assert types[-1] == "done", types
+        print("格式错误的消息: 回复error后连接保持, 之后的对话正常完成")
+
+    async def build_app(ollama_url):
+        # 在服务端的事件循环线程中创建，sqlite连接只能在创建它的线程中使用
+        deepseek = Deepseek(host=ollama_url)
+        scheduler = Scheduler()
+        # 替身服务器可以同时服务所有连接，这里测的是服务端自身的开销
+        scheduler.add_resource("llm", concurrency=max(levels), max_queue=max(levels) * 2, max_per_session=2)
+        scheduler.add_resource("sd", concurrency=1, max_queue=max(levels) * 2, max_per_session=2)
+        pipeline = ChatPipeline(deepseek, fake_images, scheduler=scheduler,
+                                sessions=SessionManager(deepseek.new_history, ":memory:"))
+        return create_app(pipeline, warm_up=False)
+
+    with OllamaStandin(profile=profile) as standin:
+        server_thread = EventLoopThread("Server")
+        app = server_thread.run_coroutine(build_app(standin.url)).result()
+        server, address = start_server(app, server_thread)
+        print(f"服务地址 {address}, 替身 {profile.token_rate:.0f} tokens/s, 每轮{len(standin.script)}个token, "
+              f"每个连接{turns}轮, 每张图GPU {gpu_seconds * 1e3:.0f}ms")
+        for connections in levels:
+            asyncio.run(run_level(address, connections, binary=False))
+        asyncio.run(run_level(address, levels[-1], binary=True))
+        asyncio.run(run_post(address, levels[-1]))
+        asyncio.run(run_malformed(address))
+        print(f"替身服务器: {standin.requests}个请求, {standin.connections}个TCP连接")
+        server.should_exit = True
+        time.sleep(0.5)
+        server_thread.stop()
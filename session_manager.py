@@ -0,0 +1,345 @@
+import asyncio
+import json
+import os
+import sqlite3
+import time
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import Callable
+
+from chat_history import ChatHistory
+from log_utils import log, debug, error
+
+
+class _Session:
+    __slots__ = ("history", "lock", "users", "dirty")
+
+    def __init__(self, history):
+        self.history = history
+        self.lock = asyncio.Lock()  # 同一会话的请求按顺序处理
+        self.users = 0  # 正在使用或等待该会话的请求数，大于0时不会被换出
+        self.dirty = False  # 内存中的历史是否比磁盘上的新
+
+
+class SessionManager:
+    """
+    多会话对话历史管理，按用户或频道id区分会话
+
+    最近使用的max_hot个会话保存在内存中（LRU），其余的以zlib压缩的JSON存入sqlite，
+    再次使用时按需载入。同一会话的请求串行执行，不同会话之间可以并发。
+    sqlite读写与压缩都在一个后台线程中按顺序执行，事件循环中只做字典的增删，换出会话时不阻塞其他会话的输出。
+    必须在同一个事件循环中使用。
+    """
+
+    def __init__(self, history_factory: Callable[[], ChatHistory], db_path=None, max_hot=256):
+        """
+        Args:
+            history_factory: 创建空对话历史的函数，如Deepseek.new_history
+            db_path: sqlite文件路径，默认为本目录下的sessions.db，":memory:"表示不落盘
+            max_hot: 内存中最多保留的会话数
+        """
+        self.history_factory = history_factory
+        self.max_hot = max_hot
+        self.db_path = db_path or os.path.join(os.path.dirname(__file__), "sessions.db")
+        # 连接在这里创建，之后只在后台线程中使用；只有一个线程，读写按提交的顺序执行
+        self._db = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS sessions (id TEXT PRIMARY KEY, data BLOB NOT NULL, updated REAL NOT NULL)")
+        self._db.commit()
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="SessionManager")
+        self._hot = OrderedDict()  # 会话id -> _Session，按最近使用排序
+        self._spilling = {}  # 已移出内存、正在写入磁盘的会话id -> (_Session, 写入的Future)
+        self.hits = 0
+        self.loads = 0
+        self.spills = 0
+
+    @property
+    def hot_count(self) -> int:
+        return len(self._hot)
+
+    @staticmethod
+    def _encode(history: ChatHistory) -> bytes:
+        return zlib.compress(json.dumps(history.dump(), ensure_ascii=False, separators=(",", ":")).encode())
+
+    def _decode(self, data: bytes) -> ChatHistory:
+        history = self.history_factory()
+        history.load(json.loads(zlib.decompress(data)))
+        return history
+
+    # 以下三个方法在后台线程中执行
+    def _write(self, items):
+        """把(会话id, 历史)写入磁盘，合并为一个事务；这些历史已移出内存或由调用方保证不被修改"""
+        now = time.time()
+        self._db.executemany("INSERT OR REPLACE INTO sessions (id, data, updated) VALUES (?, ?, ?)",
+                             [(session_id, self._encode(history), now) for session_id, history in items])
+        self._db.commit()
+
+    def _load(self, session_id):
+        row = self._db.execute("SELECT data FROM sessions WHERE id = ?", (session_id,)).fetchone()
+        return None if row is None else self._decode(row[0])
+
+    def _delete(self, session_id):
+        self._db.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+        self._db.commit()
+
+    def _run(self, func, *args) -> asyncio.Future:
+        return asyncio.get_running_loop().run_in_executor(self._writer, func, *args)
+
+    async def _get(self, session_id) -> _Session:
+        """取出会话并占用（users加1），调用方用完后负责减1"""
+        while True:
+            session = self._hot.get(session_id)
+            if session is not None:
+                self._hot.move_to_end(session_id)
+                self.hits += 1
+                session.users += 1
+                return session
+            spilling = self._spilling.get(session_id)
+            if spilling is not None:
+                # 正在写入磁盘：等写完后直接放回内存，不再从磁盘读取；写入期间历史不能被修改
+                session, future = spilling
+                await asyncio.wait((future,))
+                if self._spilling.get(session_id) is spilling:
+                    del self._spilling[session_id]
+                    if future.cancelled() or future.exception() is not None:
+                        session.dirty = True
+                    self._add_hot(session_id, session)
+                    return session
+                continue
+            history = await self._run(self._load, session_id)
+            if session_id in self._hot or session_id in self._spilling:
+                # 读取期间其他请求已经载入了这个会话
+                continue
+            if history is not None:
+                self.loads += 1
+                debug("SessionManager", "从磁盘载入会话%s", session_id)
+            else:
+                history = self.history_factory()
+            history.conversation = session_id
+            session = _Session(history)
+            self._add_hot(session_id, session)
+            return session
+
+    def _add_hot(self, session_id, session: _Session):
+        # 先占用再换出，避免刚放入内存的会话被当作空闲会话移出内存
+        session.users += 1
+        self._hot[session_id] = session
+        self._evict()
+
+    def _evict(self):
+        """内存中会话超出上限时，把最久未使用且空闲的会话移出内存，有改动的在后台线程中写入磁盘"""
+        if len(self._hot) <= self.max_hot:
+            return
+        spilled = []
+        for session_id in list(self._hot):
+            if len(self._hot) <= self.max_hot:
+                break
+            session = self._hot[session_id]
+            if session.users:
+                continue
+            del self._hot[session_id]
+            self.spills += 1
+            if session.dirty:
+                session.dirty = False
+                spilled.append((session_id, session))
+        if not spilled:
+            return
+        future = self._run(self._write, [(session_id, session.history) for session_id, session in spilled])
+        for session_id, session in spilled:
+            self._spilling[session_id] = (session, future)
+        future.add_done_callback(lambda done: self._spilled(done, spilled))
+
+    def _spilled(self, future: asyncio.Future, spilled):
+        """写入完成：移出等待列表；写入失败时把会话放回内存，之后再次换出时重试"""
+        failed = future.cancelled() or future.exception() is not None
+        if failed:
+            error("SessionManager", f"会话写入磁盘失败: {future.exception() if not future.cancelled() else '已取消'}")
+        for session_id, session in spilled:
+            entry = self._spilling.get(session_id)
+            if entry is None or entry[0] is not session:
+                continue
+            del self._spilling[session_id]
+            if failed:
+                session.dirty = True
+                self._hot[session_id] = session
+
+    @asynccontextmanager
+    async def session(self, session_id: str):
+        """
+        独占使用一个会话的对话历史：
+            async with manager.session(user_id) as history:
+                async for chunk in deepseek.generate_response(text, history=history): ...
+        """
+        session = await self._get(session_id)
+        try:
+            async with session.lock:
+                try:
+                    yield session.history
+                finally:
+                    session.dirty = True
+        finally:
+            session.users -= 1
+            self._evict()
+
+    async def reset(self, session_id: str):
+        """
+        清空一个会话。与普通请求一样先取得会话（在磁盘上时载入），等待之前的请求结束后
+        在原会话对象上换成空的历史，已在排队的请求随后看到的是清空后的会话
+        """
+        session = await self._get(session_id)
+        try:
+            async with session.lock:
+                session.history = self.history_factory()
+                session.history.conversation = session_id
+                session.dirty = False
+                # 删除排在之前换出的写入之后执行
+                await self._run(self._delete, session_id)
+        finally:
+            session.users -= 1
+            self._evict()
+
+    def flush(self):
+        """把内存中有改动的会话写入磁盘，等待之前的写入与本次写入完成后返回"""
+        items = []
+        for session_id, session in self._hot.items():
+            if session.dirty:
+                session.dirty = False
+                items.append((session_id, session.history))
+        self._writer.submit(self._write, items).result()
+
+    def close(self):
+        self.flush()
+        self._writer.shutdown()
+        self._db.close()
+        log("SessionManager", f"会话已保存: 内存命中{self.hits}次, 磁盘载入{self.loads}次, 换出{self.spills}次")
+
+
+if __name__ == "__main__":
+    # 测试：1万个会话各进行若干轮对话后，内存占用是否保持平稳；同一会话串行、不同会话并发
+    # python session_manager.py [会话数] [内存中会话上限]
+    import gc
+    import sys
+    import tempfile
+
+    import psutil
+
+    from deepseek import Deepseek
+
+    sessions = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    max_hot = int(sys.argv[2]) if len(sys.argv) > 2 else 256
+    deepseek = Deepseek()
+    process = psutil.Process()
+    reply = "{light blue hair, cat ear, smile}" + "好呀主人，我们去公园吧喵～" * 8
+
+    def rss_mb():
+        gc.collect()
+        return process.memory_info().rss / 1024 ** 2
+
+    async def fake_turn(history, text):
+        # 与Deepseek.chat相同的历史操作，不请求Ollama
+        history.add_user(text)
+        history.trim()
+        await asyncio.sleep(0)
+        history.add_assistant(reply)
+
+    async def fill(manager, turns=3):
+        for turn in range(turns):
+            for index in range(sessions):
+                async with manager.session(f"user{index}") as history:
+                    await fake_turn(history, f"第{turn}轮: 主人好")
+
+    async def concurrency(manager):
+        """同一会话的两个请求不能交错，不同会话的请求同时进行"""
+        active = {}
+        overlaps = {"same": 0, "cross": 0}
+
+        async def request(session_id):
+            async with manager.session(session_id) as history:
+                if active.get(session_id):
+                    overlaps["same"] += 1
+                if any(count for other, count in active.items() if other != session_id):
+                    overlaps["cross"] += 1
+                active[session_id] = active.get(session_id, 0) + 1
+                await asyncio.sleep(0.01)
+                await fake_turn(history, "并发")
+                active[session_id] -= 1
+
+        await asyncio.gather(*(request(f"user{index % 4}") for index in range(40)))
+        return overlaps
+
+    async def stall(path, count=64):
+        """换出长对话时事件循环的最长停顿：另一个协程每1ms醒来一次（相当于其他会话的流式输出），记录最大延迟"""
+        manager = SessionManager(deepseek.new_history, path, max_hot=4)
+        long_reply = reply * 40
+        lateness = []
+        running = True
+
+        async def ticker():
+            while running:
+                start = time.perf_counter()
+                await asyncio.sleep(0.001)
+                lateness.append(time.perf_counter() - start - 0.001)
+
+        task = asyncio.create_task(ticker())
+        for turn in range(3):
+            for index in range(count):
+                async with manager.session(f"long{index}") as history:
+                    history.add_user(f"第{turn}轮: 主人好")
+                    history.add_assistant(long_reply)
+                await asyncio.sleep(0)
+        running = False
+        await task
+        manager.close()
+        lateness.sort()
+        return lateness[len(lateness) // 2], lateness[-1]
+
+    async def in_use():
+        """内存已满且其余会话都在使用时，新建的会话不能被立即换出；清空会话要等当前请求结束"""
+        manager = SessionManager(deepseek.new_history, ":memory:", max_hot=1)
+        async with manager.session("a") as history:
+            async with manager.session("b") as other:
+                assert "b" in manager._hot
+                await fake_turn(other, "主人好")
+            reset = asyncio.create_task(manager.reset("a"))
+            await fake_turn(history, "主人好")
+            await asyncio.sleep(0.01)
+            assert not reset.done()
+        await reset
+        async with manager.session("a") as history:
+            assert len(history) == 1
+        async with manager.session("b") as history:
+            assert len(history) == 3
+        manager.close()
+
+    async def main():
+        with tempfile.TemporaryDirectory() as tmp:
+            baseline = rss_mb()
+            unbounded = SessionManager(deepseek.new_history, os.path.join(tmp, "unbounded.db"), max_hot=sessions)
+            start = time.perf_counter()
+            await fill(unbounded)
+            print(f"全部在内存: {sessions}个会话, RSS +{rss_mb() - baseline:.1f}MB, "
+                  f"{(time.perf_counter() - start) / sessions / 3 * 1e6:.0f}us/轮")
+            unbounded.close()
+            del unbounded
+
+            baseline = rss_mb()
+            manager = SessionManager(deepseek.new_history, os.path.join(tmp, "sessions.db"), max_hot=max_hot)
+            start = time.perf_counter()
+            await fill(manager)
+            print(f"LRU {max_hot}: {sessions}个会话, RSS +{rss_mb() - baseline:.1f}MB, "
+                  f"{(time.perf_counter() - start) / sessions / 3 * 1e6:.0f}us/轮, 内存中{manager.hot_count}个, "
+                  f"载入{manager.loads}次, 换出{manager.spills}次, "
+                  f"磁盘 {os.path.getsize(os.path.join(tmp, 'sessions.db')) / 1024 ** 2:.1f}MB")
+            async with manager.session("user0") as history:
+                assert len(history) == 7 and history.messages()[0]['role'] == 'system'
+            print(f"并发测试: {await concurrency(manager)}")
+            manager.close()
+            p50, worst = await stall(os.path.join(tmp, "long.db"))
+            print(f"换出长对话时事件循环的延迟: p50 {p50 * 1e3:.2f}ms, 最大 {worst * 1e3:.2f}ms")
+            await in_use()
+
+    asyncio.run(main())
@@ -1,24 +1,173 @@
 import asyncio
 import os
-import json
+import time
+from contextlib import aclosing
 import aiohttp
-from datetime import datetime
 from typing import AsyncGenerator, Generator, Dict, List, Any
 
-from utils.p4_utils import save
+from chat_history import ChatHistory, estimate_tokens
+from journal import ConversationJournal
+from llm_events import TextDelta, ThinkingDelta, PromptTag, Usage
+from log_utils import log, error
+from rate_governor import CircuitOpen, RateGovernor
+from sse import SSEParser, loads
+from tag_scanner import TagScanner
+from thinking_budget import ThinkingBudget
+
+
+class MessageStream:
+    """
+    一次流式响应（Messages API的SSE）的解析状态
+
+    原始字节交给SSEParser拆分事件，再按事件类型、delta类型查表分派；
+    表中没有的事件（ping等）不解码JSON。输出TextDelta、ThinkingDelta、PromptTag事件，
+    thinking=False时不创建ThinkingDelta。
+    """
+    __slots__ = ("parser", "scanner", "thinking", "text_parts", "thinking_blocks", "error", "usage",
+                 "_thinking", "_signature")
+
+    def __init__(self, thinking=True):
+        self.parser = SSEParser()
+        self.scanner = TagScanner(think_tags=False)  # 思考内容单独给出，正文中只需提取{...}
+        self.thinking = thinking
+        self.text_parts = []  # 正文片段，结束时一次拼接
+        self.thinking_blocks = []  # 完整的思考块（含签名），下一轮请求需要原样发回
+        self.error = None  # 流中的error事件
+        self.usage = {}  # message_start与message_delta中的usage，含缓存读写的token数
+        self._thinking = None  # 正在接收的思考块片段
+        self._signature = ""
+
+    @property
+    def text(self) -> str:
+        return "".join(self.text_parts)
+
+    @property
+    def started(self) -> bool:
+        """是否已收到思考或正文"""
+        return bool(self.text_parts or self._thinking or self.thinking_blocks)
+
+    def feed(self, chunk: bytes) -> list:
+        """解析一段原始字节，返回需要输出给调用方的事件"""
+        output = []
+        for event, data in self.parser.feed(chunk):
+            handler = self.EVENT_HANDLERS.get(event)
+            if handler is not None:
+                handler(self, loads(data), output)
+        return output
+
+    def finish(self) -> list:
+        """流结束时处理最后一个没有以空行结尾的事件"""
+        output = []
+        for event, data in self.parser.flush():
+            handler = self.EVENT_HANDLERS.get(event)
+            if handler is not None:
+                handler(self, loads(data), output)
+        output += self.scanner.flush()
+        return output
+
+    def _message_start(self, data, output):
+        self.usage.update(data['message'].get('usage') or {})
+
+    def _message_delta(self, data, output):
+        self.usage.update(data.get('usage') or {})
+
+    def _block_start(self, data, output):
+        if data['content_block']['type'] == 'thinking':
+            self._thinking = []
+            self._signature = ""
+
+    def _block_delta(self, data, output):
+        delta = data['delta']
+        handler = self.DELTA_HANDLERS.get(delta['type'])
+        if handler is not None:
+            handler(self, delta, output)
+
+    def _block_stop(self, data, output):
+        if self._thinking:
+            self.thinking_blocks.append(
+                {'type': 'thinking', 'thinking': "".join(self._thinking), 'signature': self._signature})
+        self._thinking = None
+
+    def _error(self, data, output):
+        self.error = data.get('error', {})
+        error("Sonnet", f"流式响应中的错误: {self.error}")
+        output.append(TextDelta(f"API错误: {self.error.get('type', 'error')}"))
+
+    def _thinking_delta(self, delta, output):
+        thinking = delta['thinking']
+        if self._thinking is not None:
+            self._thinking.append(thinking)
+        if thinking and self.thinking:
+            output.append(ThinkingDelta(thinking))
+
+    def _signature_delta(self, delta, output):
+        self._signature = delta['signature']
+
+    def _text_delta(self, delta, output):
+        text = delta['text']
+        if text:
+            self.text_parts.append(text)
+            output += self.scanner.feed(text)
+
+    EVENT_HANDLERS = {
+        'message_start': _message_start,
+        'message_delta': _message_delta,
+        'content_block_start': _block_start,
+        'content_block_delta': _block_delta,
+        'content_block_stop': _block_stop,
+        'error': _error,
+    }
+    DELTA_HANDLERS = {
+        'thinking_delta': _thinking_delta,
+        'signature_delta': _signature_delta,
+        'text_delta': _text_delta,
+    }
+
+
+def content_tokens(content) -> int:
+    """估算消息内容的token数，content为字符串或内容块列表；之前轮次的思考块不计入输入，不统计"""
+    if isinstance(content, str):
+        return estimate_tokens(content)
+    return sum(estimate_tokens(block['text']) for block in content if block['type'] == 'text')
 
-def log(prefix, message):
-    timestamp = datetime.now().strftime("%H:%M:%S.%f")[:-3]
-    print(f"[{timestamp}] [{prefix}] {message}")
 
 class Sonnet:
-    def __init__(self):
+    def __init__(self, api_key=None, base_url=None, journal=None, conversation="chat",
+                 max_connections=8, connect_timeout=10, read_timeout=120, ssl_context=None,
+                 prompt_cache=True, max_history_tokens=0, governor=None, thinking_budget=None,
+                 fast_tags=False, fast_tag_tokens=100):
+        """
+        Args:
+            api_key: API密钥，为None时读取key.txt，不存在时使用环境变量ANTHROPIC_API_KEY
+            base_url: API地址（如替身服务器http://127.0.0.1:8080），为None时使用环境变量ANTHROPIC_BASE_URL或官方地址
+            journal: 保存对话的ConversationJournal，为None时使用本目录下的conversations.db
+            conversation: 默认的对话历史在日志中的名称，SessionManager的会话记在各自的会话id下
+            max_connections: 连接池上限
+            connect_timeout: 建立连接（含TLS握手）的超时秒数
+            read_timeout: 流式响应中两次读取之间的最长等待秒数，不限制整个回复的总时长
+            ssl_context: 自定义证书校验（如信任替身服务器的自签名证书），None时使用系统证书
+            prompt_cache: 把系统提示词与之前的对话标记为可缓存（cache_control），之后的请求只处理新增部分
+            max_history_tokens: 多轮对话的历史预算，超出时一次删到一半；0表示每轮结束后清空对话（原先的行为）
+            governor: RateGovernor，负责速率限制、重试与断路器；使用同一个API密钥的多个实例应共享同一个
+            thinking_budget: ThinkingBudget，按轮选择思考预算与max_tokens；
+                ThinkingBudget(fixed_budget=16000)为原先的固定设置
+            fast_tags: 启用思考的轮次在开始时同时发出一个不思考、只输出外貌tag的小请求，
+                图像生成不必等到思考结束；每轮多一次请求（系统提示词与历史可命中缓存）
+            fast_tag_tokens: tag请求的max_tokens
+        """
         # 读取API密钥
-        key_path = os.path.join(os.path.dirname(__file__), "key.txt")
-        with open(key_path, 'r') as f:
-            self.api_key = f.read().strip()
+        if api_key is None:
+            key_path = os.path.join(os.path.dirname(__file__), "key.txt")
+            if os.path.exists(key_path):
+                with open(key_path, 'r') as f:
+                    api_key = f.read().strip()
+            else:
+                api_key = os.environ.get("ANTHROPIC_API_KEY", "")
+        self.api_key = api_key
 
-        self.api_base_url = "https://api.anthropic.com/v1/messages"
+        base_url = base_url or os.environ.get("ANTHROPIC_BASE_URL", "https://api.anthropic.com")
+        self.api_base_url = base_url.rstrip("/") + "/v1/messages"
+        self.model = "claude-3-7-sonnet-20250219"
         self.headers = {
             "x-api-key": self.api_key,
             "anthropic-version": "2023-06-01",
@@ -44,168 +193,444 @@ class Sonnet:
             5. 输出时仅输出冒号后面的value，不要输出冒号前面的key，并且不要在{}内输出中文
             6. 请尽可能加快输出速度，不要输出think模块的内容"""
 
-        self.messages = []  # 用于存储对话历史
-        self.messages.append({
-            'role': 'system',
-            'content': self.init_content
-        })
+        # 系统提示词只构造一次，每轮请求直接引用
+        self.prompt_cache = prompt_cache
+        if prompt_cache:
+            self.system = [{'type': 'text', 'text': self.init_content, 'cache_control': {'type': 'ephemeral'}}]
+        else:
+            self.system = self.init_content
 
-        # 存储思考块
-        self.thinking_blocks = []
+        # 对话历史直接保存为Messages API的格式，每轮只追加新消息，不再重新遍历整个历史
+        # 与Deepseek的会话模式相同，超出预算时一次删到一半，之后多轮对话的缓存前缀保持不变
+        self.max_history_tokens = max_history_tokens
+        self.history = self.new_history()
 
-    def _init_system(self):
+        # 最近结束的一轮的思考块与token用量（含缓存读写），仅供调试；多会话并发时以各轮的Usage为准
+        self.thinking_blocks = []
+        self.last_stats = {}
+
+        # 复用的HTTP连接池，首次请求时在常驻事件循环中创建，见_get_session
+        self.session = None
+        self.max_connections = max_connections
+        self.timeout = aiohttp.ClientTimeout(total=None, connect=connect_timeout, sock_read=read_timeout)
+        self.ssl_context = ssl_context
+        self.governor = governor or RateGovernor()
+        self.thinking_budget = thinking_budget or ThinkingBudget()
+        self.fast_tags = fast_tags
+        self.fast_tag_tokens = fast_tag_tokens
+
+        # 每轮对话追加写入日志，写盘在后台线程中进行
+        self.journal = journal or ConversationJournal()
+        self.conversation = conversation
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        """
+        获取复用的ClientSession
+        首次请求时在常驻事件循环中创建，之后每轮对话复用keep-alive连接，不再重复DNS解析与TLS握手
+        """
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit=self.max_connections, keepalive_timeout=60,
+                                             ttl_dns_cache=300,
+                                             ssl=self.ssl_context if self.ssl_context is not None else True)
+            self.session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+        return self.session
+
+    async def aclose(self):
+        """关闭复用的HTTP连接，必须在创建连接池的事件循环中调用"""
+        if self.session is not None:
+            session, self.session = self.session, None
+            await session.close()
+            log("Sonnet", "已关闭HTTP连接池")
+
+    def new_history(self) -> ChatHistory:
+        """创建Messages API格式的对话历史，供SessionManager为每个会话创建独立的历史"""
+        return ChatHistory(self.init_content, max_tokens=self.max_history_tokens or 1 << 30,
+                           count_tokens=content_tokens, trim_to=self.max_history_tokens // 2)
+
+    @property
+    def messages(self):
+        return self.history.messages()
+
+    def _init_system(self, history: ChatHistory = None):
         """初始化系统设置"""
-        self.messages = [{'role': 'system', 'content': self.init_content}]
-        self.thinking_blocks = []  # 清空思考块
+        (self.history if history is None else history).reset()
         log("Sonnet", "重置系统消息")
 
-    async def generate_response(self, prompt: str) -> AsyncGenerator[str, None]:
-        """使用Sonnet API生成响应"""
+    def _add_user(self, history: ChatHistory, prompt: str):
+        """追加用户消息；启用缓存时把缓存断点从上一条用户消息移到这一条，之前的前缀在服务端已有缓存"""
+        if not self.prompt_cache:
+            history.add_user(prompt)
+            return
+        # 断点保存在历史本身中，每个会话的历史各自移动自己的断点
+        for message in reversed(history.turns):
+            if message['role'] == 'user':
+                if type(message['content']) is list:
+                    message['content'][-1].pop('cache_control', None)
+                break
+        history.add_user([{'type': 'text', 'text': prompt, 'cache_control': {'type': 'ephemeral'}}])
+
+    @staticmethod
+    def _drop_unanswered(history: ChatHistory):
+        """请求失败或被取消时删除未得到回复的用户消息，保持user/assistant交替"""
+        if history.turns and history.turns[-1]['role'] == 'user':
+            history.pop()
+
+    @staticmethod
+    def _usage_stats(usage: dict) -> dict:
+        """把API返回的usage转换为本轮的统计"""
+        stats = {
+            'llm_input_tokens': usage.get('input_tokens', 0),
+            'llm_cache_read_tokens': usage.get('cache_read_input_tokens') or 0,
+            'llm_cache_write_tokens': usage.get('cache_creation_input_tokens') or 0,
+            'llm_output_tokens': usage.get('output_tokens', 0),
+        }
+        log("Sonnet", f"token用量: {stats}")
+        return stats
+
+    async def _request_tags(self, session, history: ChatHistory):
+        """
+        不思考、只输出外貌tag的请求：在历史之后预填"{"作为助手回复的开头，遇到"}"停止
+        返回tag文本，失败时返回None（本轮改用正式回复中的tag）
+        """
+        payload = {
+            "model": self.model,
+            "messages": history.turns + [{'role': 'assistant', 'content': '{'}],
+            "system": self.system,
+            "stream": True,
+            "max_tokens": self.fast_tag_tokens,
+            "stop_sequences": ["}"],
+        }
+        try:
+            response = await self.governor.call(
+                lambda: session.post(self.api_base_url, headers=self.headers, json=payload),
+                input_tokens=history.total_tokens)
+            async with response:
+                if response.status != 200:
+                    error("Sonnet", f"tag请求失败: {response.status}")
+                    return None
+                stream = MessageStream(thinking=False)
+                async for chunk in response.content.iter_any():
+                    stream.feed(chunk)
+                stream.finish()
+        except Exception as e:
+            error("Sonnet", f"tag请求失败: {e!r}")
+            return None
+        tags = stream.text.strip().strip("{}").strip()
+        return tags or None
+
+    @staticmethod
+    async def _read_with_tags(content, tags_task):
+        """读取响应的字节块，同时等待tag请求：tag请求完成时输出其结果（str），之后只输出字节块"""
+        chunks = content.iter_any()
+        read = None
+        try:
+            while True:
+                if read is None:
+                    read = asyncio.ensure_future(chunks.__anext__())
+                if tags_task is not None and not read.done():
+                    await asyncio.wait((read, tags_task), return_when=asyncio.FIRST_COMPLETED)
+                    if tags_task.done():
+                        task, tags_task = tags_task, None
+                        tags = None if task.cancelled() else task.result()
+                        if tags:
+                            yield tags
+                        continue
+                try:
+                    chunk = await read
+                except StopAsyncIteration:
+                    return
+                read = None
+                yield chunk
+        finally:
+            if read is not None:
+                read.cancel()
+
+    async def generate_response(self, prompt: str, history: ChatHistory = None) -> AsyncGenerator[str, None]:
+        """只输出正文的文本接口，{...}提示词按原样输出，不包含思考内容"""
+        async with aclosing(self.generate_events(prompt, history, thinking=False)) as events:
+            async for event in events:
+                event_type = type(event)
+                if event_type is TextDelta:
+                    yield event.text
+                elif event_type is PromptTag:
+                    yield f"{{{event.prompt}}}"
+
+    async def generate_events(self, prompt: str, history: ChatHistory = None,
+                              thinking=True) -> AsyncGenerator[object, None]:
+        """
+        使用Sonnet API生成响应，输出TextDelta、ThinkingDelta、PromptTag事件，结束时输出Usage
+        history为None时使用默认的对话历史；thinking=False时不输出思考内容（模型仍会思考）
+        启用fast_tags时每轮只输出一个PromptTag：tag请求先完成时使用其结果，正式回复中的tag不再输出
+        """
+        if history is None:
+            history = self.history
         log("Sonnet", f"请求生成响应，提示词: '{prompt}'")
 
-        # 将用户输入添加到对话历史
-        self.messages.append({
-            'role': 'user',
-            'content': prompt
-        })
-
-        # 准备API请求
-        anthropic_messages = []
-        for msg in self.messages:
-            if msg['role'] == 'system':
-                continue  # 系统消息需要单独处理
-
-            # 如果是助手消息且有思考块，需要添加思考块
-            if msg['role'] == 'assistant' and hasattr(self, 'thinking_blocks') and self.thinking_blocks:
-                content = []
-                # 添加思考块
-                for block in self.thinking_blocks:
-                    content.append(block)
-                # 添加文本内容
-                content.append({"type": "text", "text": msg['content']})
-                anthropic_messages.append({
-                    'role': 'assistant',
-                    'content': content
-                })
-            else:
-                anthropic_messages.append({
-                    'role': 'user' if msg['role'] == 'user' else 'assistant',
-                    'content': msg['content']
-                })
+        # 按输入与之前的对话长度选择本轮的思考预算，简短的输入不思考
+        # 上一轮的预算按会话保存在历史中，共享实例的其他会话不影响这段对话的消息缓存
+        plan = self.thinking_budget.choose(prompt, history.total_tokens, history.last_thinking_budget)
+        history.last_thinking_budget = plan.budget
 
-        # Claude需要将系统消息单独传递
-        system_message = next((msg['content'] for msg in self.messages if msg['role'] == 'system'), None)
+        # 将用户输入添加到对话历史，超出预算时一次删除一大块最早的对话
+        self._add_user(history, prompt)
+        trimmed = history.trim()
+        if trimmed:
+            log("Sonnet", f"对话历史超出预算，删除了{trimmed}条最早的消息")
 
+        # 系统提示词与历史消息都是已构造好的对象，这里只引用，不复制
         payload = {
-            "model": "claude-3-7-sonnet-20250219",
-            "messages": anthropic_messages,
-            "system": system_message,
+            "model": self.model,
+            "messages": history.turns,
+            "system": self.system,
             "stream": True,
-            "max_tokens": 32000,  # 增大token输出限制
-            "thinking": {
-                "type": "enabled",
-                "budget_tokens": 16000  # 设置扩展思考预算
-            }
+            **plan.payload(),
         }
 
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                self.api_base_url,
-                headers=self.headers,
-                json=payload
-            ) as response:
+        completed = False
+        session = self._get_session()
+        start = time.perf_counter()
+        first_token = None
+        tag_seconds = None
+        tags_task = None
+        if self.fast_tags and plan.budget:
+            # 不思考时正式回复的开头就是tag，不需要额外的请求
+            tags_task = asyncio.create_task(self._request_tags(session, history))
+        try:
+            try:
+                # 按速率限制的节奏发出请求，429/529/5xx与连接错误在收到第一个字节前重试
+                response = await self.governor.call(
+                    lambda: session.post(self.api_base_url, headers=self.headers, json=payload),
+                    input_tokens=history.total_tokens)
+            except CircuitOpen as e:
+                error("Sonnet", str(e))
+                yield TextDelta(f"API错误: {str(e)}")
+                return
+            async with response:
                 if response.status != 200:
                     error_text = await response.text()
-                    log("Sonnet", f"API错误: {response.status}, {error_text}")
-                    yield f"API错误: {response.status}"
+                    error("Sonnet", f"API错误: {response.status}, {error_text}")
+                    yield TextDelta(f"API错误: {response.status}")
                     return
 
                 # 收集助手的回复
-                assistant_message = {'role': 'assistant', 'content': ''}
-                current_thinking_block = None
-                self.thinking_blocks = []  # 清空旧的思考块
-
-                # 处理流式响应
-                async for line in response.content:
-                    line = line.decode('utf-8').strip()
-                    if not line:
+                stream = MessageStream(thinking)
+                source = response.content.iter_any() if tags_task is None else \
+                    self._read_with_tags(response.content, tags_task)
+                async for chunk in source:
+                    if type(chunk) is str:
+                        # tag请求先于正式回复给出了tag
+                        if tag_seconds is None:
+                            tag_seconds = time.perf_counter() - start
+                            log("Sonnet", f"tag请求完成，{tag_seconds:.2f}s")
+                            yield PromptTag(chunk)
                         continue
-
-                    if line.startswith('data:'):
-                        line = line[5:].strip()
-                        if line == '[DONE]':
-                            break
-
-                        try:
-                            data = json.loads(line)
-
-                            # 处理不同类型的事件
-                            if data.get('type') == 'message_start':
+                    events = stream.feed(chunk)
+                    if first_token is None and stream.started:
+                        first_token = time.perf_counter() - start
+                    for event in events:
+                        if type(event) is PromptTag:
+                            if tag_seconds is not None:
                                 continue
-
-                            elif data.get('type') == 'content_block_start':
-                                block_type = data.get('content_block', {}).get('type')
-                                if block_type == 'thinking':
-                                    # 开始处理思考块
-                                    current_thinking_block = {
-                                        'type': 'thinking',
-                                        'thinking': '',
-                                        'signature': ''
-                                    }
-
-                            elif data.get('type') == 'content_block_delta':
-                                delta_type = data.get('delta', {}).get('type')
-
-                                if delta_type == 'thinking_delta':
-                                    # 思考块增量
-                                    thinking_content = data.get('delta', {}).get('thinking', '')
-                                    if current_thinking_block is not None:
-                                        current_thinking_block['thinking'] += thinking_content
-                                    # 将思考内容转为<think>内容</think>格式，输出给调用方
-                                    if thinking_content:
-                                        yield f"<think>{thinking_content}</think>"
-
-                                elif delta_type == 'signature_delta':
-                                    # 思考块签名增量
-                                    signature = data.get('delta', {}).get('signature', '')
-                                    if current_thinking_block is not None:
-                                        current_thinking_block['signature'] = signature
-
-                                elif delta_type == 'text_delta':
-                                    # 文本内容增量
-                                    content = data.get('delta', {}).get('text', '')
-                                    if content:
-                                        assistant_message['content'] += content
-                                        yield content
-
-                            elif data.get('type') == 'content_block_stop':
-                                # 内容块结束
-                                if current_thinking_block is not None and current_thinking_block['thinking']:
-                                    self.thinking_blocks.append(current_thinking_block)
-                                    current_thinking_block = None
-
-                            elif data.get('type') == 'message_stop':
-                                # 消息结束
-                                pass
-
-                        except json.JSONDecodeError as e:
-                            log("Sonnet", f"解析JSON出错: {e}, {line}")
-
-        # 将助手的完整回复添加到对话历史
-        self.messages.append(assistant_message)
-        log("Sonnet", f"完整回复添加到历史，当前长度: {len(self.messages)}")
-        save(self.messages, "chat")
-
-        # 重置系统消息
-        self._init_system()
+                            tag_seconds = time.perf_counter() - start
+                            if tags_task is not None:
+                                tags_task.cancel()
+                        yield event
+                for event in stream.finish():
+                    if type(event) is PromptTag:
+                        if tag_seconds is not None:
+                            continue
+                        tag_seconds = time.perf_counter() - start
+                    yield event
+                if stream.error is not None:
+                    return
+                # 本轮的思考块与统计只保存在局部变量中，同一实例上并发的其他会话不会覆盖
+                thinking_blocks = stream.thinking_blocks
+                stats = self._usage_stats(stream.usage)
+                # 记录本轮的预算与实际耗时，用于估计之后几轮的预算
+                elapsed = time.perf_counter() - start
+                thinking_tokens = sum(estimate_tokens(block['thinking']) for block in thinking_blocks)
+                self.thinking_budget.record(plan, elapsed, elapsed if first_token is None else first_token,
+                                            thinking_tokens, stats['llm_output_tokens'],
+                                            stats['llm_input_tokens'] + stats['llm_cache_write_tokens'])
+                stats.update(llm_thinking_budget=plan.budget, llm_thinking_tokens=thinking_tokens,
+                             llm_response_seconds=elapsed)
+                if tag_seconds is not None:
+                    stats['llm_tag_seconds'] = tag_seconds
+                reply = stream.text
+
+            # 将助手的完整回复添加到对话历史，思考块需要在下一轮原样发回
+            if thinking_blocks:
+                history.add_assistant(thinking_blocks + [{'type': 'text', 'text': reply}])
+            else:
+                history.add_assistant(reply)
+            log("Sonnet", f"完整回复添加到历史，当前长度: {len(history)}")
+            # 会话的历史带有会话id，各会话的对话分别记录，默认的历史记在self.conversation下
+            conversation = self.conversation if history.conversation is None else history.conversation
+            self.journal.append_turn(conversation, [{'role': 'user', 'content': prompt},
+                                                    {'role': 'assistant', 'content': reply}])
+
+            if not self.max_history_tokens:
+                # 重置系统消息
+                self._init_system(history)
+            completed = True
+            self.thinking_blocks = thinking_blocks
+            self.last_stats = stats
+            yield Usage(stats)
+        finally:
+            if tags_task is not None and not tags_task.done():
+                tags_task.cancel()
+            if not completed:
+                # 请求被取消或失败时丢弃本轮的用户消息，避免历史中出现未回复的消息
+                log("Sonnet", "响应未完成，删除本轮的用户消息")
+                self._drop_unanswered(history)
+
+    def close(self):
+        """写完尚未保存的对话并关闭日志"""
+        self.journal.close()
 
 
 if __name__ == "__main__":
-    # 测试代码
+    # python sonnet.py：请求真实API的简单测试
+    # python sonnet.py standin [轮数]：用启用TLS的本地替身服务器对比每轮新建连接与复用连接池的握手次数与首token延迟
+    # python sonnet.py cache [轮数]：多轮对话中关闭与启用提示词缓存时每轮的首token延迟与输入token费用
+    # python sonnet.py tags [轮数]：扩展思考时等待正式回复中的tag与并行发出tag请求，从用户输入到图像完成的时间
+    import sys
+    import tempfile
+    import time
+
     async def test():
         sonnet = Sonnet()
         async for chunk in sonnet.generate_response("你好，请介绍一下自己"):
             print(chunk, end="", flush=True)
         print("\n测试完成")
-
-    asyncio.run(test())
+        await sonnet.aclose()
+        sonnet.close()
+
+    async def run_turns(name, sonnet, server, turns, reuse):
+        server.reset_stats()
+        ttfts = []
+        start = time.perf_counter()
+        for turn in range(turns):
+            turn_start = time.perf_counter()
+            ttft = None
+            async for _ in sonnet.generate_response(f"第{turn}轮: 主人好"):
+                if ttft is None:
+                    ttft = time.perf_counter() - turn_start
+            ttfts.append(ttft)
+            if not reuse:
+                # 原先的做法：每轮新建并关闭ClientSession
+                await sonnet.aclose()
+        elapsed = time.perf_counter() - start
+        await sonnet.aclose()
+        ttfts.sort()
+        print(f"{name}: {turns}轮, TLS握手(TCP连接) {server.connections}次, 首token p50 {ttfts[len(ttfts) // 2] * 1e3:.1f}ms "
+              f"最大 {ttfts[-1] * 1e3:.1f}ms, 总耗时 {elapsed:.2f}s")
+
+    async def bench(server, turns):
+        from journal import ConversationJournal
+
+        with tempfile.TemporaryDirectory() as tmp:
+            journal = ConversationJournal(os.path.join(tmp, "conversations.db"))
+            for name, reuse in (("每轮新建连接", False), ("复用连接池", True)):
+                sonnet = Sonnet(api_key="standin", base_url=server.url, journal=journal,
+                                ssl_context=server.client_ssl_context())
+                await run_turns(name, sonnet, server, turns, reuse)
+            journal.close()
+
+    async def cache_bench(server, turns):
+        from journal import ConversationJournal
+
+        question = "主人今天想和你一起出去玩，你想去哪里呀？" * 5
+        # 相对于普通输入token的价格：写入缓存1.25倍，读取缓存0.1倍
+        prices = {'llm_input_tokens': 1.0, 'llm_cache_write_tokens': 1.25, 'llm_cache_read_tokens': 0.1}
+        with tempfile.TemporaryDirectory() as tmp:
+            journal = ConversationJournal(os.path.join(tmp, "conversations.db"))
+            for name, prompt_cache in (("不缓存", False), ("提示词缓存", True)):
+                server.prompt_cache.clear()
+                sonnet = Sonnet(api_key="standin", base_url=server.url, journal=journal,
+                                prompt_cache=prompt_cache, max_history_tokens=16000)
+                ttfts = []
+                cost = 0.0
+                read = 0
+                for turn in range(turns):
+                    turn_start = time.perf_counter()
+                    ttft = None
+                    async for _ in sonnet.generate_response(f"第{turn}轮: {question}"):
+                        if ttft is None:
+                            ttft = time.perf_counter() - turn_start
+                    ttfts.append(ttft)
+                    cost += sum(sonnet.last_stats[key] * price for key, price in prices.items())
+                    read += sonnet.last_stats['llm_cache_read_tokens']
+                await sonnet.aclose()
+                print(f"{name}: 首token 第1轮 {ttfts[0] * 1e3:.0f}ms, 第{turns // 2}轮 {ttfts[turns // 2 - 1] * 1e3:.0f}ms, "
+                      f"第{turns}轮 {ttfts[-1] * 1e3:.0f}ms; 最后一轮 {sonnet.last_stats}; "
+                      f"累计输入费用 {cost:.0f} (按普通输入token计), 缓存读取 {read} tokens")
+            journal.close()
+
+    async def tags_bench(server, turns):
+        from journal import ConversationJournal
+        from pipeline import ChatPipeline, ImageReady
+
+        sd_seconds = 2.0
+
+        def generate_images(prompt, cancel_event, preview_callback, timings, prompt_time):
+            time.sleep(sd_seconds)  # 模拟去噪
+            return [prompt]
+
+        def p50(values):
+            return sorted(values)[len(values) // 2]
+
+        with tempfile.TemporaryDirectory() as tmp:
+            journal = ConversationJournal(os.path.join(tmp, "conversations.db"))
+            print(f"替身: 思考3000tokens, 每秒输出1000tokens; 图像生成{sd_seconds:.1f}s")
+            for name, fast_tags in (("等待正式回复中的tag", False), ("并行的tag请求", True)):
+                server.reset_stats()
+                sonnet = Sonnet(api_key="standin", base_url=server.url, journal=journal, fast_tags=fast_tags,
+                                thinking_budget=ThinkingBudget(fixed_budget=16000))
+                pipeline = ChatPipeline(sonnet, generate_images)
+                marks = {"tag": [], "image": [], "reply": [], "turn": []}
+                for turn in range(turns):
+                    start = time.perf_counter()
+                    turn_marks = {}
+
+                    def on_event(event):
+                        if type(event) is PromptTag:
+                            turn_marks.setdefault("tag", time.perf_counter() - start)
+                        elif type(event) is ImageReady:
+                            turn_marks["image"] = time.perf_counter() - start
+
+                    timings = await pipeline.run_turn(f"第{turn}轮: 主人好", on_event, thinking=False)
+                    turn_marks["reply"] = timings['llm_response_seconds']
+                    turn_marks["turn"] = timings['turn_total_seconds']
+                    for key, value in turn_marks.items():
+                        marks[key].append(value)
+                await sonnet.aclose()
+                print(f"{name}: {turns}轮, 开始生成图像 p50 {p50(marks['tag']):.2f}s, 图像完成 p50 {p50(marks['image']):.2f}s, "
+                      f"回复结束 p50 {p50(marks['reply']):.2f}s, 每轮总耗时 p50 {p50(marks['turn']):.2f}s, "
+                      f"请求 {server.requests}次")
+            journal.close()
+
+    if len(sys.argv) > 1 and sys.argv[1] == "tags":
+        from standin_servers import AnthropicStandin, DEFAULT_REPLY, DEFAULT_TAGS, DEFAULT_THINKING, StreamProfile, \
+            split_tokens
+
+        turns = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+        script = [("thinking", token) for token in split_tokens(DEFAULT_THINKING * 100, max_size=1)[:3000]]
+        script += [("text", token) for token in split_tokens(f"{{{DEFAULT_TAGS}}}" + DEFAULT_REPLY * 3, seed=2)]
+        with AnthropicStandin(script, StreamProfile(token_rate=1000, first_token_delay=0.05)) as standin:
+            asyncio.run(tags_bench(standin, turns))
+    elif len(sys.argv) > 1 and sys.argv[1] == "cache":
+        from standin_servers import AnthropicStandin, StreamProfile
+
+        turns = int(sys.argv[2]) if len(sys.argv) > 2 else 30
+        # 每秒处理5000个输入token，未命中缓存的输入越多首token越晚
+        with AnthropicStandin(profile=StreamProfile(token_rate=0, prefill_rate=5000)) as standin:
+            asyncio.run(cache_bench(standin, turns))
+    elif len(sys.argv) > 1 and sys.argv[1] == "standin":
+        from standin_servers import AnthropicStandin, StreamProfile
+
+        turns = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+        with AnthropicStandin(profile=StreamProfile(token_rate=0), tls=True) as standin:
+            asyncio.run(bench(standin, turns))
+    else:
+        asyncio.run(test())
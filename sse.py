@@ -0,0 +1,253 @@
+import json
+
+try:
+    import orjson
+    loads = orjson.loads  # 可选依赖，安装后使用更快的JSON解码
+except ImportError:
+    orjson = None
+    loads = json.loads
+
+
+class SSEParser:
+    """
+    增量的Server-Sent Events解析器
+
+    直接处理网络读到的原始字节块（可以在事件、行甚至UTF-8字符中间断开），
+    以空行为界拆分事件，支持event字段、多行data、注释行以及\\r\\n与\\r换行。
+    data保持为bytes，由调用方按事件类型决定是否解码JSON，不需要的事件（如ping）不做任何解码。
+    """
+    __slots__ = ("_buffer", "last_event_id", "retry")
+
+    def __init__(self):
+        self._buffer = b""
+        self.last_event_id = None
+        self.retry = None  # 服务端建议的重连间隔（毫秒）
+
+    def feed(self, chunk: bytes) -> list:
+        """输入一段字节，返回其中完整事件的(事件类型, data字节)列表"""
+        if self._buffer:
+            chunk = self._buffer + chunk
+        if b"\r" in chunk:
+            # 末尾的\r可能是\r\n的前半，留到下一段再处理
+            tail = b"\r" if chunk.endswith(b"\r") else b""
+            if tail:
+                chunk = chunk[:-1]
+            chunk = chunk.replace(b"\r\n", b"\n").replace(b"\r", b"\n") + tail
+        end = chunk.rfind(b"\n\n")
+        if end < 0:
+            self._buffer = chunk
+            return []
+        self._buffer = chunk[end + 2:]
+        events = []
+        for block in chunk[:end].split(b"\n\n"):
+            event = self._parse(block)
+            if event is not None:
+                events.append(event)
+        return events
+
+    def flush(self) -> list:
+        """流结束时处理缓冲区中没有以空行结尾的最后一个事件"""
+        block, self._buffer = self._buffer.rstrip(b"\r\n"), b""
+        event = self._parse(block) if block else None
+        return [event] if event is not None else []
+
+    def _parse(self, block: bytes):
+        event = "message"
+        data = None
+        for line in block.split(b"\n"):
+            if not line or line[0] == 58:  # 空行或以":"开头的注释
+                continue
+            field, _, value = line.partition(b":")
+            if value[:1] == b" ":
+                value = value[1:]
+            if field == b"data":
+                data = value if data is None else data + b"\n" + value
+            elif field == b"event":
+                event = value.decode()
+            elif field == b"id":
+                self.last_event_id = value.decode()
+            elif field == b"retry" and value.isdigit():
+                self.retry = int(value)
+        if data is None:
+            return None
+        return event, data
+
+
+if __name__ == "__main__":
+    # 基准测试：回放一段约3万token的扩展思考流，对比每token的CPU耗时：
+    # 原先的逐行解析+<think>标记字符串+TagScanner重新扫描，与增量解析+查表分派+类型事件
+    # python sse.py [token数] [录制的token流.json]
+    import asyncio
+    import random
+    import sys
+    import time
+
+    from aiohttp.streams import StreamReader
+
+    import sonnet
+    from llm_events import TextDelta, ThinkingDelta, PromptTag
+    from sonnet import MessageStream
+    from tag_scanner import TagScanner
+    from standin_servers import AnthropicStandin, DEFAULT_REPLY, DEFAULT_TAGS, DEFAULT_THINKING, \
+        load_script, split_tokens
+
+    tokens = int(sys.argv[1]) if len(sys.argv) > 1 else 30000
+
+    def correctness():
+        """事件、行与UTF-8字符在任意位置被切断时结果不变"""
+        raw = ("event: a\r\ndata: {\"x\": \"喵\"}\r\n\r\n: 注释\n\nevent: b\ndata: 第一行\ndata:第二行\nid: 7\n\n"
+               "data: 无类型\rretry: 3000\r\r").encode()
+        expected = [("a", '{"x": "喵"}'.encode()), ("b", "第一行\n第二行".encode()), ("message", "无类型".encode())]
+        for step in range(1, len(raw) + 1):
+            parser = SSEParser()
+            events = []
+            for pos in range(0, len(raw), step):
+                events += parser.feed(raw[pos:pos + step])
+            events += parser.flush()
+            assert events == expected, (step, events)
+            assert parser.last_event_id == "7" and parser.retry == 3000
+        parser = SSEParser()
+        assert parser.feed(b"data: no newline") == [] and parser.flush() == [("message", b"no newline")]
+
+    def record_stream():
+        """按替身服务器的格式生成一段完整的SSE字节流，返回(字节流, token数)"""
+        if len(sys.argv) > 2:
+            script = load_script(sys.argv[2])
+        else:
+            # 思考约占5/6，片段平均2.5个字符，按每token 4个字符准备足够的文本
+            thinking = split_tokens(DEFAULT_THINKING * (tokens * 4 // len(DEFAULT_THINKING) + 1), seed=1)
+            text = split_tokens(f"{{{DEFAULT_TAGS}}}" + DEFAULT_REPLY * (tokens // len(DEFAULT_REPLY) + 1), seed=2)
+            script = [("thinking", token) for token in thinking[:tokens * 5 // 6]]
+            script += [("text", token) for token in text[:tokens - len(script)]]
+        event = AnthropicStandin._event
+        parts = [event("message_start", {"message": {"id": "msg_bench", "content": [], "usage": {}}}),
+                 event("ping", {})]
+        block_kind = None
+        for kind, token in script:
+            if kind != block_kind:
+                if block_kind == "thinking":
+                    parts.append(event("content_block_delta", {"index": 0, "delta": {
+                        "type": "signature_delta", "signature": "c3RhbmRpbi1zaWduYXR1cmU="}}))
+                if block_kind is not None:
+                    parts.append(event("content_block_stop", {"index": 0}))
+                block_kind = kind
+                block = {"type": "thinking", "thinking": ""} if kind == "thinking" else {"type": "text", "text": ""}
+                parts.append(event("content_block_start", {"index": 1, "content_block": block}))
+            delta = {"type": "thinking_delta", "thinking": token} if kind == "thinking" \
+                else {"type": "text_delta", "text": token}
+            parts.append(event("content_block_delta", {"index": 1, "delta": delta}))
+        parts.append(event("content_block_stop", {"index": 1}))
+        parts.append(event("message_delta", {"delta": {"stop_reason": "end_turn"}, "usage": {"output_tokens": 1}}))
+        parts.append(event("message_stop", {}))
+        return b"".join(parts), len(script)
+
+    class _Protocol:
+        """StreamReader需要的最小协议对象"""
+        _reading_paused = False
+
+        def pause_reading(self):
+            pass
+
+        def resume_reading(self, resume_parser=True):
+            pass
+
+    def make_reader(chunks):
+        """把字节块放入aiohttp的StreamReader，与真实响应的response.content相同"""
+        reader = StreamReader(_Protocol(), 2 ** 30, loop=asyncio.get_running_loop())
+        for chunk in chunks:
+            reader.feed_data(chunk)
+        reader.feed_eof()
+        return reader
+
+    async def legacy(reader):
+        """原先generate_response中的逐行解析，思考内容包装为<think>字符串后由TagScanner重新拆开"""
+        output = []
+        current_thinking_block = None
+        thinking_blocks = []
+        async for line in reader:
+            line = line.decode('utf-8').strip()
+            if not line:
+                continue
+            if line.startswith('data:'):
+                line = line[5:].strip()
+                data = json.loads(line)
+                if data.get('type') == 'message_start':
+                    continue
+                elif data.get('type') == 'content_block_start':
+                    if data.get('content_block', {}).get('type') == 'thinking':
+                        current_thinking_block = {'type': 'thinking', 'thinking': '', 'signature': ''}
+                elif data.get('type') == 'content_block_delta':
+                    delta_type = data.get('delta', {}).get('type')
+                    if delta_type == 'thinking_delta':
+                        thinking_content = data.get('delta', {}).get('thinking', '')
+                        if current_thinking_block is not None:
+                            current_thinking_block['thinking'] += thinking_content
+                        if thinking_content:
+                            output.append(f"<think>{thinking_content}</think>")
+                    elif delta_type == 'signature_delta':
+                        current_thinking_block['signature'] = data.get('delta', {}).get('signature', '')
+                    elif delta_type == 'text_delta':
+                        content = data.get('delta', {}).get('text', '')
+                        if content:
+                            output.append(content)
+                elif data.get('type') == 'content_block_stop':
+                    if current_thinking_block is not None and current_thinking_block['thinking']:
+                        thinking_blocks.append(current_thinking_block)
+                        current_thinking_block = None
+        scanner = TagScanner()
+        events = []
+        for chunk in output:
+            events += scanner.feed(chunk)
+        events += scanner.flush()
+        return events, thinking_blocks
+
+    async def incremental(reader, thinking=True):
+        stream = MessageStream(thinking)
+        events = []
+        async for chunk in reader.iter_any():
+            events += stream.feed(chunk)
+        events += stream.finish()
+        return events, stream.thinking_blocks
+
+    def summarize(result):
+        events, thinking_blocks = result
+        return ("".join(event.text for event in events if type(event) is TextDelta),
+                "".join(event.text for event in events if type(event) is ThinkingDelta),
+                [event.prompt for event in events if type(event) is PromptTag], thinking_blocks)
+
+    async def bench():
+        raw, count = record_stream()
+        # 按网络读取的大小切块，块边界随机落在事件、行与多字节字符中间
+        rng = random.Random(0)
+        chunks = []
+        pos = 0
+        while pos < len(raw):
+            size = rng.randint(16, 1024)
+            chunks.append(raw[pos:pos + size])
+            pos += size
+        print(f"回放: {count} token, {len(raw) / 1024:.0f}KB, {len(chunks)}个网络块")
+        fast = orjson.loads if orjson is not None else json.loads
+        runs = [("逐行解析+<think>字符串(json)", legacy, json.loads),
+                ("增量解析+类型事件(json)", incremental, json.loads)]
+        if orjson is not None:
+            runs.append(("增量解析+类型事件(orjson)", incremental, orjson.loads))
+        runs.append(("增量解析+类型事件, 不输出思考", lambda reader: incremental(reader, False), fast))
+        results = {}
+        for name, consume, decoder in runs:
+            sonnet.loads = decoder
+            best = None
+            for _ in range(5):
+                reader = make_reader(chunks)
+                start = time.process_time()
+                results[name] = summarize(await consume(reader))
+                elapsed = time.process_time() - start
+                best = elapsed if best is None else min(best, elapsed)
+            print(f"{name}: {best * 1e3:.1f}ms CPU, 每token {best / count * 1e6:.2f}us")
+        first = next(iter(results.values()))
+        assert first[1] and first[2]
+        for name, (visible, thinking, prompts, thinking_blocks) in results.items():
+            assert (visible, prompts, thinking_blocks) == (first[0], first[2], first[3]), name
+            assert thinking == (first[1] if "不输出思考" not in name else ""), name
+
+    correctness()
+    asyncio.run(bench())
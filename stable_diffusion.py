@@ -1,17 +1,40 @@
 import random
+import time
 from diffusers import StableDiffusionPipeline, StableDiffusionXLPipeline
 import torch
 import os
 
+from log_utils import log, debug, error
+
+
+class GenerationCancelled(Exception):
+    """图像生成在去噪过程中被取消"""
+
+
+# 潜空间到RGB的线性近似系数（4个latent通道 -> RGB），用于去噪过程中的低成本预览
+LATENT_RGB_FACTORS = {
+    "sdxl": ([[0.3651, 0.4232, 0.4341],
+              [-0.2533, -0.0042, 0.1068],
+              [0.1076, 0.1111, -0.0362],
+              [-0.3165, -0.2492, -0.2188]],
+             [0.1084, -0.0175, -0.0011]),
+    "sd15": ([[0.3512, 0.2297, 0.3227],
+              [0.3250, 0.4974, 0.2350],
+              [-0.2829, 0.1762, 0.2721],
+              [-0.2120, -0.2616, -0.7177]],
+             [0.0, 0.0, 0.0]),
+}
+
+
 class StableDiffusion:
-    def __init__(self, hf_token):
+    def __init__(self, hf_token=None):
         # 设置模型缓存目录
         self.cache_dir = os.path.join(os.path.dirname(__file__), "model_cache")
         os.makedirs(self.cache_dir, exist_ok=True)
 
         # 初始化模型
         self.device = "cuda" if torch.cuda.is_available() else "cpu"
-        print(self.device)
+        log("StableDiffusion", self.device)
         self.model = None
         self.is_sdxl = False
         self.hf_token = hf_token
@@ -29,7 +52,7 @@ class StableDiffusion:
         }
 
         if not self.load_model():
-            print("Load model failed")
+            error("StableDiffusion", "Load model failed")
             return
 
     def load_model(self, model_id="sdxl", clip_skip=2):
@@ -45,7 +68,7 @@ class StableDiffusion:
 
         try:
             self.is_sdxl = "sdxl" in selected_model.lower()
-            print(f"Loading model {model_id} on {self.device}...")
+            log("StableDiffusion", f"Loading model {model_id} on {self.device}...")
 
             if self.is_sdxl:
                 from diffusers import StableDiffusionXLPipeline
@@ -82,7 +105,7 @@ class StableDiffusion:
                     self.model.text_encoder_2.text_model.final_layer_norm = self.model.text_encoder_2.text_model.encoder.layers[-(clip_skip)].layer_norm2
                     self.model.text_encoder_2.text_model.last_hidden_state = self.model.text_encoder_2.text_model.encoder.layers[-(clip_skip)].mlp
 
-                    print(f"Clip Skip set to {clip_skip}")
+                    log("StableDiffusion", f"Clip Skip set to {clip_skip}")
             else:
                 self.model = StableDiffusionPipeline.from_pretrained(
                     self.ANIME_MODELS[selected_model],
@@ -98,10 +121,10 @@ class StableDiffusion:
                 self.model.enable_attention_slicing()
                 self.model.enable_vae_slicing()
 
-            print("Model loaded successfully!")
+            log("StableDiffusion", "Model loaded successfully!")
             return True
         except Exception as e:
-            print(f"Error loading model: {str(e)}")
+            error("StableDiffusion", f"Error loading model: {str(e)}")
             return False
 
     def load_lora(self, lora_path, alpha=0.75):
@@ -136,12 +159,12 @@ class StableDiffusion:
 
                 # 确保模型在正确的设备上
                 self.model.to(self.device)
-                print(f"LoRA model loaded from {lora_path} with alpha={alpha}")
+                log("StableDiffusion", f"LoRA model loaded from {lora_path} with alpha={alpha}")
             else:
                 raise NotImplementedError("LoRA loading for non-SDXL models not implemented")
 
         except Exception as e:
-            print(f"Error loading LoRA: {str(e)}")
+            error("StableDiffusion", f"Error loading LoRA: {str(e)}")
             raise
 
     def unload_lora(self):
@@ -153,7 +176,7 @@ class StableDiffusion:
 
         if self.is_sdxl:
             self.model.unload_lora_weights()
-            print("LoRA weights unloaded")
+            log("StableDiffusion", "LoRA weights unloaded")
 
     def generate_image(self,
                        prompt,
@@ -166,7 +189,12 @@ class StableDiffusion:
                        seed=None,
                        vae_batch_size=1,
                        tiling=False,
-                       clip_skip=2):
+                       clip_skip=2,
+                       output_type="pil",
+                       cancel_event=None,
+                       preview_callback=None,
+                       preview_every=0,
+                       timings=None):
         """
         生成图像
         Args:
@@ -178,6 +206,11 @@ class StableDiffusion:
             num_inference_steps: 推理步数
             guidance_scale: 提示词引导系数
             seed: 随机种子
+            output_type: 输出格式，"pil"返回PIL图片列表，"np"返回NHWC的float数组
+            cancel_event: threading.Event，被设置后在下一个去噪步结束时抛出GenerationCancelled
+            preview_callback: 预览回调preview_callback(step, images)，images为潜空间分辨率的NHWC uint8数组
+            preview_every: 每隔多少步生成一次预览，0表示不生成
+            timings: 传入dict时写入文本编码、去噪、VAE解码各阶段耗时（秒）
         Returns:
             生成的图片列表
         """
@@ -224,6 +257,38 @@ class StableDiffusion:
         if self.model is None:
             raise RuntimeError("Model not loaded. Please call load_model() first.")
 
+        if cancel_event is not None and cancel_event.is_set():
+            raise GenerationCancelled("图像生成在开始前被取消")
+
+        preview_enabled = preview_callback is not None and preview_every > 0
+        step_times = {"start": None, "last": None, "preview": 0.0}
+
+        def on_step_end(pipeline, step, timestep, callback_kwargs):
+            # 每个去噪步结束时检查是否需要取消
+            if cancel_event is not None and cancel_event.is_set():
+                raise GenerationCancelled(f"图像生成在第{step + 1}步被取消")
+
+            # 每preview_every步输出一次预览，最后一步由VAE解码出完整图像
+            if preview_enabled and (step + 1) % preview_every == 0 and step + 1 < num_inference_steps:
+                preview_start = time.perf_counter()
+                preview_callback(step + 1, self.latents_to_preview(callback_kwargs["latents"]))
+                step_times["preview"] += time.perf_counter() - preview_start
+
+            if timings is not None and step + 1 == num_inference_steps:
+                # 计时需要等待GPU上排队的计算完成
+                self._synchronize()
+            step_times["last"] = time.perf_counter()
+            if step_times["start"] is None:
+                step_times["start"] = step_times["last"]
+            return callback_kwargs
+
+        def on_denoise_start(module, args):
+            # UNet第一次前向之前即文本编码结束、去噪开始
+            if "denoise_start" not in step_times:
+                self._synchronize()
+                step_times["denoise_start"] = time.perf_counter()
+
+        hook = None
         try:
             # 设置随机种子
             torch.manual_seed(self.sd_seed)
@@ -239,9 +304,11 @@ class StableDiffusion:
 
             # 生成图像
             full_positive = prompt + default_anime_positive
-            print(f"正面提示词：{full_positive}")
+            debug("StableDiffusion", "正面提示词：%s", full_positive)
             full_negative = negative_prompt + default_anime_negative
-            print(f"负面提示词：{full_negative}")
+            debug("StableDiffusion", "负面提示词：%s", full_negative)
+            call_start = time.perf_counter()
+            hook = self.model.unet.register_forward_pre_hook(on_denoise_start) if timings is not None else None
             with torch.inference_mode(), torch.amp.autocast("cuda"):
                 output = self.model(
                     prompt=prompt + default_anime_positive,
@@ -252,7 +319,17 @@ class StableDiffusion:
                     num_inference_steps=num_inference_steps,
                     guidance_scale=guidance_scale,
                     generator=torch.manual_seed(seed) if seed is not None else None,
+                    output_type=output_type,
+                    callback_on_step_end=on_step_end,
                 )
+                if hook is not None:
+                    hook.remove()
+                    self._synchronize()
+                    call_end = time.perf_counter()
+                    if "denoise_start" in step_times and step_times["last"] is not None:
+                        timings["sd_text_encode_seconds"] = step_times["denoise_start"] - call_start
+                        timings["sd_denoise_seconds"] = step_times["last"] - step_times["denoise_start"]
+                        timings["sd_vae_decode_seconds"] = call_end - step_times["last"]
 
                 # 清理VRAM
                 if self.device == "cuda":
@@ -260,13 +337,61 @@ class StableDiffusion:
             # 获取生成的图片
             images = output.images
 
+            if preview_enabled and step_times["start"] is not None and step_times["last"] > step_times["start"]:
+                denoise_time = step_times["last"] - step_times["start"]
+                log("StableDiffusion", f"预览耗时: {step_times['preview'] * 1000:.1f}ms, "
+                                       f"占去噪时间的{step_times['preview'] / denoise_time * 100:.1f}%")
+
             # 返回生成的图片列表
             return images
 
+        except GenerationCancelled as e:
+            if hook is not None:
+                hook.remove()
+            log("StableDiffusion", str(e))
+            # 尽快释放被取消任务占用的显存
+            if self.device == "cuda":
+                torch.cuda.empty_cache()
+            raise
         except Exception as e:
-            print(f"Error generating image: {str(e)}")
+            if hook is not None:
+                hook.remove()
+            error("StableDiffusion", f"Error generating image: {str(e)}")
             return None
 
+    def warm_up(self, num_inference_steps=2):
+        """
+        用一次极短的去噪预热：触发CUDA kernel加载、cudnn自动调优与显存分配，首次真实生成不再承担这部分开销
+        使用与正式生成相同的分辨率，调优结果才能复用
+        """
+        if self.model is None:
+            return False
+        start = time.perf_counter()
+        images = self.generate_image("", num_inference_steps=num_inference_steps, output_type="np")
+        log("StableDiffusion", f"预热完成，耗时{time.perf_counter() - start:.2f}s")
+        return images is not None
+
+    def _synchronize(self):
+        """等待GPU计算完成，使计时准确"""
+        if self.device == "cuda":
+            torch.cuda.synchronize()
+
+    def latents_to_preview(self, latents):
+        """
+        用线性近似将潜变量直接映射为RGB预览，不经过VAE
+        Args:
+            latents: 形状为(N, 4, H/8, W/8)的潜变量
+        Returns:
+            形状为(N, H/8, W/8, 3)的uint8数组
+        """
+        factors, bias = LATENT_RGB_FACTORS["sdxl" if self.is_sdxl else "sd15"]
+        factors = torch.tensor(factors, dtype=torch.float32, device=latents.device)
+        bias = torch.tensor(bias, dtype=torch.float32, device=latents.device)
+        with torch.inference_mode():
+            rgb = torch.einsum("nchw,cr->nhwr", latents.float(), factors) + bias
+            rgb = ((rgb + 1) * 127.5).clamp(0, 255).to(torch.uint8)
+        return rgb.cpu().numpy()
+
     def save_images(self, images, output_dir="outputs", base_filename="generated", start_index=0):
         """
         保存生成的图片
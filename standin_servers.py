@@ -0,0 +1,550 @@
+import asyncio
+import hashlib
+import json
+import math
+import os
+import random
+import shutil
+import ssl
+import subprocess
+import tempfile
+import time
+from datetime import datetime, timezone
+from typing import List, Optional
+
+from aiohttp import web
+
+from chat_history import estimate_tokens
+from log_utils import log
+from loop_thread import EventLoopThread
+
+
+DEFAULT_THINKING = "主人在和我打招呼呢，我要用可爱的语气回应，并先给出描述外貌的tag。"
+DEFAULT_TAGS = "light blue hair, cat ear, opened, school uniform, pleated skirt, shy"
+DEFAULT_REPLY = "主人好呀喵～今天也要一起度过开心的一天哦！有什么想和我聊的吗？"
+
+
+def split_tokens(text: str, seed=0, min_size=1, max_size=4) -> List[str]:
+    """把文本随机切成1~4个字符的片段，模拟LLM的token流"""
+    rng = random.Random(seed)
+    tokens = []
+    pos = 0
+    while pos < len(text):
+        step = rng.randint(min_size, max_size)
+        tokens.append(text[pos:pos + step])
+        pos += step
+    return tokens
+
+
+def default_script(repeat=4) -> List[tuple]:
+    """默认的回放脚本，(类型, 片段)列表，类型为"thinking"或"text"""
+    thinking = [("thinking", token) for token in split_tokens(DEFAULT_THINKING * repeat, seed=1)]
+    text = [("text", token) for token in split_tokens(f"{{{DEFAULT_TAGS}}}" + DEFAULT_REPLY * repeat, seed=2)]
+    return thinking + text
+
+
+def load_script(path: str) -> List[tuple]:
+    """
+    读取录制的token流：JSON列表，元素为字符串（视为text）或[类型, 片段]
+    字符串中的<think>...</think>会被拆成thinking片段
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        items = json.load(f)
+    script = []
+    thinking = False
+    for item in items:
+        if isinstance(item, str):
+            kind = "thinking" if thinking else "text"
+            if "<think>" in item:
+                thinking = True
+                item = item.replace("<think>", "")
+                kind = "thinking"
+            if "</think>" in item:
+                thinking = False
+                item = item.replace("</think>", "")
+            if item:
+                script.append((kind, item))
+        else:
+            script.append((item[0], item[1]))
+    return script
+
+
+def self_signed_certificate(directory: str, host="127.0.0.1") -> tuple:
+    """用openssl命令行生成host的自签名证书，返回(证书路径, 私钥路径)"""
+    certfile = os.path.join(directory, "standin.crt")
+    keyfile = os.path.join(directory, "standin.key")
+    subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+                    "-keyout", keyfile, "-out", certfile, "-subj", f"/CN={host}",
+                    "-addext", f"subjectAltName=IP:{host}"],
+                   check=True, capture_output=True)
+    return certfile, keyfile
+
+
+class StreamProfile:
+    """
+    回放参数
+    token_rate: 每秒token数；jitter: 每个token间隔的随机浮动比例；first_token_delay: 首token前的等待（秒）
+    error_rate: 请求直接返回error_status的概率；disconnect_rate: 输出一半后断开连接的概率
+    prefill_rate: 每秒处理的输入token数，未命中提示词缓存的输入按此计算首token前的额外等待，0表示不模拟
+    error_script: 按请求顺序给出的状态码（如[529, 529, 200]），200表示正常输出，超出列表后按error_rate注入
+    rate_limit_requests / rate_limit_input_tokens: 每rate_limit_window秒的请求数与输入token上限（令牌桶），
+        超出时返回429与retry-after，0表示不限制；Anthropic替身在响应头中报告anthropic-ratelimit-*
+    """
+
+    def __init__(self, token_rate=50.0, jitter=0.0, first_token_delay=0.0,
+                 error_rate=0.0, error_status=500, disconnect_rate=0.0, seed=0, prefill_rate=0.0,
+                 error_script=None, rate_limit_requests=0, rate_limit_input_tokens=0, rate_limit_window=60.0):
+        self.token_rate = token_rate
+        self.jitter = jitter
+        self.first_token_delay = first_token_delay
+        self.prefill_rate = prefill_rate
+        self.error_script = error_script or []
+        self.rate_limit_requests = rate_limit_requests
+        self.rate_limit_input_tokens = rate_limit_input_tokens
+        self.rate_limit_window = rate_limit_window
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.disconnect_rate = disconnect_rate
+        self.seed = seed
+
+    def interval(self, rng) -> float:
+        if self.token_rate <= 0:
+            return 0.0
+        base = 1.0 / self.token_rate
+        if self.jitter:
+            base *= 1.0 + rng.uniform(-self.jitter, self.jitter)
+        return max(0.0, base)
+
+
+class StandinServer:
+    """
+    本地替身服务器的公共部分：在独立线程的事件循环中运行aiohttp应用，统计请求数与连接数
+
+    服务器与被测代码不共用事件循环，被测代码阻塞时服务器仍按设定的节奏输出。
+    tls=True时使用临时生成的自签名证书提供HTTPS，每个TCP连接对应一次TLS握手，
+    客户端需使用client_ssl_context()信任该证书。
+    """
+
+    name = "Standin"
+
+    def __init__(self, script=None, profile: Optional[StreamProfile] = None, tls=False):
+        self.script = script or default_script()
+        self.profile = profile or StreamProfile()
+        self.tls = tls
+        self.certfile = None
+        self.requests = 0
+        self.errors = 0
+        self.disconnects = 0
+        self.peers = set()  # 不同的客户端(地址, 端口)，即TCP连接数
+        self.bodies = []  # 收到的请求体，用于检查请求内容
+        self.url = None
+        self._loop_thread = None
+        self._runner = None
+        self._cert_dir = None
+
+    @property
+    def connections(self) -> int:
+        return len(self.peers)
+
+    def reset_stats(self):
+        self.requests = 0
+        self.errors = 0
+        self.disconnects = 0
+        self.peers.clear()
+        self.bodies.clear()
+
+    def _routes(self, app):
+        raise NotImplementedError
+
+    def _begin(self, request):
+        """记录一次请求，返回本次请求的随机数生成器、注入的错误状态码（0表示正常）与断开位置"""
+        self.peers.add(request.transport.get_extra_info("peername"))
+        rng = random.Random(self.profile.seed * 100003 + self.requests)
+        index = self.requests
+        self.requests += 1
+        error_status = self.profile.error_status if rng.random() < self.profile.error_rate else 0
+        if index < len(self.profile.error_script):
+            error_status = self.profile.error_script[index] if self.profile.error_script[index] != 200 else 0
+        disconnect_at = None
+        if rng.random() < self.profile.disconnect_rate:
+            disconnect_at = len(self.script) // 2
+        if error_status:
+            self.errors += 1
+        return rng, error_status, disconnect_at
+
+    async def _pace(self, rng, index):
+        """首token前等待first_token_delay，之后按token_rate与jitter等待"""
+        delay = self.profile.first_token_delay if index == 0 else 0.0
+        delay += self.profile.interval(rng)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def _disconnect(self, request):
+        self.disconnects += 1
+        request.transport.close()
+
+    async def _start(self, host, port, ssl_context):
+        app = web.Application()
+        self._routes(app)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port, ssl_context=ssl_context)
+        await site.start()
+        return site._server.sockets[0].getsockname()[1]
+
+    def start(self, host="127.0.0.1", port=0) -> str:
+        """在后台线程中启动服务器，返回基础URL"""
+        ssl_context = None
+        if self.tls:
+            self._cert_dir = tempfile.mkdtemp(prefix="standin-")
+            self.certfile, keyfile = self_signed_certificate(self._cert_dir, host)
+            ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+            ssl_context.load_cert_chain(self.certfile, keyfile)
+        self._loop_thread = EventLoopThread(self.name)
+        port = self._loop_thread.submit(self._start, host, port, ssl_context).result()
+        self.url = f"{'https' if self.tls else 'http'}://{host}:{port}"
+        log(self.name, f"替身服务器已启动: {self.url}")
+        return self.url
+
+    def client_ssl_context(self) -> Optional[ssl.SSLContext]:
+        """信任本服务器自签名证书的客户端SSLContext，未启用TLS时返回None"""
+        if not self.tls:
+            return None
+        return ssl.create_default_context(cafile=self.certfile)
+
+    def stop(self):
+        if self._loop_thread is None:
+            return
+        self._loop_thread.submit(self._runner.cleanup).result()
+        self._loop_thread.stop()
+        self._loop_thread = None
+        if self._cert_dir is not None:
+            shutil.rmtree(self._cert_dir, ignore_errors=True)
+            self._cert_dir = None
+
+    def __enter__(self):
+        if self._loop_thread is None:
+            self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+class OllamaStandin(StandinServer):
+    """Ollama /api/chat替身，NDJSON流式输出，思考内容以<think>...</think>包在content中（与deepseek-r1相同）"""
+
+    name = "OllamaStandin"
+
+    def _routes(self, app):
+        app.router.add_post("/api/chat", self.chat)
+
+    @staticmethod
+    def _part(content, done=False, **extra):
+        part = {"model": "standin", "created_at": "", "done": done,
+                "message": {"role": "assistant", "content": content}}
+        part.update(extra)
+        return json.dumps(part, ensure_ascii=False).encode() + b"\n"
+
+    async def chat(self, request):
+        rng, error_status, disconnect_at = self._begin(request)
+        body = await request.json()
+        self.bodies.append(body)
+        if error_status:
+            return web.json_response({"error": "injected error"}, status=error_status)
+        if not body.get("messages"):
+            # 空消息只加载模型
+            await asyncio.sleep(self.profile.first_token_delay)
+            return web.json_response(json.loads(self._part("", done=True, done_reason="load",
+                                                           load_duration=int(self.profile.first_token_delay * 1e9))))
+        stream = body.get("stream", True)
+        start = time.perf_counter()
+        response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"}) if stream else None
+        if stream:
+            await response.prepare(request)
+        thinking = False
+        contents = []
+        for index, (kind, token) in enumerate(self.script):
+            if index == disconnect_at:
+                self._disconnect(request)
+                return response or web.Response()
+            await self._pace(rng, index)
+            # 思考片段与正文片段切换处插入<think>标签
+            if kind == "thinking" and not thinking:
+                token = "<think>" + token
+                thinking = True
+            elif kind == "text" and thinking:
+                token = "</think>" + token
+                thinking = False
+            if stream:
+                await response.write(self._part(token))
+            else:
+                contents.append(token)
+        if thinking:
+            token = "</think>"
+            if stream:
+                await response.write(self._part(token))
+            else:
+                contents.append(token)
+        final = dict(done_reason="stop", total_duration=int((time.perf_counter() - start) * 1e9),
+                     prompt_eval_count=sum(len(m.get("content", "")) for m in body["messages"]),
+                     prompt_eval_duration=int(self.profile.first_token_delay * 1e9),
+                     eval_count=len(self.script))
+        if not stream:
+            return web.json_response(json.loads(self._part("".join(contents), done=True, **final)))
+        await response.write(self._part("", done=True, **final))
+        await response.write_eof()
+        return response
+
+
+class AnthropicStandin(StandinServer):
+    """
+    Anthropic Messages API（/v1/messages）替身，SSE流式输出，包含thinking_delta与signature_delta
+
+    模拟提示词缓存：带cache_control的内容块之前的前缀（不少于MIN_CACHE_TOKENS）被写入缓存，
+    之后的请求在任一内容块边界命中已缓存的前缀时只处理其后的部分，usage中报告缓存读写的token数。
+    与真实API相同，thinking参数变化时消息部分的缓存失效，系统提示词的缓存不受影响。
+    按请求的thinking与max_tokens截取回放脚本：未启用思考时不输出思考，思考不超过budget_tokens。
+    支持预填的助手回复（跳过脚本正文中相同的开头）与stop_sequences。
+    """
+
+    name = "AnthropicStandin"
+    MIN_CACHE_TOKENS = 1024  # Sonnet可缓存前缀的最小长度
+
+    def __init__(self, script=None, profile: Optional[StreamProfile] = None, tls=False):
+        super().__init__(script, profile, tls)
+        self.prompt_cache = {}  # 前缀摘要 -> token数
+        self.rate_limited = 0  # 因超出速率限制返回429的次数
+        # 服务端令牌桶：名称 -> [上限, 余量, 上次更新时间]
+        self._buckets = {name: [limit, float(limit), time.monotonic()] for name, limit in (
+            ("requests", self.profile.rate_limit_requests), ("input-tokens", self.profile.rate_limit_input_tokens))
+            if limit}
+
+    def reset_stats(self):
+        super().reset_stats()
+        self.rate_limited = 0
+
+    def _rate_limit(self, input_tokens) -> tuple:
+        """按令牌桶检查速率限制，返回(需要等待的秒数, 响应头)，等待为0时已扣除本次用量"""
+        now = time.monotonic()
+        window = self.profile.rate_limit_window
+        costs = {"requests": 1, "input-tokens": input_tokens}
+        wait = 0.0
+        for name, bucket in self._buckets.items():
+            limit, level, updated = bucket
+            bucket[1] = level = min(limit, level + (now - updated) * limit / window)
+            bucket[2] = now
+            wait = max(wait, (min(costs[name], limit) - level) * window / limit)
+        headers = {}
+        for name, (limit, level, _) in self._buckets.items():
+            if wait <= 0:
+                level -= costs[name]
+                self._buckets[name][1] = level
+            reset = time.time() + max(0.0, limit - level) * window / limit
+            headers[f"anthropic-ratelimit-{name}-limit"] = str(limit)
+            headers[f"anthropic-ratelimit-{name}-remaining"] = str(max(0, int(level)))
+            headers[f"anthropic-ratelimit-{name}-reset"] = datetime.fromtimestamp(reset, timezone.utc).isoformat(
+                timespec="milliseconds").replace("+00:00", "Z")
+        return max(0.0, wait), headers
+
+    def _routes(self, app):
+        app.router.add_post("/v1/messages", self.messages)
+
+    @staticmethod
+    def _event(event_type, data) -> bytes:
+        data["type"] = event_type
+        return f"event: {event_type}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n".encode()
+
+    @staticmethod
+    def _blocks(body):
+        """按发送顺序展开system与messages中的内容块，之前轮次的思考块不计入输入"""
+        system = body.get("system") or []
+        for block in [{"type": "text", "text": system}] if isinstance(system, str) else system:
+            yield dict(block, role="system")
+        for message in body.get("messages", []):
+            content = message["content"]
+            if isinstance(content, str):
+                content = [{"type": "text", "text": content}]
+            for block in content:
+                if block.get("type") != "thinking":
+                    yield dict(block, role=message["role"])
+
+    def _usage(self, body):
+        """计算本次请求的输入token数，其中命中缓存的部分与新写入缓存的部分"""
+        digest = hashlib.sha256()
+        total = 0
+        cached = 0
+        breakpoint_prefix = None
+        in_messages = False
+        for block in self._blocks(body):
+            if not in_messages and block["role"] != "system":
+                # 消息部分的缓存与thinking参数相关
+                in_messages = True
+                digest.update(json.dumps(body.get("thinking"), sort_keys=True).encode())
+            cache_control = block.pop("cache_control", None)
+            digest.update(json.dumps(block, ensure_ascii=False, sort_keys=True).encode())
+            total += estimate_tokens(block.get("text", ""))
+            key = digest.hexdigest()
+            if key in self.prompt_cache:
+                cached = total
+            if cache_control is not None and total >= self.MIN_CACHE_TOKENS:
+                breakpoint_prefix = (key, total)
+        written = 0
+        if breakpoint_prefix is not None and breakpoint_prefix[1] > cached:
+            self.prompt_cache[breakpoint_prefix[0]] = breakpoint_prefix[1]
+            written = breakpoint_prefix[1] - cached
+        return {"input_tokens": total - cached - written, "output_tokens": 1,
+                "cache_creation_input_tokens": written, "cache_read_input_tokens": cached}
+
+    def _script_for(self, body) -> tuple:
+        """按请求截取回放脚本，返回(脚本, stop_reason)"""
+        thinking = body.get("thinking") or {}
+        budget = thinking.get("budget_tokens", 0) if thinking.get("type") == "enabled" else 0
+        messages = body.get("messages") or []
+        prefill = ""
+        if messages and messages[-1]["role"] == "assistant" and isinstance(messages[-1]["content"], str):
+            prefill = messages[-1]["content"]
+        stops = body.get("stop_sequences") or []
+        script = []
+        thinking_tokens = 0
+        text = ""
+        stop_reason = "end_turn"
+        for kind, token in self.script:
+            if kind == "thinking":
+                if thinking_tokens >= budget:
+                    continue
+                thinking_tokens += 1
+            elif prefill:
+                # 预填的内容已在请求中，从其后继续输出
+                cut = min(len(prefill), len(token))
+                token, prefill = token[cut:], prefill[cut:]
+                if not token:
+                    continue
+            if kind == "text" and stops:
+                text += token
+                positions = [text.find(stop) for stop in stops if stop in text]
+                if positions:
+                    token = token[:len(token) - (len(text) - min(positions))]
+                    if token:
+                        script.append((kind, token))
+                    stop_reason = "stop_sequence"
+                    break
+            script.append((kind, token))
+        max_tokens = body.get("max_tokens")
+        if max_tokens is not None and len(script) > max_tokens:
+            return script[:max_tokens], "max_tokens"
+        return script, stop_reason
+
+    async def messages(self, request):
+        rng, error_status, disconnect_at = self._begin(request)
+        body = await request.json()
+        self.bodies.append(body)
+        if error_status:
+            error_type = {429: "rate_limit_error", 529: "overloaded_error"}.get(error_status, "api_error")
+            return web.json_response({"type": "error", "error": {"type": error_type, "message": "injected error"}},
+                                     status=error_status, headers={"retry-after": "1"} if error_status == 429 else None)
+        wait, rate_headers = self._rate_limit(sum(estimate_tokens(block.get("text", "")) for block in self._blocks(body)))
+        if wait > 0:
+            self.rate_limited += 1
+            rate_headers["retry-after"] = str(math.ceil(wait))
+            return web.json_response({"type": "error", "error": {"type": "rate_limit_error",
+                                                                 "message": "rate limit exceeded"}},
+                                     status=429, headers=rate_headers)
+
+        usage = self._usage(body)
+        if self.profile.prefill_rate > 0:
+            # 未命中缓存的输入需要重新处理
+            uncached = usage["input_tokens"] + usage["cache_creation_input_tokens"]
+            await asyncio.sleep(uncached / self.profile.prefill_rate)
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache",
+                                               **rate_headers})
+        await response.prepare(request)
+        await response.write(self._event("message_start", {"message": {
+            "id": f"msg_standin_{self.requests}", "type": "message", "role": "assistant",
+            "model": body.get("model", "standin"), "content": [], "stop_reason": None,
+            "usage": usage}}))
+        await response.write(self._event("ping", {}))
+
+        script, stop_reason = self._script_for(body)
+        block_index = -1
+        block_kind = None
+        output_tokens = 0
+        for index, (kind, token) in enumerate(script):
+            if index == disconnect_at:
+                self._disconnect(request)
+                return response
+            await self._pace(rng, index)
+            if kind != block_kind:
+                if block_kind is not None:
+                    await self._close_block(response, block_index, block_kind)
+                block_index += 1
+                block_kind = kind
+                block = {"type": "thinking", "thinking": ""} if kind == "thinking" else {"type": "text", "text": ""}
+                await response.write(self._event("content_block_start", {"index": block_index, "content_block": block}))
+            if kind == "thinking":
+                delta = {"type": "thinking_delta", "thinking": token}
+            else:
+                delta = {"type": "text_delta", "text": token}
+            await response.write(self._event("content_block_delta", {"index": block_index, "delta": delta}))
+            output_tokens += 1
+        if block_kind is not None:
+            await self._close_block(response, block_index, block_kind)
+        await response.write(self._event("message_delta", {
+            "delta": {"stop_reason": stop_reason, "stop_sequence": None},
+            "usage": {"output_tokens": output_tokens}}))
+        await response.write(self._event("message_stop", {}))
+        await response.write_eof()
+        return response
+
+    async def _close_block(self, response, block_index, block_kind):
+        if block_kind == "thinking":
+            # 思考块结束前发送签名
+            await response.write(self._event("content_block_delta", {
+                "index": block_index, "delta": {"type": "signature_delta", "signature": "c3RhbmRpbi1zaWduYXR1cmU="}}))
+        await response.write(self._event("content_block_stop", {"index": block_index}))
+
+
+if __name__ == "__main__":
+    # 端到端基准：用替身服务器测试Deepseek与Sonnet的首token延迟与吞吐
+    # python standin_servers.py [轮数] [token速率] [录制的token流.json]
+    import sys
+
+    from metrics import LatencyMetrics, StreamTimer
+
+    turns = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    rate = float(sys.argv[2]) if len(sys.argv) > 2 else 200.0
+    script = load_script(sys.argv[3]) if len(sys.argv) > 3 else None
+    profile = StreamProfile(token_rate=rate, jitter=0.3, first_token_delay=0.1, seed=0)
+
+    async def run_backend(name, backend, server):
+        metrics = LatencyMetrics()
+        server.reset_stats()
+        start = time.perf_counter()
+        chars = 0
+        for turn in range(turns):
+            timer = StreamTimer()
+            async for chunk in backend.generate_response(f"第{turn}轮: 主人好"):
+                timer.tick()
+                chars += len(chunk)
+            metrics.record_turn(timer.results())
+        elapsed = time.perf_counter() - start
+        if hasattr(backend, "aclose"):
+            await backend.aclose()
+        summary = metrics.summary()
+        print(f"{name}: {turns}轮, 首token p50 {summary['llm_ttft_seconds']['p50'] * 1e3:.0f}ms "
+              f"p95 {summary['llm_ttft_seconds']['p95'] * 1e3:.0f}ms, "
+              f"{summary['llm_tokens_per_second']['p50']:.0f} chunks/s, {chars}字符, 总耗时 {elapsed:.2f}s, "
+              f"请求 {server.requests}, 连接 {server.connections}")
+
+    async def main(ollama_url, anthropic_url):
+        from deepseek import Deepseek
+        await run_backend("Deepseek", Deepseek(host=ollama_url), ollama_server)
+        try:
+            from sonnet import Sonnet
+        except ImportError as e:
+            print(f"跳过Sonnet: {e}")
+            return
+        await run_backend("Sonnet", Sonnet(api_key="standin", base_url=anthropic_url), anthropic_server)
+
+    with OllamaStandin(script, profile) as ollama_server, AnthropicStandin(script, profile) as anthropic_server:
+        asyncio.run(main(ollama_server.url, anthropic_server.url))
@@ -0,0 +1,278 @@
+from typing import List
+
+from llm_events import TextDelta, ThinkingDelta, PromptTag
+
+THINK_OPEN = "<think>"
+THINK_CLOSE = "</think>"
+PROMPT_OPEN = "{"
+PROMPT_CLOSE = "}"
+
+# 扫描器状态
+_TEXT = 0
+_THINK = 1
+_PROMPT = 2
+
+
+def _partial_tag_length(data: str, start: int, tag: str) -> int:
+    """返回data[start:]末尾与tag前缀相同的最大长度（不含完整tag）"""
+    # 绝大多数chunk末尾没有'<'，一次rfind即可排除
+    if data.rfind(tag[0], max(start, len(data) - len(tag) + 1)) == -1:
+        return 0
+    for length in range(min(len(tag) - 1, len(data) - start), 0, -1):
+        if data.endswith(tag[:length], start):
+            return length
+    return 0
+
+
+class TagScanner:
+    """
+    流式标签扫描器，逐块处理LLM输出中的<think>...</think>与{...}标签
+
+    标签被拆分到多个chunk中时，末尾可能是标签前缀的几个字符会暂存在carry中，
+    与下一个chunk拼接后再判断；每个字符只被扫描常数次。
+    流式输出的chunk通常只有几个字符且不含标签的起始字符，这种chunk只做一次in判断就整块输出。
+    think_tags=False时只提取{...}，用于思考内容已单独给出的后端（如Sonnet的thinking_delta）。
+    """
+
+    def __init__(self, think_tags=True):
+        self.think_tags = think_tags
+        self._state = _TEXT
+        self._carry = ""
+        self._prompt_parts = []
+
+    def feed(self, chunk: str) -> List[object]:
+        """处理一个chunk，返回TextDelta/ThinkingDelta/PromptTag事件列表"""
+        if not self._carry and chunk:
+            # 快速路径：chunk中没有当前状态下可能开始或结束标签的字符
+            state = self._state
+            if state == _TEXT:
+                if "{" not in chunk and ("<" not in chunk or not self.think_tags):
+                    return [TextDelta(chunk)]
+            elif state == _THINK:
+                if "<" not in chunk:
+                    return [ThinkingDelta(chunk)]
+            elif "}" not in chunk:
+                self._prompt_parts.append(chunk)
+                return []
+
+        events = []
+        if self._carry:
+            data = self._carry + chunk
+            self._carry = ""
+        else:
+            data = chunk
+        end = len(data)
+        pos = 0
+
+        # 各标签的下一个位置，-2表示尚未查找，-1表示之后不存在
+        think_close_at = prompt_open_at = prompt_close_at = -2
+        think_open_at = -2 if self.think_tags else -1
+
+        while pos < end:
+            if self._state == _TEXT:
+                if think_open_at != -1 and think_open_at < pos:
+                    think_open_at = data.find(THINK_OPEN, pos)
+                if prompt_open_at != -1 and prompt_open_at < pos:
+                    prompt_open_at = data.find(PROMPT_OPEN, pos)
+
+                if think_open_at == -1 and prompt_open_at == -1:
+                    # 没有完整标签，保留可能是<think>前缀的尾部
+                    partial = _partial_tag_length(data, pos, THINK_OPEN) if self.think_tags else 0
+                    if end - partial > pos:
+                        events.append(TextDelta(data[pos:end - partial]))
+                    if partial:
+                        self._carry = data[end - partial:]
+                    break
+
+                if prompt_open_at == -1 or (think_open_at != -1 and think_open_at < prompt_open_at):
+                    if think_open_at > pos:
+                        events.append(TextDelta(data[pos:think_open_at]))
+                    pos = think_open_at + len(THINK_OPEN)
+                    self._state = _THINK
+                else:
+                    if prompt_open_at > pos:
+                        events.append(TextDelta(data[pos:prompt_open_at]))
+                    pos = prompt_open_at + len(PROMPT_OPEN)
+                    self._state = _PROMPT
+                    self._prompt_parts = []
+
+            elif self._state == _THINK:
+                if think_close_at != -1 and think_close_at < pos:
+                    think_close_at = data.find(THINK_CLOSE, pos)
+
+                if think_close_at == -1:
+                    partial = _partial_tag_length(data, pos, THINK_CLOSE)
+                    if end - partial > pos:
+                        events.append(ThinkingDelta(data[pos:end - partial]))
+                    if partial:
+                        self._carry = data[end - partial:]
+                    break
+
+                if think_close_at > pos:
+                    events.append(ThinkingDelta(data[pos:think_close_at]))
+                pos = think_close_at + len(THINK_CLOSE)
+                self._state = _TEXT
+
+            else:
+                if prompt_close_at != -1 and prompt_close_at < pos:
+                    prompt_close_at = data.find(PROMPT_CLOSE, pos)
+
+                if prompt_close_at == -1:
+                    self._prompt_parts.append(data[pos:])
+                    break
+
+                self._prompt_parts.append(data[pos:prompt_close_at])
+                events.append(PromptTag("".join(self._prompt_parts)))
+                self._prompt_parts = []
+                pos = prompt_close_at + len(PROMPT_CLOSE)
+                self._state = _TEXT
+
+        return events
+
+    def flush(self) -> List[object]:
+        """流结束时调用，输出暂存的内容并重置状态；未闭合的{...}会被丢弃"""
+        events = []
+        if self._carry:
+            if self._state == _TEXT:
+                events.append(TextDelta(self._carry))
+            elif self._state == _THINK:
+                events.append(ThinkingDelta(self._carry))
+        self._state = _TEXT
+        self._carry = ""
+        self._prompt_parts = []
+        return events
+
+
+if __name__ == "__main__":
+    # 微基准测试：python tag_scanner.py [录制的chunk列表.json ...]
+    import json
+    import random
+    import sys
+    import time
+
+    def synthetic_stream(seed, tokens=4000):
+        """生成一段与deepseek-r1输出结构相同的token流"""
+        rng = random.Random(seed)
+        words = ["主人", "喵", "今天", "天气", "真好", "我们", "一起", "出去", "玩吧", "，", "。",
+                 "the", "user", "wants", "me", "to", "think", "about", "this", " "]
+        thinking = "".join(rng.choice(words) for _ in range(tokens // 2))
+        reply = "".join(rng.choice(words) for _ in range(tokens // 2))
+        tags = "light blue hair, cat ear, opened, school uniform, pleated skirt, shy"
+        text = f"<think>{thinking}</think>\n\n{{{tags}}}{reply}"
+        chunks = []
+        pos = 0
+        while pos < len(text):
+            step = rng.randint(1, 4)
+            chunks.append(text[pos:pos + step])
+            pos += step
+        return chunks
+
+    def legacy_scan(chunks):
+        """原先基于str.split的实现，用作对比"""
+        out = []
+        collecting_think = collecting_prompt = False
+        for chunk in chunks:
+            if collecting_think and "</think>" in chunk:
+                collecting_think = False
+                parts = chunk.split("</think>")
+                if parts[1]:
+                    out.append(parts[1])
+                continue
+            if not collecting_think and "<think>" in chunk:
+                collecting_think = True
+                continue
+            if collecting_think:
+                continue
+            if collecting_prompt and "}" in chunk:
+                collecting_prompt = False
+                continue
+            if not collecting_prompt and "{" in chunk:
+                collecting_prompt = True
+                continue
+            if not collecting_prompt:
+                out.append(chunk)
+        return out
+
+    def scan(chunks, think_tags=True):
+        scanner = TagScanner(think_tags)
+        events = []
+        for chunk in chunks:
+            events.extend(scanner.feed(chunk))
+        events.extend(scanner.flush())
+        return events
+
+    def merged(events):
+        """合并相邻的同类片段，切分方式不同时片段的边界可以不同，内容与顺序必须相同"""
+        result = []
+        for event in events:
+            value = event.prompt if type(event) is PromptTag else event.text
+            if result and type(event) is not PromptTag and result[-1][0] is type(event):
+                result[-1] = (type(event), result[-1][1] + value)
+            else:
+                result.append((type(event), value))
+        return result
+
+    def fuzz(rounds=3000):
+        """随机拼接标签片段并随机切分，逐块扫描的结果必须与一次扫描完整文本相同"""
+        rng = random.Random(0)
+        pieces = ["<think>", "</think>", "<", "</", "<th", "think>", "{", "}", "{a, b}", "喵", "主人", "x", " ", "<<"]
+        for _ in range(rounds):
+            text = "".join(rng.choice(pieces) for _ in range(rng.randint(0, 30)))
+            cuts = sorted(rng.sample(range(1, len(text)), min(len(text) - 1, rng.randint(0, 8)))) if text else []
+            chunks = [text[start:end] for start, end in zip([0] + cuts, cuts + [len(text)])]
+            for think_tags in (True, False):
+                assert merged(scan(chunks, think_tags)) == merged(scan([text], think_tags)), (chunks, think_tags)
+        print(f"随机切分测试: {rounds}段文本, 逐块扫描与整段扫描结果相同")
+
+    def event_floor(chunks):
+        """每个chunk调用一次方法、生成一个事件的开销，即逐块输出事件的下限"""
+        def feed(chunk):
+            return [TextDelta(chunk)]
+
+        events = []
+        for chunk in chunks:
+            events.extend(feed(chunk))
+        return events
+
+    def bench(func, chunks, repeat=20):
+        best = float("inf")
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func(chunks)
+            best = min(best, time.perf_counter() - start)
+        return best
+
+    if len(sys.argv) > 1:
+        streams = []
+        for path in sys.argv[1:]:
+            with open(path, "r", encoding="utf-8") as f:
+                streams.append((path, json.load(f)))
+    else:
+        streams = [(f"synthetic-{seed}", synthetic_stream(seed)) for seed in range(3)]
+
+    fuzz()
+    for name, chunks in streams:
+        chars = sum(len(c) for c in chunks)
+        events = scan(chunks)
+        full = "".join(chunks)
+        visible = "".join(e.text for e in events if type(e) is TextDelta)
+        thinking = "".join(e.text for e in events if type(e) is ThinkingDelta)
+        prompts = [e.prompt for e in events if type(e) is PromptTag]
+        # 无论怎样切分chunk，结果都应与一次性扫描完整文本相同
+        whole = scan([full])
+        assert visible == "".join(e.text for e in whole if type(e) is TextDelta)
+        assert thinking == "".join(e.text for e in whole if type(e) is ThinkingDelta)
+        assert prompts == [e.prompt for e in whole if type(e) is PromptTag]
+        leaked = THINK_OPEN in visible or THINK_CLOSE in visible
+        legacy_leaked = any(tag in "".join(legacy_scan(chunks)) for tag in (THINK_OPEN, THINK_CLOSE))
+
+        elapsed = bench(scan, chunks)
+        legacy_elapsed = bench(legacy_scan, chunks)
+        floor_elapsed = bench(event_floor, chunks)
+        print(f"{name}: {len(chunks)} chunks, {chars} chars, "
+              f"thinking {len(thinking)} chars, prompts {prompts!r}")
+        print(f"  TagScanner: {elapsed * 1e3:.2f}ms, {elapsed / chars * 1e9:.0f}ns/char, "
+              f"{elapsed / len(chunks) * 1e6:.2f}us/chunk, 标签泄漏: {leaked}")
+        print(f"  legacy split: {legacy_elapsed * 1e3:.2f}ms, {legacy_elapsed / chars * 1e9:.0f}ns/char, "
+              f"标签泄漏: {legacy_leaked}（只输出字符串，不生成事件）")
+        print(f"  每个chunk生成一个事件的下限: {floor_elapsed * 1e3:.2f}ms, {floor_elapsed / chars * 1e9:.0f}ns/char")
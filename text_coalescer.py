@@ -0,0 +1,102 @@
+import asyncio
+
+
+class TextCoalescer:
+    """
+    合并高频的文本片段后再发送到UI
+
+    每个token都跨线程发射一次信号会塞满Qt事件队列，这里把片段先缓存，
+    每隔flush_interval秒（默认约一帧）或累计max_chars个字符时合并发送一次。
+    必须在事件循环线程中调用。
+    """
+
+    def __init__(self, emit, flush_interval=1 / 60, max_chars=256):
+        self.emit = emit
+        self.flush_interval = flush_interval  # 秒，<=0时不做合并
+        self.max_chars = max_chars
+        self.emit_count = 0
+        self._parts = []
+        self._size = 0
+        self._timer = None
+
+    def add(self, text: str):
+        """缓存一个文本片段，必要时立即发送"""
+        if not text:
+            return
+        self._parts.append(text)
+        self._size += len(text)
+        if self.flush_interval <= 0 or self._size >= self.max_chars:
+            self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.flush_interval, self.flush)
+
+    def flush(self):
+        """立即发送已缓存的全部文本"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._parts:
+            return
+        text = "".join(self._parts)
+        self._parts = []
+        self._size = 0
+        self.emit_count += 1
+        self.emit(text)
+
+
+if __name__ == "__main__":
+    # 对比逐token发射与合并发射时的信号数量与UI线程耗时
+    import os
+    import sys
+    import time
+
+    from PyQt6.QtCore import QObject, pyqtSignal as Signal
+    from PyQt6.QtWidgets import QApplication, QTextEdit
+
+    from loop_thread import EventLoopThread
+
+    tokens = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    rate = float(sys.argv[2]) if len(sys.argv) > 2 else 100.0  # tokens/s
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    app = QApplication(sys.argv)
+
+    class Emitter(QObject):
+        text_chunk_ready = Signal(str)
+
+    def run(flush_interval):
+        emitter = Emitter()
+        view = QTextEdit()
+        view.setReadOnly(True)
+        stats = {"signals": 0, "ui_time": 0.0}
+
+        def update_chat_text(text):
+            start = time.perf_counter()
+            view.insertPlainText(text)
+            view.verticalScrollBar().setValue(view.verticalScrollBar().maximum())
+            stats["ui_time"] += time.perf_counter() - start
+            stats["signals"] += 1
+
+        emitter.text_chunk_ready.connect(update_chat_text)
+        coalescer = TextCoalescer(emitter.text_chunk_ready.emit, flush_interval=flush_interval)
+
+        async def stream():
+            for index in range(tokens):
+                coalescer.add(f"喵{index} ")
+                await asyncio.sleep(1 / rate)
+            coalescer.flush()
+
+        loop_thread = EventLoopThread("CoalescerBench")
+        future = loop_thread.submit(stream)
+        while not future.done():
+            app.processEvents()
+            time.sleep(0.001)
+        loop_thread.stop()
+        app.processEvents()
+        return stats, view.toPlainText()
+
+    baseline, baseline_text = run(0)
+    coalesced, coalesced_text = run(1 / 60)
+    assert baseline_text == coalesced_text
+    for name, stats in (("per-token", baseline), ("coalesced", coalesced)):
+        print(f"{name}: {tokens} tokens @ {rate:.0f}/s, signals {stats['signals']}, "
+              f"UI time {stats['ui_time'] * 1e3:.1f}ms")
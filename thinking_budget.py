@@ -0,0 +1,248 @@
+import re
+
+from chat_history import estimate_tokens
+from log_utils import log, debug
+from metrics import pipeline_metrics
+
+# 需要推理的输入的特征词，命中时预算提高一档
+REASONING_MARKERS = ("为什么", "怎么", "如何", "怎样", "解释", "分析", "计算", "比较", "区别", "建议", "推荐",
+                     "步骤", "证明", "规划")
+# 英文特征词按整词匹配，避免"show"、"however"中的"how"
+ENGLISH_REASONING_MARKERS = re.compile(r"\b(why|how|explain|compare)\b")
+
+
+class ThinkingPlan:
+    """一轮请求的思考预算与输出上限，budget为0时不启用扩展思考"""
+    __slots__ = ("budget", "max_tokens", "reason")
+
+    def __init__(self, budget: int, max_tokens: int, reason: str):
+        self.budget = budget
+        self.max_tokens = max_tokens
+        self.reason = reason
+
+    def payload(self) -> dict:
+        """请求体中的max_tokens与thinking字段"""
+        fields = {"max_tokens": self.max_tokens}
+        if self.budget:
+            fields["thinking"] = {"type": "enabled", "budget_tokens": self.budget}
+        return fields
+
+    def __repr__(self):
+        return f"ThinkingPlan(budget={self.budget}, max_tokens={self.max_tokens}, reason={self.reason!r})"
+
+
+class ThinkingBudget:
+    """
+    按轮选择扩展思考预算
+
+    先按用户输入的长度与是否需要推理选出期望的档位，简短的寒暄不启用思考；
+    再按延迟目标限制思考预算（max_tokens保持不变，正文长度不受影响）：用最近几轮观测到的首token延迟、输出速度、回复长度与思考预算的实际使用比例，
+    估算在latency_target秒内还能容纳多大的预算。预算只在TIERS的几个档位之间切换。
+    思考参数变化会使消息部分的提示词缓存失效（系统提示词不受影响），降低预算时比较节省的思考时间
+    与重新处理已缓存对话的时间，后者更长时保持上一轮的预算；提高预算总是允许。
+    每轮的预算、实际思考token数与耗时记入metrics，用于按数据调整档位与阈值。
+    速度等观测值在共享同一个后端的所有会话间共用；上一轮的预算与消息缓存一样属于各个会话，由调用方传入。
+    """
+
+    TIERS = (0, 1024, 4096, 16000)
+    MIN_BUDGET = 1024  # API允许的最小思考预算
+
+    def __init__(self, latency_target=120.0, tiers=TIERS, max_tokens=32000, trivial_tokens=12,
+                 output_rate=80.0, first_token=1.0, prefill_rate=5000.0, smoothing=0.3, fixed_budget=None,
+                 metrics=pipeline_metrics):
+        """
+        Args:
+            latency_target: 每轮从发出请求到回复结束的目标秒数。默认值下按初始估计最高档也可以选到
+                （16000的预算约思考一半，80tokens/s约需100s）；调低后较高的档位只在实测思考较少时才会选到
+            tiers: 可选的思考预算档位，0表示不思考
+            max_tokens: 每轮的输出上限（原先为32000），思考与正文共用，不随预算调整
+            trivial_tokens: 不超过这个长度且没有推理特征词的输入不启用思考
+            output_rate / first_token / prefill_rate: 输出速度（token/s）、首token延迟（秒）与未命中缓存时
+                处理输入的速度（token/s）的初始估计，之后按观测值平滑更新
+            smoothing: 观测值的指数平滑系数
+            fixed_budget: 固定的思考预算（原先为16000），设置后不再按轮调整
+        """
+        self.latency_target = latency_target
+        self.tiers = tuple(sorted(tiers))
+        self.max_tokens = max_tokens
+        self.trivial_tokens = trivial_tokens
+        self.smoothing = smoothing
+        self.fixed_budget = fixed_budget
+        self.metrics = metrics
+        # 观测值的平滑估计
+        self.output_rate = output_rate
+        self.first_token = first_token
+        self.prefill_rate = prefill_rate
+        self.reply_estimate = 150.0  # 正文的token数
+        self.utilization = 0.5  # 实际思考token数 / 预算
+
+    def _level(self, prompt: str) -> tuple:
+        """按输入选出期望的档位下标与原因"""
+        tokens = estimate_tokens(prompt)
+        lowered = prompt.lower()
+        reasoning = any(marker in lowered for marker in REASONING_MARKERS) or \
+            ENGLISH_REASONING_MARKERS.search(lowered) is not None
+        if tokens <= self.trivial_tokens and not reasoning:
+            return 0, "简短输入"
+        level = 1 if tokens <= 60 else 2 if tokens <= 300 else 3
+        if reasoning:
+            level += 1
+        return min(level, len(self.tiers) - 1), "需要推理" if reasoning else f"输入{tokens}tokens"
+
+    def affordable(self) -> int:
+        """按延迟目标估算本轮可以使用的最大思考预算"""
+        thinking_seconds = self.latency_target - self.first_token - self.reply_estimate / self.output_rate
+        return int(max(0.0, thinking_seconds) * self.output_rate / max(self.utilization, 0.05))
+
+    def choose(self, prompt: str, history_tokens=0, previous: int = None) -> ThinkingPlan:
+        """
+        选择本轮的预算
+        Args:
+            prompt: 本轮的用户输入
+            history_tokens: 本轮之前已有的对话（含系统提示词）的token数，即可以命中缓存的前缀长度
+            previous: 同一对话上一轮的预算（如ChatHistory.last_thinking_budget），None时不考虑消息缓存
+        """
+        if self.fixed_budget is not None:
+            return ThinkingPlan(self.fixed_budget, self._max_tokens(self.fixed_budget), "固定预算")
+        level, reason = self._level(prompt)
+        budget = self.tiers[level]
+        cap = self.affordable()
+        if budget > cap:
+            budget = max((tier for tier in self.tiers if tier <= cap), default=0)
+            reason = f"延迟目标{self.latency_target:.0f}s内最多{cap}tokens"
+        if budget and budget < self.MIN_BUDGET:
+            budget = 0
+        if previous is not None and budget < previous <= cap:
+            saved = (previous - budget) * self.utilization / self.output_rate
+            if history_tokens / self.prefill_rate > saved:
+                # 节省的思考时间不及重新处理整个对话历史，保持上一轮的预算
+                budget = previous
+                reason = "保持消息缓存"
+        plan = ThinkingPlan(budget, self._max_tokens(budget), reason)
+        debug("ThinkingBudget", "%r", plan)
+        return plan
+
+    def _max_tokens(self, budget: int) -> int:
+        """API要求max_tokens大于思考预算，预算超过上限时为正文另留一个最小预算的空间"""
+        return max(self.max_tokens, budget + self.MIN_BUDGET)
+
+    def _smooth(self, old, new):
+        return old + self.smoothing * (new - old)
+
+    def record(self, plan: ThinkingPlan, elapsed: float, first_token: float, thinking_tokens: int,
+               output_tokens: int, uncached_tokens=0):
+        """
+        记录一轮的观测值并更新估计
+        Args:
+            elapsed: 从发出请求到回复结束的秒数
+            first_token: 首个输出（思考或正文）的延迟秒数
+            thinking_tokens: 实际的思考token数
+            output_tokens: 输出的总token数（含思考）
+            uncached_tokens: 未命中缓存的输入token数（含写入缓存的部分）
+        """
+        self.first_token = self._smooth(self.first_token, first_token)
+        if uncached_tokens >= 1024 and first_token > 0:
+            self.prefill_rate = self._smooth(self.prefill_rate, uncached_tokens / first_token)
+        streaming = elapsed - first_token
+        if output_tokens > 1 and streaming > 0:
+            self.output_rate = self._smooth(self.output_rate, output_tokens / streaming)
+        self.reply_estimate = self._smooth(self.reply_estimate, max(0, output_tokens - thinking_tokens))
+        if plan.budget:
+            self.utilization = self._smooth(self.utilization, min(1.0, thinking_tokens / plan.budget))
+        self.metrics.record(f"llm_response_seconds_budget_{plan.budget}", elapsed)
+        self.metrics.record(f"llm_thinking_tokens_budget_{plan.budget}", thinking_tokens)
+        log("ThinkingBudget", f"思考预算{plan.budget}({plan.reason}): 耗时{elapsed:.2f}s, 思考{thinking_tokens}tokens, "
+                              f"输出速度估计{self.output_rate:.0f}tokens/s")
+
+    def stats(self) -> dict:
+        """每个档位的耗时与实际思考token数"""
+        summary = self.metrics.summary()
+        result = {}
+        for budget in self.tiers if self.fixed_budget is None else (self.fixed_budget,):
+            seconds = summary.get(f"llm_response_seconds_budget_{budget}")
+            if seconds is None:
+                continue
+            thinking = summary[f"llm_thinking_tokens_budget_{budget}"]
+            result[budget] = {"turns": seconds["count"], "seconds_p50": seconds["p50"], "seconds_p95": seconds["p95"],
+                              "thinking_mean": thinking["mean"]}
+        return result
+
+
+if __name__ == "__main__":
+    # 用替身服务器对比原先的固定预算（16000/32000）与按轮调整的预算在一段多轮对话中的每轮耗时、思考token数与缓存命中
+    # 替身每秒输出1000个token（output_rate初始估计的12.5倍），延迟目标按同样的比例缩小，默认10s约对应默认的120s
+    # python thinking_budget.py [延迟目标秒数]
+    import asyncio
+    import os
+    import sys
+    import tempfile
+    import time
+
+    from journal import ConversationJournal
+    from metrics import LatencyMetrics
+    from sonnet import Sonnet
+    from standin_servers import AnthropicStandin, DEFAULT_REPLY, DEFAULT_TAGS, DEFAULT_THINKING, StreamProfile, \
+        split_tokens
+
+    target = float(sys.argv[1]) if len(sys.argv) > 1 else 10.0
+    # 模型在预算充足时思考约3000个token，正文约100个token；逐字输出，与estimate_tokens的估算一致
+    script = [("thinking", token) for token in split_tokens(DEFAULT_THINKING * 100, max_size=1)[:3000]]
+    script += [("text", token) for token in split_tokens(f"{{{DEFAULT_TAGS}}}", min_size=4, max_size=4)]
+    script += [("text", token) for token in split_tokens(DEFAULT_REPLY * 3, max_size=1)]
+    plan_text = "主人下周想带你去海边旅行，要坐三个小时的火车，住两个晚上，预算不多，还想去水族馆和夜市。" * 8
+    prompts = [
+        ("简短", "主人早上好"),
+        ("简短", "嗯嗯"),
+        ("普通", "今天晚上我们吃什么好呢，你有什么想吃的吗"),
+        ("推理", "为什么猫咪总是喜欢晒太阳呀？给我解释一下"),
+        ("简短", "好的喵"),
+        ("推理", plan_text + "帮我规划一下行程吧"),
+        ("普通", "那我们带什么零食去火车上吃呢，你喜欢吃什么"),
+        ("简短", "哈哈"),
+        ("推理", "水族馆和夜市应该先去哪个？比较一下"),
+        ("普通", "到了海边你最想做什么事情呢，说说看吧"),
+        ("简短", "晚安喵"),
+        ("普通", "明天早上几点出发比较好呢，你来决定吧"),
+    ]
+
+    async def run(name, server, journal, budget):
+        server.prompt_cache.clear()
+        server.reset_stats()
+        sonnet = Sonnet(api_key="standin", base_url=server.url, journal=journal, conversation=name,
+                        max_history_tokens=16000, thinking_budget=budget)
+        seconds = {}
+        thinking = 0
+        cache_read = 0
+        uncached = 0
+        start = time.perf_counter()
+        for kind, prompt in prompts:
+            turn_start = time.perf_counter()
+            async for _ in sonnet.generate_response(prompt):
+                pass
+            seconds.setdefault(kind, []).append(time.perf_counter() - turn_start)
+            thinking += sonnet.last_stats['llm_thinking_tokens']
+            cache_read += sonnet.last_stats['llm_cache_read_tokens']
+            uncached += sonnet.last_stats['llm_input_tokens'] + sonnet.last_stats['llm_cache_write_tokens']
+        elapsed = time.perf_counter() - start
+        await sonnet.aclose()
+        per_kind = ", ".join(f"{kind} {sum(values) / len(values):.2f}s" for kind, values in seconds.items())
+        print(f"{name}: {len(prompts)}轮共 {elapsed:.2f}s (平均每轮 {per_kind}), 思考 {thinking}tokens, "
+              f"缓存读取 {cache_read}tokens, 未命中缓存的输入 {uncached}tokens")
+        for tier, stats in budget.stats().items():
+            print(f"    预算{tier}: {stats['turns']}轮, 耗时p50 {stats['seconds_p50']:.2f}s, "
+                  f"平均思考 {stats['thinking_mean']:.0f}tokens")
+
+    async def main(server):
+        with tempfile.TemporaryDirectory() as tmp:
+            journal = ConversationJournal(os.path.join(tmp, "conversations.db"))
+            print("替身: 每秒输出1000tokens, 每秒处理20000个输入token")
+            await run("原先(固定16000)", server, journal,
+                      ThinkingBudget(fixed_budget=16000, metrics=LatencyMetrics()))
+            for latency_target in (target / 4, target, target * 2):
+                await run(f"按轮调整(延迟目标{latency_target:.1f}s)", server, journal,
+                          ThinkingBudget(latency_target=latency_target, output_rate=1000.0, first_token=0.05,
+                                         prefill_rate=20000.0, metrics=LatencyMetrics()))
+            journal.close()
+
+    with AnthropicStandin(script, StreamProfile(token_rate=1000, prefill_rate=20000, first_token_delay=0.05)) as standin:
+        asyncio.run(main(standin))